@@ -0,0 +1,136 @@
+import collections
+import math
+import time
+from typing import Any, Deque, Dict, Tuple
+
+from errors import ServiceUnavailableError
+
+
+class CircuitOpenError(ServiceUnavailableError):
+    """Raised when a model's circuit is open and calls are being short-circuited"""
+
+
+class CircuitBreaker:
+    """Circuit breaker for a single model.
+
+    Closed: calls go through, and outcomes are kept for the last
+    ``window_seconds``. Once at least ``min_calls`` outcomes are in the window
+    and the share of errors and timeouts reaches ``failure_rate``, the circuit
+    opens.
+
+    Open: calls fail immediately for ``open_seconds``, then the circuit goes
+    half-open.
+
+    Half-open: up to ``half_open_calls`` probe calls go through. A successful
+    probe closes the circuit and a failed one opens it again.
+
+    The caller records one outcome per call, however many attempts it took.
+    Errors that say nothing about the provider's health, such as a request
+    failing the provider's input validation, go to ``record_neutral``.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, name: str, window_seconds: float, min_calls: int, failure_rate: float,
+                 open_seconds: float, half_open_calls: int):
+        self.name = name
+        self.window_seconds = window_seconds
+        self.min_calls = min_calls
+        self.failure_rate = failure_rate
+        self.open_seconds = open_seconds
+        self.half_open_calls = half_open_calls
+
+        self._state = self.CLOSED
+        self.opened_at = 0.0
+        self.probes_in_flight = 0
+        # (timestamp, failed, timed_out)
+        self.outcomes: Deque[Tuple[float, bool, bool]] = collections.deque()
+        self.times_opened = 0
+        self.short_circuited = 0
+        self.neutral = 0
+
+    @property
+    def state(self) -> str:
+        if self._state == self.OPEN and time.monotonic() - self.opened_at >= self.open_seconds:
+            self._state = self.HALF_OPEN
+            self.probes_in_flight = 0
+            print(f"[Breaker] {self.name} half-open, allowing probe calls")
+        return self._state
+
+    def _trim(self):
+        cutoff = time.monotonic() - self.window_seconds
+        while self.outcomes and self.outcomes[0][0] < cutoff:
+            self.outcomes.popleft()
+
+    def retry_after(self) -> int:
+        if self._state != self.OPEN:
+            return 1
+        return max(1, math.ceil(self.open_seconds - (time.monotonic() - self.opened_at)))
+
+    def allow(self):
+        """Admit a call or raise CircuitOpenError"""
+        state = self.state
+        if state == self.CLOSED:
+            return
+        if state == self.HALF_OPEN and self.probes_in_flight < self.half_open_calls:
+            self.probes_in_flight += 1
+            return
+        self.short_circuited += 1
+        raise CircuitOpenError(
+            f"{self.name} is temporarily unavailable after repeated failures",
+            retry_after=self.retry_after(),
+        )
+
+    def _open(self):
+        self._state = self.OPEN
+        self.opened_at = time.monotonic()
+        self.probes_in_flight = 0
+        self.times_opened += 1
+        print(f"[Breaker] {self.name} opened for {self.open_seconds}s")
+
+    def record_success(self):
+        if self._state == self.HALF_OPEN:
+            self._state = self.CLOSED
+            self.outcomes.clear()
+            print(f"[Breaker] {self.name} closed")
+        self.outcomes.append((time.monotonic(), False, False))
+        self._trim()
+
+    def record_failure(self, timed_out: bool = False):
+        if self._state == self.HALF_OPEN:
+            self._open()
+            return
+        self.outcomes.append((time.monotonic(), True, timed_out))
+        self._trim()
+        if self._state == self.CLOSED and len(self.outcomes) >= self.min_calls:
+            failures = sum(1 for _, failed, _ in self.outcomes if failed)
+            if failures / len(self.outcomes) >= self.failure_rate:
+                self._open()
+
+    def record_abandoned(self):
+        """Release an admitted call that never reached the provider"""
+        if self._state == self.HALF_OPEN and self.probes_in_flight > 0:
+            self.probes_in_flight -= 1
+
+    def record_neutral(self):
+        """Release an admitted call whose error is down to the request, not the provider"""
+        self.neutral += 1
+        self.record_abandoned()
+
+    def stats(self) -> Dict[str, Any]:
+        self._trim()
+        calls = len(self.outcomes)
+        failures = sum(1 for _, failed, _ in self.outcomes if failed)
+        timeouts = sum(1 for _, _, timed_out in self.outcomes if timed_out)
+        return {
+            "state": self.state,
+            "window_calls": calls,
+            "error_rate": round(failures / calls, 3) if calls else 0.0,
+            "timeout_rate": round(timeouts / calls, 3) if calls else 0.0,
+            "times_opened": self.times_opened,
+            "short_circuited": self.short_circuited,
+            "neutral": self.neutral,
+            "retry_after": self.retry_after() if self._state == self.OPEN else 0,
+        }
@@ -1,4 +1,6 @@
 import os
+import json
+import tempfile
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -7,24 +9,157 @@ class Config:
     # Replicate API Configuration
     REPLICATE_API_TOKEN = os.getenv("REPLICATE_API_TOKEN", "your-replicate-api-token-here")
     
-    # Model configurations
+    # Frontend assets are held in memory and re-read when they change on disk
+    STATIC_DIR = os.getenv("STATIC_DIR", "static")
+    STATIC_RELOAD_INTERVAL = float(os.getenv("STATIC_RELOAD_INTERVAL", "2"))
+    
+    # Spool directory for uploaded reference images (point it at a tmpfs in production)
+    SPOOL_DIR = os.getenv("SPOOL_DIR", os.path.join(tempfile.gettempdir(), "portrait_spool"))
+    SPOOL_MAX_BYTES = int(os.getenv("SPOOL_MAX_BYTES", str(512 * 1024 * 1024)))
+    SPOOL_MAX_AGE = float(os.getenv("SPOOL_MAX_AGE", "3600"))  # seconds before an orphan is evicted
+    SPOOL_JANITOR_INTERVAL = float(os.getenv("SPOOL_JANITOR_INTERVAL", "300"))
+    SPOOL_WAIT_TIMEOUT = float(os.getenv("SPOOL_WAIT_TIMEOUT", "10"))  # backpressure wait before a 503
+    
+    # Budget for image bytes held in memory (uploads, decoding, output downloads)
+    MEMORY_BUDGET_BYTES = int(os.getenv("MEMORY_BUDGET_BYTES", str(768 * 1024 * 1024)))
+    MEMORY_BUDGET_WAIT_TIMEOUT = float(os.getenv("MEMORY_BUDGET_WAIT_TIMEOUT", "10"))  # backpressure wait before a 503
+    
+    # Reusable references created via POST /references
+    REFERENCE_TTL = float(os.getenv("REFERENCE_TTL", "3600"))
+    REFERENCE_MAX_ENTRIES = int(os.getenv("REFERENCE_MAX_ENTRIES", "256"))
+    REFERENCE_MAX_SIDE = int(os.getenv("REFERENCE_MAX_SIDE", "1024"))
+    
+    # Local face pre-check of uploads (needs opencv-python-headless): enforce rejects with a 422, warn only reports
+    FACE_GATE_MODE = os.getenv("FACE_GATE_MODE", "enforce").lower()  # enforce, warn or off
+    FACE_GATE_MIN_FACE_RATIO = float(os.getenv("FACE_GATE_MIN_FACE_RATIO", "0.1"))  # face height / image height
+    FACE_GATE_MAX_SIDE = int(os.getenv("FACE_GATE_MAX_SIDE", "320"))
+    FACE_GATE_TIMEOUT = float(os.getenv("FACE_GATE_TIMEOUT", "2"))
+    FACE_GATE_WORKERS = int(os.getenv("FACE_GATE_WORKERS", "2"))
+    
+    # Perceptual-hash index of references, so near-duplicate uploads reuse one; PHASH_INDEX_DIR keeps it across restarts
+    PHASH_MAX_DISTANCE = int(os.getenv("PHASH_MAX_DISTANCE", "6"))  # differing bits out of 64
+    PHASH_INDEX_MAX_ENTRIES = int(os.getenv("PHASH_INDEX_MAX_ENTRIES", "10000"))  # 0 disables the index
+    PHASH_INDEX_DIR = os.getenv("PHASH_INDEX_DIR", "")
+    
+    # Fair-share scheduling of predictions across API clients
+    MAX_CONCURRENT_PREDICTIONS = int(os.getenv("MAX_CONCURRENT_PREDICTIONS", "8"))
+    CLIENT_WEIGHTS = json.loads(os.getenv("CLIENT_WEIGHTS", "{}"))  # e.g. {"key:ab12cd34ef56": 4}
+    CLIENT_DEFAULT_WEIGHT = float(os.getenv("CLIENT_DEFAULT_WEIGHT", "1"))
+    CLIENT_MAX_CONCURRENCY = int(os.getenv("CLIENT_MAX_CONCURRENCY", "4"))
+    CLIENT_RATE_LIMIT = float(os.getenv("CLIENT_RATE_LIMIT", "0"))  # predictions per second, 0 = unlimited
+    CLIENT_RATE_BURST = float(os.getenv("CLIENT_RATE_BURST", "10"))
+    CLIENT_MAX_QUEUE = int(os.getenv("CLIENT_MAX_QUEUE", "50"))
+    SCHEDULER_QUEUE_TIMEOUT = float(os.getenv("SCHEDULER_QUEUE_TIMEOUT", "120"))
+    
+    # Per-model circuit breakers
+    BREAKER_WINDOW_SECONDS = float(os.getenv("BREAKER_WINDOW_SECONDS", "120"))
+    BREAKER_MIN_CALLS = int(os.getenv("BREAKER_MIN_CALLS", "3"))
+    BREAKER_FAILURE_RATE = float(os.getenv("BREAKER_FAILURE_RATE", "0.5"))
+    BREAKER_OPEN_SECONDS = float(os.getenv("BREAKER_OPEN_SECONDS", "60"))
+    BREAKER_HALF_OPEN_CALLS = int(os.getenv("BREAKER_HALF_OPEN_CALLS", "1"))
+    
+    # Retries of transient provider errors (429s, 5xx, connection resets)
+    RETRY_MAX_ATTEMPTS = int(os.getenv("RETRY_MAX_ATTEMPTS", "3"))
+    RETRY_BASE_DELAY = float(os.getenv("RETRY_BASE_DELAY", "0.5"))
+    RETRY_MAX_DELAY = float(os.getenv("RETRY_MAX_DELAY", "10"))
+    RETRY_TIME_BUDGET = float(os.getenv("RETRY_TIME_BUDGET", "60"))  # seconds per call, including retries
+    RETRY_BUDGET_RATIO = float(os.getenv("RETRY_BUDGET_RATIO", "0.2"))  # retries allowed per recent request
+    RETRY_BUDGET_MIN_RETRIES = int(os.getenv("RETRY_BUDGET_MIN_RETRIES", "5"))
+    
+    # Deadlines; clients may ask for less with X-Request-Timeout or a timeout_seconds form field
+    PREDICTION_TIMEOUT = float(os.getenv("PREDICTION_TIMEOUT", "300"))  # seconds per model call
+    MAX_REQUEST_TIMEOUT = float(os.getenv("MAX_REQUEST_TIMEOUT", "600"))
+    PREDICTION_POLL_INTERVAL = float(os.getenv("PREDICTION_POLL_INTERVAL", "0.5"))
+    
+    # Load shedding: new generations get a 503 and /readyz fails at these thresholds (0 disables one)
+    SHED_QUEUE_DEPTH = int(os.getenv("SHED_QUEUE_DEPTH", "64"))  # queued predictions across all clients
+    SHED_LOOP_LAG_MS = float(os.getenv("SHED_LOOP_LAG_MS", "500"))
+    SHED_MEMORY_RATIO = float(os.getenv("SHED_MEMORY_RATIO", "0.95"))  # share of MEMORY_BUDGET_BYTES in use
+    SHED_RETRY_AFTER = int(os.getenv("SHED_RETRY_AFTER", "10"))
+    
+    # Event-loop stalls longer than this are logged with the blocking stack (0 disables the watchdog)
+    LOOP_STALL_THRESHOLD_MS = float(os.getenv("LOOP_STALL_THRESHOLD_MS", "100"))
+    LOOP_STALL_HISTORY = int(os.getenv("LOOP_STALL_HISTORY", "20"))
+    
+    # Graceful shutdown: in-flight generations get this long to finish before their predictions are cancelled
+    DRAIN_GRACE_PERIOD = float(os.getenv("DRAIN_GRACE_PERIOD", "30"))
+    DRAIN_RETRY_AFTER = int(os.getenv("DRAIN_RETRY_AFTER", "5"))
+    
+    # Admin endpoints and on-demand profiling (X-Admin-Token); both are off without a token
+    ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "")
+    PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))  # share of generation requests profiled
+    PROFILE_MAX_KEPT = int(os.getenv("PROFILE_MAX_KEPT", "20"))
+    
+    # Idempotency-Key replays for generation POSTs; set IDEMPOTENCY_PATH to keep them across restarts
+    IDEMPOTENCY_TTL = float(os.getenv("IDEMPOTENCY_TTL", str(24 * 3600)))
+    IDEMPOTENCY_MAX_ENTRIES = int(os.getenv("IDEMPOTENCY_MAX_ENTRIES", "10000"))
+    IDEMPOTENCY_PATH = os.getenv("IDEMPOTENCY_PATH", "")
+    
+    # Append-only generation ledger
+    LEDGER_PATH = os.getenv("LEDGER_PATH", os.path.join("data", "generations.jsonl"))
+    LEDGER_BATCH_SIZE = int(os.getenv("LEDGER_BATCH_SIZE", "256"))
+    LEDGER_FLUSH_INTERVAL = float(os.getenv("LEDGER_FLUSH_INTERVAL", "0.05"))
+    LEDGER_MAX_PENDING = int(os.getenv("LEDGER_MAX_PENDING", "100000"))
+    
+    # Resized, re-encoded copies of generation outputs (avif needs pillow-avif-plugin)
+    RENDITION_SIZES = [int(size) for size in os.getenv("RENDITION_SIZES", "128,256,512,1024").split(",")]
+    RENDITION_FORMATS = os.getenv("RENDITION_FORMATS", "avif,webp,jpeg").split(",")
+    RENDITION_QUALITY = int(os.getenv("RENDITION_QUALITY", "75"))
+    RENDITION_CACHE_DIR = os.getenv("RENDITION_CACHE_DIR", os.path.join("data", "renditions"))
+    RENDITION_CACHE_MAX_GENERATIONS = int(os.getenv("RENDITION_CACHE_MAX_GENERATIONS", "5000"))
+    RENDITION_MEMORY_CACHE_BYTES = int(os.getenv("RENDITION_MEMORY_CACHE_BYTES", str(64 * 1024 * 1024)))
+    RENDITION_MAX_SOURCE_BYTES = int(os.getenv("RENDITION_MAX_SOURCE_BYTES", str(30 * 1024 * 1024)))
+    RENDITION_WORKERS = int(os.getenv("RENDITION_WORKERS", "2"))
+    
+    # Opt-in capture of request shapes for replay (see replay.py)
+    CAPTURE_TRAFFIC = os.getenv("CAPTURE_TRAFFIC", "false").lower() in ("1", "true", "yes")
+    CAPTURE_PATH = os.getenv("CAPTURE_PATH", os.path.join("data", "traffic_capture.jsonl"))
+    
+    # Offline fake backend for load tests and replays; no real predictions are made
+    FAKE_BACKEND = os.getenv("FAKE_BACKEND", "false").lower() in ("1", "true", "yes")
+    FAKE_BACKEND_LATENCY = float(os.getenv("FAKE_BACKEND_LATENCY", "8"))  # seconds per prediction
+    FAKE_BACKEND_FAILURE_RATE = float(os.getenv("FAKE_BACKEND_FAILURE_RATE", "0"))
+    
+    # Inference backend: replicate, fake (offline placeholder outputs) or local (degraded stylization)
+    INFERENCE_BACKEND = os.getenv("INFERENCE_BACKEND", "fake" if FAKE_BACKEND else "replicate").lower()
+    
+    # Degraded local fallback while the provider is saturated or failing
+    FALLBACK_ENABLED = os.getenv("FALLBACK_ENABLED", "true").lower() in ("1", "true", "yes")
+    FALLBACK_QUEUE_DEPTH = int(os.getenv("FALLBACK_QUEUE_DEPTH", "16"))  # queued predictions counted as saturation
+    FALLBACK_SATURATION_SECONDS = float(os.getenv("FALLBACK_SATURATION_SECONDS", "30"))  # how long it must last
+    FALLBACK_OUTPUT_DIR = os.getenv("FALLBACK_OUTPUT_DIR", os.path.join("data", "fallback_outputs"))
+    FALLBACK_MAX_OUTPUTS = int(os.getenv("FALLBACK_MAX_OUTPUTS", "1000"))
+    
+    # Variants per generation request
+    MAX_VARIANTS = int(os.getenv("MAX_VARIANTS", "8"))
+    VARIANT_MAX_CONCURRENCY = int(os.getenv("VARIANT_MAX_CONCURRENCY", "2"))  # calls per request for models without num_outputs
+    
+    # Model configurations (seed_param: the model's seed input; max_outputs: largest num_outputs it accepts)
     MODELS = {
 
         "ipadapter": {
             "model_id": "lucataco/ip_adapter-sdxl-face:226c6bf67a75a129b0f978e518fed33e1fb13956e15761c1ac53c9d2f898c9af",
-            "description": "Style-aware portrait generation with IP-Adapter SDXL Face"
+            "description": "Style-aware portrait generation with IP-Adapter SDXL Face",
+            "seed_param": "seed",
+            "max_outputs": 4  # accepts num_outputs, so variants share one prediction
         },
         "instantid": {
             "model_id": "tgohblio/instant-id-albedobase-xl:2a2afbff09996b53247b0714577d4ff82d2c9da8e8b00c5499b5b34510bb8b5e",
-            "description": "Identity-preserving portrait generation with AlbedoBase XL"
+            "description": "Identity-preserving portrait generation with AlbedoBase XL",
+            "seed_param": "seed",
+            "max_outputs": 1
         },
         "instantid2": {
             "model_id": "tgohblio/instant-id-multicontrolnet:35324a7df2397e6e57dfd8f4f9d2910425f5123109c8c3ed035e769aeff9ff3c",
-            "description": "Advanced identity preservation with MultiControlNet"
+            "description": "Advanced identity preservation with MultiControlNet",
+            "seed_param": "seed",
+            "max_outputs": 1
         },
         "ipadapter2": {
             "model_id": "zsxkib/instant-id-ipadapter-plus-face:32402fb5c493d883aa6cf098ce3e4cc80f1fe6871f6ae7f632a8dbde01a3d161",
-            "description": "Enhanced IP-Adapter with improved face preservation"
+            "description": "Enhanced IP-Adapter with improved face preservation",
+            "seed_param": None,
+            "max_outputs": 1
         }
     }
     
@@ -0,0 +1,72 @@
+import time
+from collections import Counter
+from typing import Any, Dict, Optional
+
+import request_context
+from errors import ServiceUnavailableError
+
+# Stages at which work was dropped because its deadline had passed
+_expired: Counter = Counter()
+
+
+class DeadlineExceededError(ServiceUnavailableError):
+    """Raised when the client's deadline passes before the work is done"""
+
+    status_code = 504
+
+    def __init__(self, message: str, retry_after: int = 1):
+        super().__init__(message, retry_after=retry_after)
+
+
+def parse_timeout(value: Optional[str]) -> Optional[float]:
+    """Parse a client timeout in seconds. Raises ValueError if it is not a positive number."""
+    if value is None or value == "":
+        return None
+    seconds = float(value)
+    if not seconds > 0:
+        raise ValueError("timeout must be a positive number of seconds")
+    return seconds
+
+
+def set_timeout(seconds: Optional[float], max_seconds: float):
+    """Give the current request a deadline ``seconds`` from now, capped at ``max_seconds``.
+
+    A deadline already set for the request is only ever tightened.
+    """
+    if seconds is None:
+        return
+    deadline = time.monotonic() + min(seconds, max_seconds)
+    current = request_context.deadline.get()
+    if current is None or deadline < current:
+        request_context.deadline.set(deadline)
+
+
+def remaining() -> Optional[float]:
+    """Seconds left until the current request's deadline, or None without one"""
+    deadline = request_context.deadline.get()
+    if deadline is None:
+        return None
+    return deadline - time.monotonic()
+
+
+def bound(timeout: float) -> float:
+    """``timeout`` shortened to what is left of the current request's deadline"""
+    left = remaining()
+    return timeout if left is None else min(timeout, left)
+
+
+def expired(stage: str) -> DeadlineExceededError:
+    """Count work dropped at ``stage`` and return the error to raise for it"""
+    _expired[stage] += 1
+    return DeadlineExceededError(f"Request deadline passed before {stage}")
+
+
+def check(stage: str):
+    """Drop work whose deadline has already passed before it starts"""
+    left = remaining()
+    if left is not None and left <= 0:
+        raise expired(stage)
+
+
+def stats() -> Dict[str, Any]:
+    return {"expired_by_stage": dict(_expired)}
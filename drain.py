@@ -0,0 +1,119 @@
+import asyncio
+import contextlib
+import time
+from typing import Any, Dict, Iterator, Optional
+
+import uvicorn
+
+from errors import ServiceUnavailableError
+
+
+class ShuttingDownError(ServiceUnavailableError):
+    """Raised for new predictions once the instance has stopped taking work"""
+
+
+class DrainController:
+    """Lets in-flight generations finish before the process exits.
+
+    Once draining, new generation requests are refused with a 503 and
+    readiness fails, so the load balancer sends traffic elsewhere. ``drain``
+    waits up to ``grace_period`` for the generations already running,
+    logging progress, then stops the service from starting predictions and
+    cancels the remote ones still running so they are not billed for
+    results nobody will receive.
+    """
+
+    def __init__(self, service: Any, grace_period: float, cancel_wait: float = 5.0, retry_after: int = 5):
+        self.service = service
+        self.grace_period = grace_period
+        self.cancel_wait = cancel_wait
+        self.retry_after = retry_after
+        self.in_flight = 0
+        self.draining = False
+        self.started: Optional[float] = None
+        self.refused = 0
+        self.cancelled = 0
+        self._hurry = False
+        self._task: Optional[asyncio.Task] = None
+
+    @contextlib.contextmanager
+    def track(self) -> Iterator[None]:
+        """Count a generation request as in flight for the duration of the block"""
+        self.in_flight += 1
+        try:
+            yield
+        finally:
+            self.in_flight -= 1
+
+    def begin(self):
+        """Stop taking new generations; the ones in flight carry on"""
+        if not self.draining:
+            self.draining = True
+            self.started = time.monotonic()
+            print(f"[Drain] Draining {self.in_flight} in-flight generations, grace period {self.grace_period:.0f}s")
+
+    def hurry(self):
+        """Stop waiting out the grace period and cancel what is still running"""
+        self._hurry = True
+
+    async def drain(self):
+        """Drain once; later callers wait for the same drain to finish"""
+        self.begin()
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._drain())
+        await asyncio.shield(self._task)
+
+    async def _wait(self, until: float, stage: str):
+        last_logged = time.monotonic()
+        while self.in_flight and not self._hurry and time.monotonic() < until:
+            await asyncio.sleep(0.1)
+            if time.monotonic() - last_logged >= 1.0:
+                last_logged = time.monotonic()
+                print(f"[Drain] {self.in_flight} generations still {stage}, {max(0.0, until - last_logged):.0f}s left")
+
+    async def _drain(self):
+        await self._wait(self.started + self.grace_period, "running")
+        if not self.in_flight:
+            print(f"[Drain] All generations finished after {time.monotonic() - self.started:.1f}s")
+
+        self.cancelled = self.service.stop_predictions()
+        if self.cancelled:
+            print(f"[Drain] Cancelled {self.cancelled} remote predictions still running")
+            # Give the cancelled calls a moment to answer their clients
+            self._hurry = False
+            await self._wait(time.monotonic() + self.cancel_wait, "cancelling")
+        if self.in_flight:
+            print(f"[Drain] Giving up on {self.in_flight} generations")
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "draining": self.draining,
+            "in_flight_generations": self.in_flight,
+            "draining_for_seconds": round(time.monotonic() - self.started, 1) if self.started else None,
+            "refused": self.refused,
+            "cancelled_predictions": self.cancelled,
+        }
+
+
+class DrainingServer(uvicorn.Server):
+    """uvicorn server that drains generations before it closes its sockets.
+
+    On the first SIGTERM or SIGINT the server keeps serving while the drain
+    runs, refusing only new generations, then shuts down as usual. Another
+    signal cuts the grace period short.
+    """
+
+    def __init__(self, config: uvicorn.Config, drain: DrainController):
+        super().__init__(config)
+        self.drain = drain
+
+    def handle_exit(self, sig, frame):
+        if self.should_exit:
+            self.drain.hurry()
+        else:
+            self.drain.begin()
+        super().handle_exit(sig, frame)
+
+    async def shutdown(self, sockets=None):
+        await self.drain.drain()
+        await super().shutdown(sockets)
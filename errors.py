@@ -0,0 +1,12 @@
+class ServiceUnavailableError(Exception):
+    """Raised when the service is temporarily unable to take on more work.
+
+    The API turns this into a ``status_code`` response (503 unless a subclass
+    says otherwise) with a Retry-After header.
+    """
+
+    status_code = 503
+
+    def __init__(self, message: str, retry_after: int = 5):
+        super().__init__(message)
+        self.retry_after = retry_after
@@ -0,0 +1,206 @@
+import asyncio
+import collections
+import io
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Dict, List, Optional, Tuple
+
+from PIL import Image, ImageOps
+
+import deadlines
+from errors import ServiceUnavailableError
+
+try:
+    import cv2
+    import numpy
+    # Haar cascades left the main package in OpenCV 5
+    FACE_DETECTION_AVAILABLE = hasattr(cv2, "CascadeClassifier")
+except ImportError:
+    FACE_DETECTION_AVAILABLE = False
+
+# The worker's grayscale copy is a quarter of an RGBA decode; callers reserve it with the upload,
+# plus a full decode for formats other than JPEG, which ``draft`` cannot shrink
+FACE_CHECK_DECODED_COPIES = 0.25
+
+# A face counts towards "several faces" when it is at least this share of the largest one's height
+PROMINENT_FACE_RATIO = 0.5
+
+PROBLEMS = {
+    "no_face": "No face was found in the reference image",
+    "multiple_faces": "The reference image shows several faces; upload a photo of one person",
+    "face_too_small": "The face in the reference image is too small; upload a closer photo",
+}
+
+# (x, y, width, height) as fractions of the upright image
+FaceBox = Tuple[float, float, float, float]
+
+_cascade = None
+
+
+def _load_cascade():
+    """Worker initializer: load the Haar cascade once per process"""
+    global _cascade
+    _cascade = cv2.CascadeClassifier(os.path.join(cv2.data.haarcascades, "haarcascade_frontalface_default.xml"))
+
+
+def detect_faces(content: bytes, max_side: int) -> List[FaceBox]:
+    """Find frontal faces on a small grayscale copy of an image.
+
+    Runs in a worker process. JPEG sources are decoded straight to a
+    reduced grayscale scale with ``draft``, so even large uploads take a
+    few milliseconds.
+    """
+    image = Image.open(io.BytesIO(content))
+    image.draft("L", (max_side, max_side))
+    image = ImageOps.exif_transpose(image).convert("L")
+    image.thumbnail((max_side, max_side), Image.BILINEAR)
+    pixels = cv2.equalizeHist(numpy.asarray(image))
+    found = _cascade.detectMultiScale(pixels, scaleFactor=1.1, minNeighbors=5, minSize=(20, 20))
+    width, height = image.size
+    return [
+        (round(x / width, 4), round(y / height, 4), round(w / width, 4), round(h / height, 4))
+        for x, y, w, h in found
+    ]
+
+
+class FaceCheck:
+    """Outcome of the face pre-check: the faces found, the main one and what is wrong, if anything"""
+
+    def __init__(self, faces: List[FaceBox], min_face_ratio: float, elapsed_ms: float):
+        self.faces = sorted(faces, key=lambda box: box[2] * box[3], reverse=True)
+        self.face_box: Optional[FaceBox] = self.faces[0] if self.faces else None
+        self.elapsed_ms = elapsed_ms
+        self.problem: Optional[str] = None
+        if not self.faces:
+            self.problem = "no_face"
+        elif sum(1 for box in self.faces if box[3] >= self.face_box[3] * PROMINENT_FACE_RATIO) > 1:
+            self.problem = "multiple_faces"
+        elif self.face_box[3] < min_face_ratio:
+            self.problem = "face_too_small"
+
+    @property
+    def message(self) -> Optional[str]:
+        return PROBLEMS.get(self.problem)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "faces": len(self.faces),
+            "face_box": list(self.face_box) if self.face_box else None,
+            "problem": self.problem,
+        }
+
+
+class FaceCheckError(Exception):
+    """Raised when the reference image has no usable face and the gate enforces it"""
+
+    def __init__(self, check: FaceCheck):
+        super().__init__(check.message)
+        self.check = check
+
+
+class FaceGate:
+    """Cheap local face-presence check run before any prediction is paid for.
+
+    Uploads are checked with OpenCV's Haar cascade on a downscaled
+    grayscale copy, in a small process pool. In ``enforce`` mode an image
+    with no face, several faces or a tiny face is rejected; in ``warn``
+    mode it goes through with a warning. The gate fails open: without
+    OpenCV installed, or when a check errors or takes longer than
+    ``timeout``, the image is let through unchecked.
+    """
+
+    def __init__(self, mode: str, workers: int, max_side: int, min_face_ratio: float, timeout: float):
+        self.mode = mode
+        self.workers = workers
+        self.max_side = max_side
+        self.min_face_ratio = min_face_ratio
+        self.timeout = timeout
+        self.enabled = mode in ("enforce", "warn") and FACE_DETECTION_AVAILABLE
+        if mode in ("enforce", "warn") and not FACE_DETECTION_AVAILABLE:
+            print("[FaceGate] OpenCV 4 is not installed; reference images will not be checked for faces")
+        self._pool: Optional[ProcessPoolExecutor] = None
+        self.outcomes: Dict[str, int] = collections.Counter()
+        self.rejected = 0
+        self.skipped = 0
+        self.total_ms = 0.0
+
+    @property
+    def pool(self) -> ProcessPoolExecutor:
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_load_cascade
+            )
+        return self._pool
+
+    async def start(self):
+        """Spawn the workers and load the cascade now rather than on the first upload"""
+        if not self.enabled:
+            return
+        loop = asyncio.get_running_loop()
+        try:
+            await loop.run_in_executor(self.pool, os.getpid)
+        except Exception as e:
+            print(f"[FaceGate] Workers failed to start ({e}); reference images will not be checked for faces")
+            self.enabled = False
+            self.shutdown()
+
+    def shutdown(self):
+        if self._pool:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+    async def check(self, content: bytes) -> Optional[FaceCheck]:
+        """Check an uploaded image; raises FaceCheckError if it must be rejected, None if unchecked.
+
+        The caller's memory reservation must cover ``FACE_CHECK_DECODED_COPIES`` of the image.
+        """
+        if not self.enabled:
+            return None
+        deadlines.check("face check")
+        loop = asyncio.get_running_loop()
+        started = time.monotonic()
+        try:
+            faces = await asyncio.wait_for(
+                loop.run_in_executor(self.pool, detect_faces, content, self.max_side),
+                timeout=deadlines.bound(self.timeout)
+            )
+        except ServiceUnavailableError:
+            raise
+        except asyncio.TimeoutError:
+            self.skipped += 1
+            print(f"[FaceGate] Check timed out after {self.timeout:.1f}s; letting the image through")
+            return None
+        except BrokenProcessPool as e:
+            # A worker died; start a fresh pool for the next check
+            self.skipped += 1
+            self.shutdown()
+            print(f"[FaceGate] Worker pool broke ({e}); letting the image through")
+            return None
+        except Exception as e:
+            self.skipped += 1
+            print(f"[FaceGate] Check failed ({e}); letting the image through")
+            return None
+
+        check = FaceCheck(faces, self.min_face_ratio, (time.monotonic() - started) * 1000)
+        self.total_ms += check.elapsed_ms
+        self.outcomes[check.problem or "ok"] += 1
+        if check.problem and self.mode == "enforce":
+            self.rejected += 1
+            raise FaceCheckError(check)
+        return check
+
+    def stats(self) -> Dict[str, Any]:
+        checked = sum(self.outcomes.values())
+        return {
+            "mode": self.mode if self.enabled else "off",
+            "checked": checked,
+            "outcomes": dict(self.outcomes),
+            "rejected": self.rejected,
+            "skipped": self.skipped,
+            "mean_ms": round(self.total_ms / checked, 1) if checked else 0.0,
+        }
@@ -0,0 +1,187 @@
+import asyncio
+import bisect
+import collections
+import os
+import sys
+import threading
+import time
+import traceback
+from typing import Any, Deque, Dict, List, Optional
+
+# Upper bounds of the lag histogram buckets, in milliseconds
+LAG_BUCKETS_MS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+# Frames under this directory, outside installed packages, count as ours when naming a blocking site
+PROJECT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def _blocking_site(stack: traceback.StackSummary) -> str:
+    """The innermost frame of our own code in a stack, else the innermost frame"""
+    for frame in reversed(stack):
+        if frame.filename.startswith(PROJECT_DIR) and "site-packages" not in frame.filename:
+            return f"{os.path.relpath(frame.filename, PROJECT_DIR)}:{frame.lineno} in {frame.name}"
+    frame = stack[-1]
+    return f"{frame.filename}:{frame.lineno} in {frame.name}"
+
+
+class LoopLagProbe:
+    """Measures event-loop lag by how late a periodic sleep wakes up.
+
+    A loop busy with blocking work wakes the probe late; the delay beyond
+    ``interval`` is the time any request would have waited to be served.
+    Every sample also goes into a histogram kept since startup.
+
+    With a ``stall_threshold``, a watchdog thread notices when the probe is
+    overdue by that much and captures the loop thread's stack while it is
+    still blocked, which points at the blocking call itself. Stalls are
+    logged, counted per blocking site and the most recent ones kept.
+    """
+
+    def __init__(self, interval: float = 0.25, window: int = 20, stall_threshold: float = 0.0,
+                 stall_history: int = 20):
+        self.interval = interval
+        self.samples: Deque[float] = collections.deque(maxlen=window)
+        self.buckets = [0] * (len(LAG_BUCKETS_MS) + 1)
+        self.total_samples = 0
+        self.total_lag = 0.0
+        self.max_lag = 0.0
+        self._task: Optional[asyncio.Task] = None
+
+        self.stall_threshold = stall_threshold
+        self.stalls: Deque[Dict[str, Any]] = collections.deque(maxlen=stall_history)
+        self.stalls_by_site: Dict[str, int] = collections.Counter()
+        self.stall_count = 0
+        self._due: Optional[float] = None
+        self._stall: Optional[Dict[str, Any]] = None
+        self._loop_thread_id: Optional[int] = None
+        self._watchdog: Optional[threading.Thread] = None
+        self._stopping = threading.Event()
+
+    async def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+        if self.stall_threshold and self._watchdog is None:
+            self._loop_thread_id = threading.get_ident()
+            self._stopping.clear()
+            self._watchdog = threading.Thread(target=self._watch, name="loop-watchdog", daemon=True)
+            self._watchdog.start()
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+        if self._watchdog:
+            self._stopping.set()
+            self._watchdog = None
+
+    async def _run(self):
+        while True:
+            started = time.monotonic()
+            self._due = started + self.interval
+            await asyncio.sleep(self.interval)
+            self._record(max(0.0, time.monotonic() - started - self.interval))
+
+    def _record(self, lag: float):
+        self.samples.append(lag)
+        self.buckets[bisect.bisect_left(LAG_BUCKETS_MS, lag * 1000)] += 1
+        self.total_samples += 1
+        self.total_lag += lag
+        self.max_lag = max(self.max_lag, lag)
+        stall = self._stall
+        if stall is not None:
+            # The stall the watchdog caught is over; now its length is known
+            stall["blocked_ms"] = round(lag * 1000, 1)
+            self._stall = None
+
+    def _watch(self):
+        """Watchdog thread: capture the loop thread's stack once per stall"""
+        while not self._stopping.wait(self.stall_threshold / 4):
+            due = self._due
+            if due is None or self._stall is not None:
+                continue
+            overdue = time.monotonic() - due
+            if overdue < self.stall_threshold:
+                continue
+            frame = sys._current_frames().get(self._loop_thread_id)
+            if frame is None:
+                continue
+            stack = traceback.extract_stack(frame)[-15:]
+            del frame
+            site = _blocking_site(stack)
+            stall = {
+                "at": time.time(),
+                "site": site,
+                "blocked_ms": None,
+                "stack": [f"{f.filename}:{f.lineno} in {f.name}" for f in stack],
+            }
+            self._stall = stall
+            self.stalls.append(stall)
+            self.stalls_by_site[site] += 1
+            self.stall_count += 1
+            print(f"[LoopLag] Event loop blocked for over {overdue * 1000:.0f}ms at {site}\n"
+                  + "".join(traceback.format_list(stack)))
+
+    @property
+    def lag(self) -> float:
+        """Worst lag over the recent window, in seconds"""
+        return max(self.samples, default=0.0)
+
+    def stats(self) -> Dict[str, Any]:
+        histogram = {f"le_{bound}ms": count for bound, count in zip(LAG_BUCKETS_MS, self.buckets)}
+        histogram["over"] = self.buckets[-1]
+        return {
+            "current_lag_ms": round(self.lag * 1000, 1),
+            "max_lag_ms": round(self.max_lag * 1000, 1),
+            "mean_lag_ms": round(self.total_lag / self.total_samples * 1000, 2) if self.total_samples else 0.0,
+            "samples": self.total_samples,
+            "histogram": histogram,
+            "stall_threshold_ms": round(self.stall_threshold * 1000),
+            "stalls": self.stall_count,
+            "stalls_by_site": dict(self.stalls_by_site.most_common(20)),
+            "recent_stalls": list(self.stalls),
+        }
+
+
+class HealthMonitor:
+    """Reports load and decides when the instance is too saturated to take more work.
+
+    The instance counts as saturated while the prediction backlog, the
+    event-loop lag or the share of the memory budget in use is at or above
+    its threshold; a threshold of 0 disables that check. A saturated
+    instance fails readiness and sheds new generation requests.
+    """
+
+    def __init__(self, service: Any, probe: LoopLagProbe, max_queue_depth: int,
+                 max_loop_lag: float, max_memory_ratio: float, retry_after: int):
+        self.service = service
+        self.probe = probe
+        self.max_queue_depth = max_queue_depth
+        self.max_loop_lag = max_loop_lag
+        self.max_memory_ratio = max_memory_ratio
+        self.retry_after = retry_after
+        self.shed = 0
+
+    def saturation_reasons(self) -> List[str]:
+        reasons = []
+        queue_depth = self.service.scheduler.queue_depth()
+        if self.max_queue_depth and queue_depth >= self.max_queue_depth:
+            reasons.append(f"{queue_depth} predictions queued")
+        if self.max_loop_lag and self.probe.lag >= self.max_loop_lag:
+            reasons.append(f"event loop lagging {self.probe.lag * 1000:.0f}ms")
+        memory = self.service.memory
+        if self.max_memory_ratio and memory.in_use >= memory.limit_bytes * self.max_memory_ratio:
+            reasons.append(f"{memory.in_use / memory.limit_bytes:.0%} of the memory budget in use")
+        return reasons
+
+    def snapshot(self) -> Dict[str, Any]:
+        scheduler = self.service.scheduler
+        reasons = self.saturation_reasons()
+        return {
+            "status": "saturated" if reasons else "ok",
+            "reasons": reasons,
+            "executor_occupancy": round(scheduler.running / scheduler.capacity, 3),
+            "in_flight_predictions": scheduler.running,
+            "queue_depth": scheduler.queue_depth(),
+            "loop_lag_ms": round(self.probe.lag * 1000, 1),
+            "memory_in_use_bytes": self.service.memory.in_use,
+            "shed_requests": self.shed,
+        }
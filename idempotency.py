@@ -0,0 +1,332 @@
+import asyncio
+import base64
+import collections
+import hashlib
+import json
+import os
+import re
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from starlette.requests import Request
+from starlette.responses import JSONResponse
+
+from ledger import JsonlBatchWriter
+
+MAX_KEY_LENGTH = 255
+# Larger responses are passed through without being stored
+MAX_STORED_BODY = 1 << 20
+# Responses a retry should not get back: the retry is expected to run the work again
+UNSTORED_STATUSES = {408, 409, 429}
+BOUNDARY_RE = re.compile(r'boundary="?([^";]+)"?')
+
+
+class BodyFingerprint:
+    """Hash of a request's path and body that survives a client re-encoding the same form.
+
+    Multipart boundaries are random per request, so they are left out of
+    the hash; the parts themselves are hashed byte for byte. Works on the
+    body as it streams through, holding back only a boundary's worth of
+    bytes between chunks.
+    """
+
+    def __init__(self, path: str, content_type: str):
+        self._hash = hashlib.sha256(path.encode("utf-8") + b"\0")
+        match = BOUNDARY_RE.search(content_type or "")
+        self._boundary = match.group(1).encode("latin-1") if match else b""
+        self._tail = b""
+        self.complete = False
+
+    def update(self, chunk: bytes, more_body: bool):
+        data = self._tail + chunk
+        if self._boundary:
+            data = data.replace(self._boundary, b"")
+        split = max(0, len(data) - len(self._boundary) + 1) if more_body and self._boundary else len(data)
+        self._tail = data[split:]
+        self._hash.update(data[:split])
+        self.complete = not more_body
+
+    def hexdigest(self) -> str:
+        return self._hash.hexdigest()
+
+
+class StoredResponse:
+    __slots__ = ("fingerprint", "status", "headers", "body")
+
+    def __init__(self, fingerprint: str, status: int, headers: List[Tuple[bytes, bytes]], body: bytes):
+        self.fingerprint = fingerprint
+        self.status = status
+        self.headers = headers
+        self.body = body
+
+
+class IdempotencyEntry:
+    """A key's first request: in progress until ``response`` is set or the entry is dropped"""
+
+    __slots__ = ("response", "expires_at", "done")
+
+    def __init__(self):
+        self.response: Optional[StoredResponse] = None
+        self.expires_at = float("inf")
+        self.done = asyncio.get_running_loop().create_future()
+
+
+class IdempotencyStore:
+    """Results of generation requests by client and ``Idempotency-Key``.
+
+    A bounded LRU in memory: once ``max_entries`` is reached, the oldest
+    finished entries are evicted, and finished entries expire ``ttl``
+    seconds after they were stored. Entries still in progress are never
+    evicted. With a ``path``, finished entries are also appended to a JSONL
+    file and reloaded at startup, so retries that land after a restart are
+    still answered; the file is compacted to the live entries on load.
+    """
+
+    def __init__(self, ttl: float, max_entries: int, path: Optional[str] = None):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.path = path
+        self.writer = JsonlBatchWriter(path, 256, 0.05, 10000) if path else None
+        self.entries: "collections.OrderedDict[Tuple[str, str], IdempotencyEntry]" = collections.OrderedDict()
+        self.stored = 0
+        self.replayed = 0
+        self.waited = 0
+        self.conflicts = 0
+        self.evicted = 0
+
+    def get(self, client_id: str, key: str) -> Optional[IdempotencyEntry]:
+        entry = self.entries.get((client_id, key))
+        if entry is not None and entry.expires_at <= time.monotonic():
+            del self.entries[(client_id, key)]
+            return None
+        return entry
+
+    def begin(self, client_id: str, key: str) -> IdempotencyEntry:
+        entry = self.entries[(client_id, key)] = IdempotencyEntry()
+        self._evict()
+        return entry
+
+    def complete(self, client_id: str, key: str, entry: IdempotencyEntry, response: StoredResponse):
+        entry.response = response
+        entry.expires_at = time.monotonic() + self.ttl
+        self.entries.move_to_end((client_id, key))
+        self.stored += 1
+        if not entry.done.done():
+            entry.done.set_result(None)
+        if self.writer:
+            self.writer.submit({
+                "client_id": client_id,
+                "key": key,
+                "fingerprint": response.fingerprint,
+                "status": response.status,
+                "headers": [[name.decode("latin-1"), value.decode("latin-1")] for name, value in response.headers],
+                "body": base64.b64encode(response.body).decode("ascii"),
+                "expires_at": time.time() + self.ttl,
+            })
+
+    def abandon(self, client_id: str, key: str, entry: IdempotencyEntry):
+        """Forget a request that did not produce a result worth replaying; a retry runs it again"""
+        if self.entries.get((client_id, key)) is entry:
+            del self.entries[(client_id, key)]
+        if not entry.done.done():
+            entry.done.set_result(None)
+
+    def _evict(self):
+        now = time.monotonic()
+        if len(self.entries) <= self.max_entries:
+            return
+        for item_key, entry in list(self.entries.items()):
+            if len(self.entries) <= self.max_entries:
+                break
+            if entry.response is not None or entry.expires_at <= now:
+                del self.entries[item_key]
+                self.evicted += 1
+
+    def _load(self) -> List[Dict[str, Any]]:
+        """Read the live records from the backing file and rewrite it with only those"""
+        if not os.path.exists(self.path):
+            return []
+        now = time.time()
+        records: Dict[Tuple[str, str], Dict[str, Any]] = {}
+        with open(self.path, "rb") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # A torn final line from a crash; skip it
+                    continue
+                if record.get("expires_at", 0) > now:
+                    records.pop((record["client_id"], record["key"]), None)
+                    records[(record["client_id"], record["key"])] = record
+        live = list(records.values())[-self.max_entries:]
+        with open(self.path + ".tmp", "w") as f:
+            for record in live:
+                f.write(json.dumps(record, separators=(",", ":")) + "\n")
+        os.replace(self.path + ".tmp", self.path)
+        return live
+
+    async def start(self):
+        if not self.writer:
+            return
+        loop = asyncio.get_running_loop()
+        records = await loop.run_in_executor(None, self._load)
+        now, wall_now = time.monotonic(), time.time()
+        for record in records:
+            entry = IdempotencyEntry()
+            entry.response = StoredResponse(
+                record["fingerprint"],
+                record["status"],
+                [(name.encode("latin-1"), value.encode("latin-1")) for name, value in record["headers"]],
+                base64.b64decode(record["body"])
+            )
+            entry.expires_at = now + record["expires_at"] - wall_now
+            entry.done.set_result(None)
+            self.entries[(record["client_id"], record["key"])] = entry
+        print(f"[Idempotency] Loaded {len(records)} stored responses from {self.path}")
+        await self.writer.start()
+
+    async def stop(self):
+        if self.writer:
+            await self.writer.stop()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "entries": len(self.entries),
+            "in_progress": sum(1 for entry in self.entries.values() if entry.response is None),
+            "stored": self.stored,
+            "replayed": self.replayed,
+            "waited": self.waited,
+            "conflicts": self.conflicts,
+            "evicted": self.evicted,
+            "persistence": self.writer.stats() if self.writer else None,
+        }
+
+
+class IdempotencyMiddleware:
+    """Answers retried generation POSTs carrying an ``Idempotency-Key`` with the first result.
+
+    The first request with a key runs as usual while its body is
+    fingerprinted and its response recorded. A retry with the same key
+    waits for that request if it is still running, then gets the same
+    response with ``Idempotent-Replayed: true``. A retry whose body differs
+    is rejected with a 422. Failed first attempts (5xx, 408, 409, 429) are
+    not kept, so the next retry runs the generation again.
+
+    A plain ASGI middleware rather than an ``@app.middleware`` function so
+    the body can be hashed as it streams through instead of being buffered.
+    It sits outside load shedding and draining, so a finished result is
+    replayed even while the instance turns new work away.
+    """
+
+    def __init__(self, app: Any, store: IdempotencyStore, identify: Callable[[Request], str],
+                 max_wait: float, path_prefix: str = "/generate-portrait"):
+        self.app = app
+        self.store = store
+        self.identify = identify
+        self.max_wait = max_wait
+        self.path_prefix = path_prefix
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] != "POST" or not scope["path"].startswith(self.path_prefix):
+            return await self.app(scope, receive, send)
+        request = Request(scope)
+        key = request.headers.get("idempotency-key")
+        if not key:
+            return await self.app(scope, receive, send)
+        if len(key) > MAX_KEY_LENGTH:
+            response = JSONResponse(status_code=400, content={"detail": f"Idempotency-Key must be at most {MAX_KEY_LENGTH} characters"})
+            return await response(scope, receive, send)
+
+        client_id = self.identify(request)
+        wait_until = time.monotonic() + self._wait_timeout(request)
+        while True:
+            entry = self.store.get(client_id, key)
+            if entry is None:
+                break
+            if entry.response is not None:
+                return await self._replay(entry.response, request, scope, receive, send)
+            # The first request is still running; its result, or its failure, decides what happens next
+            self.store.waited += 1
+            try:
+                await asyncio.wait_for(asyncio.shield(entry.done), timeout=max(0.0, wait_until - time.monotonic()))
+            except asyncio.TimeoutError:
+                response = JSONResponse(
+                    status_code=409,
+                    content={"detail": "A request with this Idempotency-Key is still in progress"},
+                    headers={"Retry-After": "5"}
+                )
+                return await response(scope, receive, send)
+
+        await self._run_first(client_id, key, request, scope, receive, send)
+
+    def _wait_timeout(self, request: Request) -> float:
+        try:
+            timeout = float(request.headers.get("x-request-timeout") or self.max_wait)
+        except ValueError:
+            timeout = self.max_wait
+        return min(max(timeout, 0.0), self.max_wait)
+
+    async def _replay(self, stored: StoredResponse, request: Request, scope, receive, send):
+        fingerprint = BodyFingerprint(scope["path"], request.headers.get("content-type", ""))
+        while not fingerprint.complete:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                return
+            fingerprint.update(message.get("body", b""), message.get("more_body", False))
+        if fingerprint.hexdigest() != stored.fingerprint:
+            self.store.conflicts += 1
+            response = JSONResponse(
+                status_code=422,
+                content={"detail": "Idempotency-Key was already used for a different request"}
+            )
+            return await response(scope, receive, send)
+
+        self.store.replayed += 1
+        await send({
+            "type": "http.response.start",
+            "status": stored.status,
+            "headers": stored.headers + [
+                (b"content-length", str(len(stored.body)).encode("ascii")),
+                (b"idempotent-replayed", b"true"),
+            ],
+        })
+        await send({"type": "http.response.body", "body": stored.body})
+
+    async def _run_first(self, client_id: str, key: str, request: Request, scope, receive, send):
+        entry = self.store.begin(client_id, key)
+        fingerprint = BodyFingerprint(scope["path"], request.headers.get("content-type", ""))
+        status = 500
+        headers: List[Tuple[bytes, bytes]] = []
+        chunks: List[bytes] = []
+        size = 0
+
+        async def fingerprinting_receive():
+            message = await receive()
+            if message["type"] == "http.request":
+                fingerprint.update(message.get("body", b""), message.get("more_body", False))
+            return message
+
+        async def recording_send(message):
+            nonlocal status, headers, size
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                headers = [(name, value) for name, value in message.get("headers", []) if name.lower() != b"content-length"]
+            elif message["type"] == "http.response.body":
+                size += len(message.get("body", b""))
+                if size <= MAX_STORED_BODY:
+                    chunks.append(message.get("body", b""))
+            try:
+                await send(message)
+            except OSError:
+                # The client is gone, which is why it will retry; keep the result for it
+                pass
+
+        try:
+            await self.app(scope, fingerprinting_receive, recording_send)
+        finally:
+            if (fingerprint.complete and status < 500 and status not in UNSTORED_STATUSES
+                    and size <= MAX_STORED_BODY):
+                response = StoredResponse(fingerprint.hexdigest(), status, headers, b"".join(chunks))
+                self.store.complete(client_id, key, entry, response)
+            else:
+                self.store.abandon(client_id, key, entry)
@@ -0,0 +1,272 @@
+import base64
+import functools
+import io
+import os
+import random
+import threading
+import time
+import uuid
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import replicate
+from PIL import Image, ImageEnhance, ImageFilter, ImageOps
+from replicate.exceptions import ModelError
+
+import request_context
+from deadlines import DeadlineExceededError
+from retry_policy import classify_error
+
+# Local fallback outputs are served by the API under this path
+LOCAL_OUTPUT_URL_PREFIX = "/outputs/"
+
+TERMINAL_STATUSES = ("succeeded", "failed", "canceled")
+# Consecutive transient polling errors tolerated before a prediction is given up (and cancelled)
+MAX_RELOAD_FAILURES = 5
+
+
+class InferenceBackend:
+    """Runs a model prediction. Same call shape as ``replicate.run``.
+
+    ``run`` blocks and returns the model output, usually a list of image
+    URLs. It is called from executor threads, with ``request_context.deadline``
+    set to when the caller stops waiting for the result.
+    """
+
+    name = "backend"
+    # Degraded backends return a stand-in for the model's output
+    degraded = False
+
+    def run(self, model_id: str, input: Dict[str, Any]) -> Any:
+        raise NotImplementedError
+
+    def cancel_all(self) -> int:
+        """Cancel every prediction still running; returns how many were cancelled"""
+        return 0
+
+
+class ReplicateBackend(InferenceBackend):
+    """Predictions on Replicate.
+
+    Creates the prediction and polls it rather than using ``replicate.run``,
+    so a prediction still running at the deadline can be cancelled instead
+    of burning provider time nobody will see. Transient errors while polling
+    are retried here rather than by the caller, which would create a second
+    paid prediction; a prediction abandoned before it finishes, for any
+    reason, is cancelled.
+    """
+
+    name = "replicate"
+
+    def __init__(self, poll_interval: float):
+        self.poll_interval = poll_interval
+        self.cancelled = 0
+        self.active: Dict[str, Any] = {}
+        self._lock = threading.Lock()
+
+    def run(self, model_id: str, input: Dict[str, Any]) -> Any:
+        deadline = request_context.deadline.get()
+        prediction = replicate.predictions.create(version=model_id.split(":", 1)[-1], input=input)
+        with self._lock:
+            self.active[prediction.id] = prediction
+        failures = 0
+        try:
+            while prediction.status not in TERMINAL_STATUSES:
+                if deadline is not None and time.monotonic() >= deadline:
+                    raise DeadlineExceededError(f"Prediction {prediction.id} cancelled at the request deadline")
+                wait = self.poll_interval * (failures + 1)
+                if deadline is not None:
+                    wait = min(wait, max(0.0, deadline - time.monotonic()))
+                time.sleep(wait)
+                try:
+                    prediction.reload()
+                    failures = 0
+                except Exception as e:
+                    failures += 1
+                    if not classify_error(e)[0] or failures >= MAX_RELOAD_FAILURES:
+                        raise
+                    print(f"[Replicate] Polling {prediction.id} failed ({e}), retrying")
+        finally:
+            with self._lock:
+                self.active.pop(prediction.id, None)
+            if prediction.status not in TERMINAL_STATUSES:
+                self.cancel(prediction)
+
+        if prediction.status == "failed":
+            raise ModelError(prediction.error)
+        if prediction.status == "canceled":
+            raise Exception(f"Prediction {prediction.id} was cancelled")
+        return prediction.output
+
+    def cancel_all(self) -> int:
+        with self._lock:
+            predictions = list(self.active.values())
+        for prediction in predictions:
+            self.cancel(prediction)
+        return len(predictions)
+
+    def cancel(self, prediction: Any):
+        try:
+            prediction.cancel()
+            self.cancelled += 1
+            print(f"[Replicate] Cancelled prediction {prediction.id}")
+        except Exception as e:
+            print(f"[Replicate] Failed to cancel prediction {prediction.id}: {e}")
+
+
+class FakeBackend(InferenceBackend):
+    """Offline stand-in for Replicate.
+
+    ``run`` sleeps for a simulated prediction time and returns a placeholder
+    output URL, so a server can be load tested or replayed without spending
+    real predictions.
+    """
+
+    name = "fake"
+
+    def __init__(self, latency: float, jitter: float = 0.25, failure_rate: float = 0.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.running = 0
+        self._cancel = threading.Event()
+
+    def run(self, model_id: str, input: Dict[str, Any]) -> List[str]:
+        spread = self.latency * self.jitter
+        finish = time.monotonic() + max(0.0, random.uniform(self.latency - spread, self.latency + spread))
+        deadline = request_context.deadline.get()
+        self.running += 1
+        try:
+            if self._cancel.wait(max(0.0, min(finish, deadline or finish) - time.monotonic())):
+                raise Exception(f"Simulated prediction for {model_id} was cancelled")
+        finally:
+            self.running -= 1
+        if deadline is not None and deadline < finish:
+            raise DeadlineExceededError(f"Simulated prediction for {model_id} cancelled at the request deadline")
+        if random.random() < self.failure_rate:
+            # A transient provider error, so simulated failures exercise retries and circuit breakers
+            raise ConnectionError(f"Simulated failure for {model_id}")
+        return [f"https://fake.local/outputs/{uuid.uuid4()}.png" for _ in range(input.get("num_outputs", 1))]
+
+    def cancel_all(self) -> int:
+        running = self.running
+        self._cancel.set()
+        return running
+
+
+def read_image_input(image: Any) -> Image.Image:
+    """Open a model image input: a data URL, an open file or a path"""
+    if isinstance(image, str) and image.startswith("data:"):
+        return Image.open(io.BytesIO(base64.b64decode(image.split(",", 1)[1])))
+    if hasattr(image, "read"):
+        return Image.open(io.BytesIO(image.read()))
+    return Image.open(image)
+
+
+@functools.lru_cache(maxsize=8)
+def _vignette_mask(width: int, height: int) -> Image.Image:
+    """White in the middle fading to black at the edges"""
+    return ImageOps.invert(Image.radial_gradient("L")).resize((width, height), Image.BILINEAR)
+
+
+def _face_centering(face_box: Sequence[float], image_size: Tuple[int, int], size: Tuple[int, int]) -> Tuple[float, float]:
+    """``ImageOps.fit`` centering that puts the face box in the middle of the crop, as far as the image allows"""
+    image_width, image_height = image_size
+    # The crop ImageOps.fit takes: the largest window of the output's aspect ratio
+    crop_width = min(image_width, image_height * size[0] / size[1])
+    crop_height = min(image_height, image_width * size[1] / size[0])
+    centering = []
+    for start, extent, image_extent, crop_extent in (
+        (face_box[0], face_box[2], image_width, crop_width),
+        (face_box[1], face_box[3], image_height, crop_height),
+    ):
+        if image_extent - crop_extent < 1:
+            centering.append(0.5)
+            continue
+        offset = (start + extent / 2) * image_extent - crop_extent / 2
+        centering.append(min(1.0, max(0.0, offset / (image_extent - crop_extent))))
+    return centering[0], centering[1]
+
+
+def stylize(image: Image.Image, style: str, width: int, height: int,
+            face_box: Optional[Sequence[float]] = None) -> Image.Image:
+    """Classical portrait treatment for a style: crop, tone and backdrop effects.
+
+    ``face_box`` is (x, y, width, height) as fractions of the upright image;
+    the crop is centred on it when given.
+    """
+    # JPEG sources decode straight at a reduced scale
+    image.draft("RGB", (width * 2, height * 2))
+    image = ImageOps.exif_transpose(image).convert("RGB")
+    # Without a detected face, assume it sits in the upper part of a portrait
+    centering = (0.5, 0.35)
+    if face_box:
+        centering = _face_centering(face_box, image.size, (width, height))
+    image = ImageOps.fit(image, (width, height), Image.BILINEAR, centering=centering)
+    mask = _vignette_mask(width, height)
+
+    if style == "professional":
+        backdrop = ImageOps.colorize(
+            ImageOps.grayscale(image).filter(ImageFilter.GaussianBlur(12)), (40, 48, 60), (200, 205, 215)
+        )
+        image = Image.composite(image, backdrop, mask)
+        image = ImageEnhance.Contrast(image).enhance(1.1)
+    elif style == "artistic":
+        image = ImageOps.posterize(image.filter(ImageFilter.SMOOTH_MORE), 4)
+        image = ImageEnhance.Color(image).enhance(1.4)
+        image = Image.composite(image, Image.new("RGB", image.size, (30, 20, 40)), mask)
+    elif style == "casual":
+        image = Image.blend(image, Image.new("RGB", image.size, (255, 200, 150)), 0.08)
+        image = ImageEnhance.Brightness(image).enhance(1.05)
+    else:
+        image = ImageOps.autocontrast(image, cutoff=1)
+        image = image.filter(ImageFilter.UnsharpMask(radius=2, percent=80, threshold=3))
+        image = Image.composite(image, ImageEnhance.Brightness(image).enhance(0.7), mask)
+    return image
+
+
+class LocalFallbackBackend(InferenceBackend):
+    """CPU-only stand-in used while the provider is saturated or failing.
+
+    Applies a quick classical stylization to the reference image instead of
+    running a model, writes the result to ``output_dir`` and returns its URL
+    under ``/outputs/``. Takes well under a second.
+    """
+
+    name = "local"
+    degraded = True
+
+    def __init__(self, output_dir: str, max_outputs: int):
+        self.output_dir = output_dir
+        self.max_outputs = max_outputs
+        self.written = 0
+        os.makedirs(output_dir, exist_ok=True)
+
+    def run(self, model_id: str, input: Dict[str, Any]) -> List[str]:
+        image = read_image_input(input.get("image") or input.get("face_image_path"))
+        image = stylize(
+            image, input.get("style", "realistic"), input.get("width", 640), input.get("height", 640),
+            face_box=input.get("face_box")
+        )
+
+        name = f"{uuid.uuid4()}.jpg"
+        image.save(os.path.join(self.output_dir, name), format="JPEG", quality=90)
+        self.written += 1
+        if self.written % 100 == 0:
+            self.prune()
+        return [LOCAL_OUTPUT_URL_PREFIX + name]
+
+    def path_for(self, url: str) -> str:
+        """Local file behind an output URL returned by ``run``"""
+        return os.path.join(self.output_dir, os.path.basename(url))
+
+    def prune(self):
+        """Delete the oldest outputs beyond ``max_outputs``"""
+        try:
+            entries = sorted(os.scandir(self.output_dir), key=lambda entry: entry.stat().st_mtime)
+        except FileNotFoundError:
+            return
+        for entry in entries[:max(0, len(entries) - self.max_outputs)]:
+            try:
+                os.remove(entry.path)
+            except FileNotFoundError:
+                pass
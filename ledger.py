@@ -0,0 +1,333 @@
+import array
+import asyncio
+import bisect
+import collections
+import json
+import os
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Deque, Dict, List, Optional, Tuple
+
+# Offsets and lengths are packed into one int per record to keep the index small
+LENGTH_BITS = 24
+LENGTH_MASK = (1 << LENGTH_BITS) - 1
+
+
+class JsonlBatchWriter:
+    """Appends JSON records to a file from a background task.
+
+    ``submit`` never blocks: records are queued in memory and written in
+    batches on a dedicated thread. When more than ``max_pending`` records are
+    waiting, new ones are dropped and counted rather than slowing callers down.
+    ``on_written`` receives each written batch with the (offset, length) of
+    every line.
+    """
+
+    def __init__(self, path: str, batch_size: int, flush_interval: float, max_pending: int,
+                 on_written: Optional[Callable[[List[Dict[str, Any]], List[Tuple[int, int]]], None]] = None):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.on_written = on_written
+
+        self.pending: Deque[Dict[str, Any]] = collections.deque()
+        self.written = 0
+        self.dropped = 0
+        self.batches = 0
+        self.failed_batches = 0
+        self._wakeup = asyncio.Event()
+        self._stopping = False
+        self._task: Optional[asyncio.Task] = None
+        # A single thread keeps batches in submission order
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="jsonl-writer")
+
+    def submit(self, record: Dict[str, Any]) -> bool:
+        if len(self.pending) >= self.max_pending:
+            self.dropped += 1
+            return False
+        self.pending.append(record)
+        if len(self.pending) >= self.batch_size:
+            self._wakeup.set()
+        return True
+
+    async def start(self):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        if self._task is None:
+            self._stopping = False
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Stop the writer after flushing everything still pending"""
+        if self._task:
+            self._stopping = True
+            self._wakeup.set()
+            await self._task
+            self._task = None
+        while self.pending:
+            await self._flush()
+
+    async def _run(self):
+        while not self._stopping:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            while self.pending:
+                await self._flush()
+
+    async def _flush(self):
+        batch = [self.pending.popleft() for _ in range(min(self.batch_size, len(self.pending)))]
+        loop = asyncio.get_running_loop()
+        try:
+            spans = await loop.run_in_executor(self._executor, self._write, batch)
+        except Exception as e:
+            self.failed_batches += 1
+            self.dropped += len(batch)
+            print(f"[Ledger] Failed to write {len(batch)} records to {self.path}: {e}")
+            return
+        self.written += len(batch)
+        self.batches += 1
+        if self.on_written:
+            try:
+                self.on_written(batch, spans)
+            except Exception as e:
+                # The records are on disk; keep the writer alive for the next batches
+                print(f"[Ledger] Failed to index {len(batch)} records written to {self.path}: {e}")
+
+    def _write(self, batch: List[Dict[str, Any]]) -> List[Tuple[int, int]]:
+        lines = [(json.dumps(record, separators=(",", ":")) + "\n").encode("utf-8") for record in batch]
+        with open(self.path, "ab") as f:
+            offset = f.tell()
+            f.write(b"".join(lines))
+        spans = []
+        for line in lines:
+            spans.append((offset, len(line)))
+            offset += len(line)
+        return spans
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "path": self.path,
+            "pending": len(self.pending),
+            "written": self.written,
+            "dropped": self.dropped,
+            "batches": self.batches,
+            "failed_batches": self.failed_batches,
+        }
+
+
+# Fields returned by history listings
+HISTORY_FIELDS = ("generation_id", "model", "model_used", "style", "status", "image_url", "created_at", "recorded_at")
+
+
+class HistoryIndex:
+    """Secondary indexes over ledger records for keyset-paginated history.
+
+    Every indexed record gets a row number in append order. Per client, and
+    per client+model and client+style, a posting list holds those row
+    numbers in ascending order. Row attributes live in typed arrays, with
+    clients, models and styles each interned to codes of their own, so a
+    million rows take a few tens of megabytes.
+
+    A page is a bisect into the most selective posting list, followed by a
+    backwards walk, so its cost does not grow with the size of the history.
+    ``recorded_at`` only ever grows in append order, which lets date bounds
+    be bisected as well.
+    """
+
+    def __init__(self):
+        self.recorded_at = array.array("d")
+        self.spans = array.array("q")
+        self.models = array.array("I")
+        self.styles = array.array("I")
+        self.client_codes: Dict[str, int] = {}
+        self.model_codes: Dict[str, int] = {}
+        self.style_codes: Dict[str, int] = {}
+        self.by_client: Dict[int, array.array] = {}
+        self.by_client_model: Dict[Tuple[int, int], array.array] = {}
+        self.by_client_style: Dict[Tuple[int, int], array.array] = {}
+
+    @staticmethod
+    def _code(codes: Dict[str, int], value: Optional[str]) -> int:
+        value = value or ""
+        code = codes.get(value)
+        if code is None:
+            code = codes[value] = len(codes)
+        return code
+
+    def add(self, record: Dict[str, Any], packed: int):
+        row = len(self.spans)
+        client = self._code(self.client_codes, record.get("client_id"))
+        model = self._code(self.model_codes, record.get("model"))
+        style = self._code(self.style_codes, record.get("style"))
+        recorded_at = float(record.get("recorded_at") or record.get("created_at") or 0)
+        # Keep the column monotonic even if the clock steps backwards
+        if row and recorded_at < self.recorded_at[-1]:
+            recorded_at = self.recorded_at[-1]
+
+        self.recorded_at.append(recorded_at)
+        self.spans.append(packed)
+        self.models.append(model)
+        self.styles.append(style)
+        self.by_client.setdefault(client, array.array("I")).append(row)
+        self.by_client_model.setdefault((client, model), array.array("I")).append(row)
+        self.by_client_style.setdefault((client, style), array.array("I")).append(row)
+
+    def query(self, client_id: str, model: Optional[str], style: Optional[str],
+              since: Optional[float], until: Optional[float], before_row: Optional[int],
+              limit: int) -> Tuple[List[int], Optional[int]]:
+        """Return up to ``limit`` rows, newest first, plus the cursor for the next page"""
+        client = self.client_codes.get(client_id)
+        if client is None:
+            return [], None
+        model_code = self.model_codes.get(model) if model else None
+        style_code = self.style_codes.get(style) if style else None
+        if (model and model_code is None) or (style and style_code is None):
+            return [], None
+
+        if model_code is not None:
+            postings = self.by_client_model.get((client, model_code))
+        elif style_code is not None:
+            postings = self.by_client_style.get((client, style_code))
+        else:
+            postings = self.by_client.get(client)
+        if not postings:
+            return [], None
+
+        end = len(postings)
+        if before_row is not None:
+            end = bisect.bisect_left(postings, before_row)
+        if until is not None:
+            end = min(end, bisect.bisect_right(postings, until, key=lambda row: self.recorded_at[row]))
+        start = 0
+        if since is not None:
+            start = bisect.bisect_left(postings, since, key=lambda row: self.recorded_at[row])
+
+        rows = []
+        position = end - 1
+        while position >= start and len(rows) < limit:
+            row = postings[position]
+            if style_code is None or model_code is None or self.styles[row] == style_code:
+                rows.append(row)
+            position -= 1
+
+        next_cursor = rows[-1] if len(rows) == limit and position >= start else None
+        return rows, next_cursor
+
+
+class GenerationLedger:
+    """Append-only JSONL ledger of generations with an in-memory id index.
+
+    The index maps each generation id to the byte span of its record, so a
+    lookup is one dict access plus one positioned read. Records that have not
+    been flushed yet are served from memory. The ledger assumes one writing
+    process per file.
+    """
+
+    def __init__(self, path: str, batch_size: int, flush_interval: float, max_pending: int):
+        self.path = path
+        self.writer = JsonlBatchWriter(path, batch_size, flush_interval, max_pending, on_written=self._index_batch)
+        self.index: Dict[bytes, int] = {}
+        self.history = HistoryIndex()
+        self.unflushed: Dict[str, Dict[str, Any]] = {}
+
+    @staticmethod
+    def _key(generation_id: str) -> Optional[bytes]:
+        try:
+            return uuid.UUID(generation_id).bytes
+        except ValueError:
+            return None
+
+    def _index_record(self, record: Dict[str, Any], offset: int, length: int):
+        key = self._key(record.get("generation_id", ""))
+        if key is not None and length <= LENGTH_MASK:
+            packed = (offset << LENGTH_BITS) | length
+            self.index[key] = packed
+            self.history.add(record, packed)
+
+    def _index_batch(self, batch: List[Dict[str, Any]], spans: List[Tuple[int, int]]):
+        for record, (offset, length) in zip(batch, spans):
+            self._index_record(record, offset, length)
+            self.unflushed.pop(record.get("generation_id"), None)
+
+    def _load_index(self):
+        """Rebuild the index by scanning the ledger file (runs before the writer starts)"""
+        if not os.path.exists(self.path):
+            return
+        offset = 0
+        with open(self.path, "rb") as f:
+            for line in f:
+                try:
+                    self._index_record(json.loads(line), offset, len(line))
+                except ValueError:
+                    # A torn final line from a crash; skip it
+                    pass
+                offset += len(line)
+
+    async def start(self):
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self._load_index)
+        print(f"[Ledger] Indexed {len(self.index)} generations from {self.path}")
+        await self.writer.start()
+
+    async def stop(self):
+        await self.writer.stop()
+
+    def record(self, entry: Dict[str, Any]):
+        """Queue a generation record; never blocks the caller"""
+        entry.setdefault("recorded_at", time.time())
+        if self.writer.submit(entry):
+            self.unflushed[entry["generation_id"]] = entry
+
+    def _read(self, packed: int) -> Dict[str, Any]:
+        offset, length = packed >> LENGTH_BITS, packed & LENGTH_MASK
+        fd = os.open(self.path, os.O_RDONLY)
+        try:
+            return json.loads(os.pread(fd, length, offset))
+        finally:
+            os.close(fd)
+
+    async def get(self, generation_id: str) -> Optional[Dict[str, Any]]:
+        record = self.unflushed.get(generation_id)
+        if record is not None:
+            return record
+        key = self._key(generation_id)
+        packed = self.index.get(key) if key is not None else None
+        if packed is None:
+            return None
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self._read, packed)
+
+    def _read_page(self, spans: List[int]) -> List[Dict[str, Any]]:
+        fd = os.open(self.path, os.O_RDONLY)
+        try:
+            page = []
+            for packed in spans:
+                record = json.loads(os.pread(fd, packed & LENGTH_MASK, packed >> LENGTH_BITS))
+                page.append({field: record.get(field) for field in HISTORY_FIELDS})
+            return page
+        finally:
+            os.close(fd)
+
+    async def list_history(self, client_id: str, model: Optional[str] = None, style: Optional[str] = None,
+                           since: Optional[float] = None, until: Optional[float] = None,
+                           cursor: Optional[int] = None, limit: int = 20) -> Dict[str, Any]:
+        """List a client's generations newest first, one keyset page at a time"""
+        rows, next_cursor = self.history.query(client_id, model, style, since, until, cursor, limit)
+        spans = [self.history.spans[row] for row in rows]
+        loop = asyncio.get_running_loop()
+        items = await loop.run_in_executor(None, self._read_page, spans) if spans else []
+        return {
+            "items": items,
+            "next_cursor": str(next_cursor) if next_cursor is not None else None
+        }
+
+    def stats(self) -> Dict[str, Any]:
+        stats = self.writer.stats()
+        stats["indexed"] = len(self.index)
+        return stats
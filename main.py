@@ -1,57 +1,318 @@
 import os
-import replicate
 import requests
-from fastapi import FastAPI, File, UploadFile, HTTPException, Form
-from fastapi.responses import FileResponse, HTMLResponse
-from fastapi.staticfiles import StaticFiles
+from fastapi import FastAPI, File, UploadFile, HTTPException, Form, Request
+from fastapi.responses import FileResponse, HTMLResponse, JSONResponse, Response
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
-from typing import List, Optional, Dict, Any
-import aiofiles
-import uuid
+from typing import List, Optional, Dict, Any, Tuple, Union
 from PIL import Image
 import io
-import json
 import os
-from portrait_service import PortraitGenerationService
+import hashlib
+import request_context
+import deadlines
+from portrait_service import REFERENCE_DECODED_COPIES, PortraitGenerationService
 from config import Config
+from errors import ServiceUnavailableError
+from references import ReferenceHandle
+from traffic_capture import TrafficCapture
+import traffic_capture
+import time
+from renditions import RenditionService, RenditionNotFoundError, CONTENT_TYPES as RENDITION_CONTENT_TYPES
+from health import HealthMonitor, LoopLagProbe
+from drain import DrainController, DrainingServer
+from idempotency import IdempotencyMiddleware, IdempotencyStore
+from profiling import ProfileStore, ProfilingMiddleware, is_admin
+from face_gate import FACE_CHECK_DECODED_COPIES, FaceCheckError
+from memory_budget import estimate_decoded_bytes, is_jpeg
+from static_assets import StaticAssetCache, IMMUTABLE_CACHE_CONTROL, PRIVATE_IMMUTABLE_CACHE_CONTROL, REVALIDATE_CACHE_CONTROL
 
 app = FastAPI(title="AI Portrait Generator", description="Generate realistic portraits using SOTA AI models")
 
 # Initialize services
 portrait_service = PortraitGenerationService()
 config = Config()
+static_assets = StaticAssetCache(config.STATIC_DIR, config.STATIC_RELOAD_INTERVAL)
+capture = TrafficCapture(config.CAPTURE_PATH) if config.CAPTURE_TRAFFIC else None
+renditions = RenditionService(
+    sizes=config.RENDITION_SIZES,
+    formats=config.RENDITION_FORMATS,
+    quality=config.RENDITION_QUALITY,
+    cache_dir=config.RENDITION_CACHE_DIR,
+    memory_cache_bytes=config.RENDITION_MEMORY_CACHE_BYTES,
+    max_source_bytes=config.RENDITION_MAX_SOURCE_BYTES,
+    workers=config.RENDITION_WORKERS,
+    budget=portrait_service.memory,
+    local_output_dir=config.FALLBACK_OUTPUT_DIR,
+    max_cached_generations=config.RENDITION_CACHE_MAX_GENERATIONS
+)
+loop_lag = LoopLagProbe(
+    stall_threshold=config.LOOP_STALL_THRESHOLD_MS / 1000,
+    stall_history=config.LOOP_STALL_HISTORY
+)
+health = HealthMonitor(
+    portrait_service,
+    loop_lag,
+    max_queue_depth=config.SHED_QUEUE_DEPTH,
+    max_loop_lag=config.SHED_LOOP_LAG_MS / 1000,
+    max_memory_ratio=config.SHED_MEMORY_RATIO,
+    retry_after=config.SHED_RETRY_AFTER
+)
+drain = DrainController(portrait_service, config.DRAIN_GRACE_PERIOD, retry_after=config.DRAIN_RETRY_AFTER)
+idempotency = IdempotencyStore(
+    config.IDEMPOTENCY_TTL,
+    config.IDEMPOTENCY_MAX_ENTRIES,
+    path=config.IDEMPOTENCY_PATH or None
+)
+
+# Added first so it runs innermost, in the endpoint's own task
+profiles = ProfileStore(config.PROFILE_MAX_KEPT)
+if config.ADMIN_TOKEN or config.PROFILE_SAMPLE_RATE > 0:
+    app.add_middleware(
+        ProfilingMiddleware,
+        store=profiles,
+        admin_token=config.ADMIN_TOKEN,
+        sample_rate=config.PROFILE_SAMPLE_RATE
+    )
+
+# Registered before identify_client so it runs inside it and sees the client id
+@app.middleware("http")
+async def capture_traffic(request: Request, call_next):
+    """Record the shape of generation requests when capture is enabled"""
+    if capture is None or not capture.wants(request.url.path, request.method):
+        return await call_next(request)
+    shape = capture.begin(request.url.path)
+    started = time.monotonic()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        capture.finish(shape, status, started)
+
+@app.middleware("http")
+async def apply_deadline(request: Request, call_next):
+    """Bound the request by the client's X-Request-Timeout, in seconds"""
+    try:
+        timeout = deadlines.parse_timeout(request.headers.get("x-request-timeout"))
+    except ValueError:
+        return JSONResponse(status_code=400, content={"detail": "X-Request-Timeout must be a positive number of seconds"})
+    deadlines.set_timeout(timeout, config.MAX_REQUEST_TIMEOUT)
+    return await call_next(request)
+
+def client_identity(request: Request) -> str:
+    """The client a request is served for: its API key, client id or address"""
+    api_key = request.headers.get("x-api-key")
+    if api_key:
+        # Never keep raw keys around in metrics
+        return "key:" + hashlib.sha256(api_key.encode()).hexdigest()[:12]
+    if request.headers.get("x-client-id"):
+        return "client:" + request.headers["x-client-id"][:64]
+    return "ip:" + (request.client.host if request.client else "unknown")
+
+@app.middleware("http")
+async def identify_client(request: Request, call_next):
+    """Tag the request with the client it is served for, for fair scheduling"""
+    request_context.client_id.set(client_identity(request))
+    return await call_next(request)
+
+# Runs before deadlines, client identification and traffic capture, so saturated work is rejected before
+# anything is parsed; only the drain check and Idempotency-Key replays, registered below, run ahead of it
+@app.middleware("http")
+async def shed_load(request: Request, call_next):
+    """Turn away new generation requests while the instance is saturated"""
+    if request.method == "POST" and request.url.path.startswith("/generate-portrait"):
+        reasons = health.saturation_reasons()
+        if reasons:
+            health.shed += 1
+            return JSONResponse(
+                status_code=503,
+                content={"detail": "Server is overloaded, please retry shortly", "reasons": reasons},
+                headers={"Retry-After": str(health.retry_after)}
+            )
+    return await call_next(request)
+
+# Registered after shed_load so a draining instance refuses work before anything else runs
+@app.middleware("http")
+async def track_generations(request: Request, call_next):
+    """Count generation requests in flight, and refuse new ones while draining for shutdown"""
+    if request.method != "POST" or not request.url.path.startswith("/generate-portrait"):
+        return await call_next(request)
+    if drain.draining:
+        drain.refused += 1
+        return JSONResponse(
+            status_code=503,
+            content={"detail": "Server is shutting down, please retry"},
+            headers={"Retry-After": str(drain.retry_after), "Connection": "close"}
+        )
+    with drain.track():
+        return await call_next(request)
 
-# Add CORS middleware
+# Wraps everything but CORS: a retry gets the stored result even while shedding or draining
+app.add_middleware(
+    IdempotencyMiddleware,
+    store=idempotency,
+    identify=client_identity,
+    max_wait=config.MAX_REQUEST_TIMEOUT
+)
+
+# Added last so it is outermost and also covers the responses the middleware above produce
+# themselves, like 503s from shedding and draining; browsers can read their Retry-After
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],  # In production, replace with specific origins
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["Retry-After"],
 )
 
-# Mount static files
-if os.path.exists("static"):
-    app.mount("/static", StaticFiles(directory="static"), name="static")
+@app.on_event("startup")
+async def startup():
+    await loop_lag.start()
+    await portrait_service.face_gate.start()
+    await static_assets.start()
+    await portrait_service.spool.start()
+    await portrait_service.ledger.start()
+    await idempotency.start()
+    if portrait_service.phash_index:
+        await portrait_service.phash_index.start()
+    if capture:
+        await capture.start()
+
+@app.on_event("shutdown")
+async def shutdown():
+    # Already done by DrainingServer; under a plain uvicorn this still cancels leftover predictions
+    await drain.drain()
+    portrait_service.executor.shutdown(wait=False, cancel_futures=True)
+    await loop_lag.stop()
+    await static_assets.stop()
+    await portrait_service.spool.stop()
+    await portrait_service.ledger.stop()
+    await idempotency.stop()
+    if portrait_service.phash_index:
+        await portrait_service.phash_index.stop()
+    renditions.shutdown()
+    portrait_service.face_gate.shutdown()
+    if capture:
+        await capture.stop()
+
+def unavailable(e: ServiceUnavailableError) -> HTTPException:
+    """Turn a capacity error into a 503 (or 429) the client can back off from"""
+    return HTTPException(status_code=e.status_code, detail=str(e), headers={"Retry-After": str(e.retry_after)})
+
+def upload_size(upload: UploadFile) -> int:
+    """Size of an uploaded file, which the multipart parser has already spooled"""
+    if upload.size is not None:
+        return upload.size
+    position = upload.file.tell()
+    upload.file.seek(0, os.SEEK_END)
+    size = upload.file.tell()
+    upload.file.seek(position)
+    return size
+
+def upload_footprint(upload: UploadFile, decoded_copies: float) -> int:
+    """Bytes to reserve for an upload: its encoded size plus the decoded copies made of it.
+
+    Reserved in one go before the upload is read, since taking a second
+    reservation while holding the first can deadlock under load.
+    """
+    if not is_jpeg(upload.file):
+        # Only JPEGs decode straight to a reduced scale: the face check and dHash
+        # decode anything else in full before shrinking it
+        decoded_copies = max(decoded_copies, 1 + FACE_CHECK_DECODED_COPIES)
+    return upload_size(upload) + int(decoded_copies * estimate_decoded_bytes(upload.file))
+
+async def resolve_reference(
+    reference_image: Optional[UploadFile],
+    reference_id: Optional[str]
+) -> Tuple[Union[str, ReferenceHandle], Optional[str]]:
+    """Resolve the image to generate from: a stored reference or a fresh upload.
+
+    Returns the image to pass to the service and the spool path to clean up, if any.
+    """
+    deadlines.check("upload")
+    if reference_id:
+        traffic_capture.note(reference_id_used=True)
+        reference = portrait_service.references.get(reference_id)
+        if not reference:
+            raise HTTPException(status_code=404, detail="Reference not found or expired")
+        request_context.face_check.set(reference.face_check)
+        return reference.handle, None
+    if not reference_image:
+        raise HTTPException(status_code=400, detail="Either reference_image or reference_id is required")
+    
+    try:
+        footprint = upload_footprint(reference_image, FACE_CHECK_DECODED_COPIES)
+        async with portrait_service.memory.reserve(footprint, "upload"):
+            content = await reference_image.read()
+            traffic_capture.note_image(content)
+            # A near-duplicate of a stored reference reuses its upload and face check
+            reference = await portrait_service.reuse_reference(content)
+            if reference is not None:
+                request_context.face_check.set(reference.face_check)
+                return reference.handle, None
+            # Reject photos without a usable face before any prediction is paid for
+            request_context.face_check.set(await portrait_service.face_gate.check(content))
+            temp_path = await portrait_service.save_uploaded_image(content)
+    except ServiceUnavailableError as e:
+        raise unavailable(e)
+    except FaceCheckError as e:
+        raise face_rejected(e)
+    return temp_path, temp_path
+
+def face_rejected(e: FaceCheckError) -> HTTPException:
+    return HTTPException(status_code=422, detail={"message": str(e), **e.check.to_dict()})
+
+def apply_timeout(timeout_seconds: Optional[float]):
+    """Bound the request by a timeout_seconds form field, like X-Request-Timeout"""
+    if timeout_seconds is not None and timeout_seconds <= 0:
+        raise HTTPException(status_code=400, detail="timeout_seconds must be a positive number of seconds")
+    deadlines.set_timeout(timeout_seconds, config.MAX_REQUEST_TIMEOUT)
+
+def parse_seeds(num_variants: int, seeds: Optional[str]) -> Optional[List[int]]:
+    """Validate the variant count and parse a comma-separated seed list"""
+    if not 1 <= num_variants <= config.MAX_VARIANTS:
+        raise HTTPException(status_code=400, detail=f"num_variants must be between 1 and {config.MAX_VARIANTS}")
+    traffic_capture.note(num_variants=num_variants)
+    if not seeds:
+        return None
+    try:
+        seed_list = [int(seed) for seed in seeds.split(",")]
+    except ValueError:
+        raise HTTPException(status_code=400, detail="seeds must be comma-separated integers")
+    if len(seed_list) not in (1, num_variants):
+        raise HTTPException(status_code=400, detail="Pass one seed, or one seed per variant")
+    return seed_list
 
 class PortraitRequest(BaseModel):
     style: str = "realistic"
     prompt: Optional[str] = None
     negative_prompt: Optional[str] = None
 
+class Variant(BaseModel):
+    image_url: str
+    seed: Optional[int] = None
+    batch_index: Optional[int] = None
+
 class PortraitResponse(BaseModel):
     image_url: str
     model_used: str
     generation_id: str
+    degraded: bool = False
+    variants: List[Variant] = []
+    face_box: Optional[List[float]] = None
+    warnings: List[str] = []
 
 @app.get("/", response_class=HTMLResponse)
-async def root():
+async def root(request: Request):
     """Serve the main frontend page"""
-    try:
-        with open("static/index.html", "r", encoding="utf-8") as f:
-            return HTMLResponse(content=f.read())
-    except FileNotFoundError:
+    asset = static_assets.get("index.html")
+    if asset:
+        # The page's asset URLs carry their content hash, so only the page itself is revalidated
+        return static_assets.respond(asset, request, REVALIDATE_CACHE_CONTROL)
+    else:
         return HTMLResponse(content="""
         <html>
             <head><title>AI Portrait Generator</title></head>
@@ -67,37 +328,90 @@ async def root():
         </html>
         """)
 
+@app.get("/static/{path:path}")
+async def static_file(path: str, request: Request):
+    """Serve a frontend asset from memory.
+
+    Requests carrying the asset's content hash as ``?v=`` are cached forever;
+    unversioned requests are revalidated with the ETag.
+    """
+    asset = static_assets.get(path)
+    if not asset:
+        raise HTTPException(status_code=404, detail="Not found")
+    if request.query_params.get("v") == asset.version:
+        return static_assets.respond(asset, request, IMMUTABLE_CACHE_CONTROL)
+    return static_assets.respond(asset, request, REVALIDATE_CACHE_CONTROL)
+
+@app.post("/references")
+async def create_reference(reference_image: UploadFile = File(...)):
+    """Upload a reference image once and get an id to reuse across generations"""
+    try:
+        # The face check and normalization run one after the other, so the larger of the two is held
+        footprint = upload_footprint(reference_image, max(FACE_CHECK_DECODED_COPIES, REFERENCE_DECODED_COPIES))
+        async with portrait_service.memory.reserve(footprint, "upload"):
+            content = await reference_image.read()
+            traffic_capture.note_image(content)
+            reference = await portrait_service.create_reference(content)
+    except ServiceUnavailableError as e:
+        raise unavailable(e)
+    except FaceCheckError as e:
+        raise face_rejected(e)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return reference.to_dict()
+
+@app.delete("/references/{reference_id}")
+async def delete_reference(reference_id: str):
+    """Forget a stored reference before it expires, with its cached copy for near-duplicate reuse"""
+    if not portrait_service.delete_reference(reference_id):
+        raise HTTPException(status_code=404, detail="Reference not found or expired")
+    return {"reference_id": reference_id, "deleted": True}
+
 @app.post("/generate-portrait-instantid", response_model=PortraitResponse)
 async def generate_portrait_instantid(
-    reference_image: UploadFile = File(...),
+    reference_image: Optional[UploadFile] = File(None),
+    reference_id: Optional[str] = Form(None),
     style: str = Form("realistic"),
     prompt: Optional[str] = Form(None),
-    negative_prompt: Optional[str] = Form(None)
+    negative_prompt: Optional[str] = Form(None),
+    num_variants: int = Form(1),
+    seeds: Optional[str] = Form(None),
+    timeout_seconds: Optional[float] = Form(None)
 ):
     """Generate a realistic portrait using the uploaded reference image with InstantID"""
     
-    temp_path = None
+    apply_timeout(timeout_seconds)
+    traffic_capture.note_prompts(style, prompt, negative_prompt)
+    seed_list = parse_seeds(num_variants, seeds)
+    image, temp_path = await resolve_reference(reference_image, reference_id)
     try:
-        # Save uploaded image
-        content = await reference_image.read()
-        temp_path = await portrait_service.save_uploaded_image(content)
         
         # Generate portrait using InstantID
         unified_prompt = portrait_service.get_prompt(style, prompt)
         unified_negative_prompt = portrait_service.get_negative_prompt(style, negative_prompt)
         
-        result = await portrait_service.generate_with_instantid(
-            temp_path, 
-            unified_prompt, 
-            unified_negative_prompt
+        result = await portrait_service.generate(
+            "instantid",
+            image,
+            unified_prompt,
+            unified_negative_prompt,
+            style=style,
+            num_variants=num_variants,
+            seeds=seed_list
         )
         
         return PortraitResponse(
             image_url=result["image_url"],
             model_used=result["model_used"],
-            generation_id=result["generation_id"]
+            generation_id=result["generation_id"],
+            degraded=result.get("degraded", False),
+            variants=result["variants"],
+            face_box=result.get("face_box"),
+            warnings=result.get("warnings", [])
         )
         
+    except ServiceUnavailableError as e:
+        raise unavailable(e)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Generation failed: {str(e)}")
     finally:
@@ -108,22 +422,23 @@ async def generate_portrait_instantid(
 
 @app.post("/generate-portrait-runall")
 async def generate_portrait_runall(
-    reference_image: UploadFile = File(...),
+    reference_image: Optional[UploadFile] = File(None),
+    reference_id: Optional[str] = Form(None),
     style: str = Form("realistic"),
     prompt: Optional[str] = Form(None),
-    negative_prompt: Optional[str] = Form(None)
+    negative_prompt: Optional[str] = Form(None),
+    timeout_seconds: Optional[float] = Form(None)
 ):
     """Generate portraits using all models and select the best result"""
     
-    temp_path = None
+    apply_timeout(timeout_seconds)
+    traffic_capture.note_prompts(style, prompt, negative_prompt)
+    image, temp_path = await resolve_reference(reference_image, reference_id)
     try:
-        # Save uploaded image
-        content = await reference_image.read()
-        temp_path = await portrait_service.save_uploaded_image(content)
         
         # Generate portraits using all models and select best
         result = await portrait_service.generate_portrait_runall(
-            temp_path, 
+            image, 
             style, 
             prompt, 
             negative_prompt
@@ -131,6 +446,8 @@ async def generate_portrait_runall(
         
         return result
         
+    except ServiceUnavailableError as e:
+        raise unavailable(e)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Run All generation failed: {str(e)}")
     finally:
@@ -139,31 +456,45 @@ async def generate_portrait_runall(
 
 @app.post("/generate-portrait-ipadapter", response_model=PortraitResponse)
 async def generate_portrait_ipadapter(
-    reference_image: UploadFile = File(...),
+    reference_image: Optional[UploadFile] = File(None),
+    reference_id: Optional[str] = Form(None),
     style: str = Form("realistic"),
     prompt: Optional[str] = Form(None),
-    negative_prompt: Optional[str] = Form(None)
+    negative_prompt: Optional[str] = Form(None),
+    num_variants: int = Form(1),
+    seeds: Optional[str] = Form(None),
+    timeout_seconds: Optional[float] = Form(None)
 ):
     """Generate portrait using IP-Adapter FaceID model"""
-    temp_path = None
+    apply_timeout(timeout_seconds)
+    traffic_capture.note_prompts(style, prompt, negative_prompt)
+    seed_list = parse_seeds(num_variants, seeds)
+    image, temp_path = await resolve_reference(reference_image, reference_id)
     try:
-        # Save uploaded image
-        content = await reference_image.read()
-        temp_path = await portrait_service.save_uploaded_image(content)
         # Generate portrait using IP-Adapter
         unified_prompt = portrait_service.get_prompt(style, prompt)
         unified_negative_prompt = portrait_service.get_negative_prompt(style, negative_prompt)
         
-        result = await portrait_service.generate_with_ipadapter(
-            temp_path,
+        result = await portrait_service.generate(
+            "ipadapter",
+            image,
             unified_prompt,
-            unified_negative_prompt
+            unified_negative_prompt,
+            style=style,
+            num_variants=num_variants,
+            seeds=seed_list
         )
         return PortraitResponse(
             image_url=result["image_url"],
             model_used=result["model_used"],
-            generation_id=result["generation_id"]
+            generation_id=result["generation_id"],
+            degraded=result.get("degraded", False),
+            variants=result["variants"],
+            face_box=result.get("face_box"),
+            warnings=result.get("warnings", [])
         )
+    except ServiceUnavailableError as e:
+        raise unavailable(e)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Generation failed: {str(e)}")
     finally:
@@ -172,25 +503,33 @@ async def generate_portrait_ipadapter(
 
 @app.post("/generate-portrait-instantid2", response_model=PortraitResponse)
 async def generate_portrait_instantid2(
-    reference_image: UploadFile = File(...),
+    reference_image: Optional[UploadFile] = File(None),
+    reference_id: Optional[str] = Form(None),
     style: str = Form("realistic"),
     prompt: Optional[str] = Form(None),
-    negative_prompt: Optional[str] = Form(None)
+    negative_prompt: Optional[str] = Form(None),
+    num_variants: int = Form(1),
+    seeds: Optional[str] = Form(None),
+    timeout_seconds: Optional[float] = Form(None)
 ):
     """Generate portrait using InstantID MultiControlNet model"""
-    temp_path = None
+    apply_timeout(timeout_seconds)
+    traffic_capture.note_prompts(style, prompt, negative_prompt)
+    seed_list = parse_seeds(num_variants, seeds)
+    image, temp_path = await resolve_reference(reference_image, reference_id)
     try:
-        # Save uploaded image
-        content = await reference_image.read()
-        temp_path = await portrait_service.save_uploaded_image(content)
         # Generate portrait using InstantID2
         unified_prompt = portrait_service.get_prompt(style, prompt)
         unified_negative_prompt = portrait_service.get_negative_prompt(style, negative_prompt)
         
-        result = await portrait_service.generate_with_instantid2(
-            temp_path,
+        result = await portrait_service.generate(
+            "instantid2",
+            image,
             unified_prompt,
-            unified_negative_prompt
+            unified_negative_prompt,
+            style=style,
+            num_variants=num_variants,
+            seeds=seed_list
         )
         
         print(f"[API] InstantID2 result:")
@@ -201,8 +540,14 @@ async def generate_portrait_instantid2(
         return PortraitResponse(
             image_url=result["image_url"],
             model_used=result["model_used"],
-            generation_id=result["generation_id"]
+            generation_id=result["generation_id"],
+            degraded=result.get("degraded", False),
+            variants=result["variants"],
+            face_box=result.get("face_box"),
+            warnings=result.get("warnings", [])
         )
+    except ServiceUnavailableError as e:
+        raise unavailable(e)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Generation failed: {str(e)}")
     finally:
@@ -211,31 +556,45 @@ async def generate_portrait_instantid2(
 
 @app.post("/generate-portrait-ipadapter2", response_model=PortraitResponse)
 async def generate_portrait_ipadapter2(
-    reference_image: UploadFile = File(...),
+    reference_image: Optional[UploadFile] = File(None),
+    reference_id: Optional[str] = Form(None),
     style: str = Form("realistic"),
     prompt: Optional[str] = Form(None),
-    negative_prompt: Optional[str] = Form(None)
+    negative_prompt: Optional[str] = Form(None),
+    num_variants: int = Form(1),
+    seeds: Optional[str] = Form(None),
+    timeout_seconds: Optional[float] = Form(None)
 ):
     """Generate portrait using IP-Adapter Plus Face model"""
-    temp_path = None
+    apply_timeout(timeout_seconds)
+    traffic_capture.note_prompts(style, prompt, negative_prompt)
+    seed_list = parse_seeds(num_variants, seeds)
+    image, temp_path = await resolve_reference(reference_image, reference_id)
     try:
-        # Save uploaded image
-        content = await reference_image.read()
-        temp_path = await portrait_service.save_uploaded_image(content)
         # Generate portrait using IP-Adapter2
         unified_prompt = portrait_service.get_prompt(style, prompt)
         unified_negative_prompt = portrait_service.get_negative_prompt(style, negative_prompt)
         
-        result = await portrait_service.generate_with_ipadapter2(
-            temp_path,
+        result = await portrait_service.generate(
+            "ipadapter2",
+            image,
             unified_prompt,
-            unified_negative_prompt
+            unified_negative_prompt,
+            style=style,
+            num_variants=num_variants,
+            seeds=seed_list
         )
         return PortraitResponse(
             image_url=result["image_url"],
             model_used=result["model_used"],
-            generation_id=result["generation_id"]
+            generation_id=result["generation_id"],
+            degraded=result.get("degraded", False),
+            variants=result["variants"],
+            face_box=result.get("face_box"),
+            warnings=result.get("warnings", [])
         )
+    except ServiceUnavailableError as e:
+        raise unavailable(e)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Generation failed: {str(e)}")
     finally:
@@ -248,9 +607,165 @@ async def get_available_models():
     return {
         "models": config.MODELS,
         "styles": list(config.PROMPT_TEMPLATES.keys()),
-        "default_params": config.DEFAULT_PARAMS
+        "default_params": config.DEFAULT_PARAMS,
+        "breakers": {
+            model_key: breaker.stats()
+            for model_key, breaker in portrait_service.breakers.items()
+        }
+    }
+
+@app.get("/generations")
+async def list_generations(
+    model: Optional[str] = None,
+    style: Optional[str] = None,
+    since: Optional[float] = None,
+    until: Optional[float] = None,
+    cursor: Optional[str] = None,
+    limit: int = 20
+):
+    """List the calling client's generations, newest first.
+
+    Pass ``next_cursor`` from a page as ``cursor`` to get the next one;
+    ``since`` and ``until`` are Unix timestamps.
+    """
+    if not 1 <= limit <= 100:
+        raise HTTPException(status_code=400, detail="limit must be between 1 and 100")
+    before_row = None
+    if cursor:
+        try:
+            before_row = int(cursor)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+    return await portrait_service.ledger.list_history(
+        request_context.client_id.get(),
+        model=model,
+        style=style,
+        since=since,
+        until=until,
+        cursor=before_row,
+        limit=limit
+    )
+
+async def own_generation(generation_id: str) -> Dict[str, Any]:
+    """The calling client's ledger record for generation_id; other clients' records are a 404 too"""
+    record = await portrait_service.ledger.get(generation_id)
+    if not record or record.get("client_id") != request_context.client_id.get():
+        raise HTTPException(status_code=404, detail="Generation not found")
+    return record
+
+@app.get("/generations/{generation_id}")
+async def get_generation(generation_id: str):
+    """Look up one of the calling client's generations by its generation_id"""
+    return await own_generation(generation_id)
+
+@app.get("/outputs/{name}")
+async def local_output(name: str):
+    """Serve an image produced by the local fallback backend"""
+    path = os.path.join(config.FALLBACK_OUTPUT_DIR, os.path.basename(name))
+    if not os.path.isfile(path):
+        raise HTTPException(status_code=404, detail="Output not found")
+    return FileResponse(path, media_type="image/jpeg", headers={"Cache-Control": IMMUTABLE_CACHE_CONTROL})
+
+@app.get("/generations/{generation_id}/renditions/{size}")
+async def get_rendition(generation_id: str, size: int, request: Request, format: Optional[str] = None):
+    """Serve a resized copy of a generation's output.
+
+    The size is rounded up to the nearest configured rendition. Without a
+    ``format`` the best one the client's Accept header allows is picked.
+    """
+    try:
+        image_format = renditions.pick_format(format, request.headers.get("accept", ""))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    size = renditions.pick_size(size)
+    # Checked before If-None-Match, or a 304 would confirm another client's generation exists
+    record = await own_generation(generation_id)
+    etag = f'"{generation_id}-{size}.{image_format}"'
+    # Private: only the generation's owner may be served it, so shared caches must not keep it
+    headers = {"Cache-Control": PRIVATE_IMMUTABLE_CACHE_CONTROL, "ETag": etag, "Vary": "Accept"}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+
+    try:
+        content = await renditions.get(generation_id, record.get("image_url"), size, image_format)
+    except RenditionNotFoundError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except ServiceUnavailableError as e:
+        raise unavailable(e)
+    except Exception as e:
+        print(f"[Renditions] Failed to render {generation_id}: {str(e)}")
+        raise HTTPException(status_code=502, detail=f"Could not render output image: {str(e)}")
+    return Response(content=content, media_type=RENDITION_CONTENT_TYPES[image_format], headers=headers)
+
+@app.get("/healthz")
+async def healthz():
+    """Liveness: the process is up and serving, with its current load"""
+    return health.snapshot()
+
+@app.get("/readyz")
+async def readyz():
+    """Readiness: fails with 503 while the instance is too saturated for new work or draining"""
+    snapshot = health.snapshot()
+    if drain.draining:
+        snapshot["status"] = "draining"
+        return JSONResponse(status_code=503, content=snapshot, headers={"Retry-After": str(drain.retry_after)})
+    if snapshot["reasons"]:
+        return JSONResponse(status_code=503, content=snapshot, headers={"Retry-After": str(health.retry_after)})
+    return snapshot
+
+def require_admin(request: Request):
+    if not is_admin(request, config.ADMIN_TOKEN):
+        raise HTTPException(status_code=403, detail="Admin token required")
+
+@app.get("/admin/profiles")
+async def list_profiles(request: Request):
+    """Recent request profiles, newest first"""
+    require_admin(request)
+    return {"profiles": profiles.list()}
+
+@app.get("/admin/profiles/{profile_id}")
+async def get_profile(request: Request, profile_id: str, format: str = "pstats"):
+    """Download a request profile: ``pstats`` for snakeviz or ``pstats.Stats``, ``text`` for a listing"""
+    require_admin(request)
+    profile = profiles.get(profile_id)
+    if profile is None:
+        raise HTTPException(status_code=404, detail="Profile not found")
+    if format == "text":
+        return Response(content=profile.text(), media_type="text/plain")
+    if format != "pstats":
+        raise HTTPException(status_code=400, detail="format must be pstats or text")
+    return Response(
+        content=profile.data,
+        media_type="application/octet-stream",
+        headers={"Content-Disposition": f'attachment; filename="{profile_id}.prof"'}
+    )
+
+@app.get("/metrics")
+async def get_metrics():
+    """Get runtime metrics for the service"""
+    return {
+        "spool": portrait_service.spool.stats(),
+        "memory": portrait_service.memory.stats(),
+        "references": portrait_service.references.stats(),
+        "scheduler": portrait_service.scheduler.stats(),
+        "retries": portrait_service.retry_policy.stats(),
+        "ledger": portrait_service.ledger.stats(),
+        "renditions": renditions.stats(),
+        "deadlines": deadlines.stats(),
+        "degradation": portrait_service.degradation_stats(),
+        "drain": drain.stats(),
+        "idempotency": idempotency.stats(),
+        "profiles": profiles.stats(),
+        "event_loop": loop_lag.stats(),
+        "face_gate": portrait_service.face_gate.stats(),
+        "phash_index": portrait_service.phash_index.stats() if portrait_service.phash_index else None,
+        "capture": capture.stats() if capture else None
     }
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
+    server = DrainingServer(
+        uvicorn.Config(app, host="0.0.0.0", port=8000, timeout_graceful_shutdown=int(config.DRAIN_GRACE_PERIOD)),
+        drain
+    )
+    server.run()
\ No newline at end of file
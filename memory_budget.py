@@ -0,0 +1,152 @@
+import asyncio
+import contextlib
+import io
+from collections import defaultdict, deque
+from typing import Any, AsyncIterator, BinaryIO, Deque, Dict, Tuple, Union
+
+from PIL import Image
+
+import deadlines
+from errors import ServiceUnavailableError
+
+JPEG_SIGNATURE = b"\xff\xd8\xff"
+
+
+class MemoryBudgetExceededError(ServiceUnavailableError):
+    """Raised when image bytes could not be reserved within the wait timeout"""
+
+
+def estimate_decoded_bytes(content: Union[bytes, BinaryIO]) -> int:
+    """Bytes a decoded copy of an encoded image will take, read from its header only.
+
+    ``content`` is the encoded image or a seekable file holding it, such as
+    a spooled upload; the file is left at the position it was found at.
+    """
+    if isinstance(content, bytes):
+        source, fallback = io.BytesIO(content), len(content)
+    else:
+        source, fallback = content, 0
+    position = source.tell()
+    try:
+        width, height = Image.open(source).size
+    except Exception:
+        return fallback
+    finally:
+        source.seek(position)
+    # Assume four bands; most images decode to RGB or RGBA
+    return width * height * 4
+
+
+def is_jpeg(content: Union[bytes, BinaryIO]) -> bool:
+    """Whether an encoded image is a JPEG, the only format ``draft`` can decode at a reduced scale"""
+    if isinstance(content, bytes):
+        return content.startswith(JPEG_SIGNATURE)
+    position = content.tell()
+    try:
+        return content.read(len(JPEG_SIGNATURE)) == JPEG_SIGNATURE
+    finally:
+        content.seek(position)
+
+
+class MemoryBudget:
+    """Process-wide accountant for image bytes held in memory.
+
+    Work that buffers uploads, decodes images or downloads outputs reserves
+    an estimate of its footprint first. Reservations that do not fit wait in
+    FIFO order, so a large upload is not starved by a stream of small ones,
+    and fail with a 503 once ``wait_timeout`` passes. A reservation larger
+    than the whole budget is capped to it and simply runs alone.
+
+    Never wait for a reservation while holding another: with FIFO waiters,
+    a few holders asking for more can block each other until they all time
+    out. Reserve the whole footprint up front, or release the first
+    reservation before taking the next.
+    """
+
+    def __init__(self, limit_bytes: int, wait_timeout: float):
+        self.limit_bytes = limit_bytes
+        self.wait_timeout = wait_timeout
+        self.in_use = 0
+        self.peak = 0
+        self.in_use_by_kind: Dict[str, int] = defaultdict(int)
+        self._waiters: Deque[Tuple[int, asyncio.Future]] = deque()
+        self.granted = 0
+        self.waited = 0
+        self.rejected = 0
+
+    def _grant(self, nbytes: int):
+        self.in_use += nbytes
+        self.peak = max(self.peak, self.in_use)
+        self.granted += 1
+
+    def _wake_waiters(self):
+        while self._waiters:
+            nbytes, future = self._waiters[0]
+            if future.done():
+                self._waiters.popleft()
+                continue
+            if self.in_use + nbytes > self.limit_bytes:
+                break
+            self._waiters.popleft()
+            self._grant(nbytes)
+            future.set_result(None)
+
+    async def _acquire(self, nbytes: int):
+        if not self._waiters and self.in_use + nbytes <= self.limit_bytes:
+            self._grant(nbytes)
+            return
+        deadlines.check("waiting for memory")
+        wait_timeout = deadlines.bound(self.wait_timeout)
+        if wait_timeout <= 0:
+            self.rejected += 1
+            raise MemoryBudgetExceededError("Server is busy processing other images, please retry shortly")
+
+        self.waited += 1
+        future = asyncio.get_running_loop().create_future()
+        self._waiters.append((nbytes, future))
+        try:
+            await asyncio.wait_for(asyncio.shield(future), timeout=wait_timeout)
+        except asyncio.TimeoutError:
+            if future.done():
+                # Granted just as the wait timed out; hand the bytes back
+                self._release(nbytes)
+            else:
+                future.cancel()
+                self._wake_waiters()
+            self.rejected += 1
+            raise MemoryBudgetExceededError("Server is busy processing other images, please retry shortly")
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self._release(nbytes)
+            else:
+                future.cancel()
+                self._wake_waiters()
+            raise
+
+    def _release(self, nbytes: int):
+        self.in_use -= nbytes
+        self._wake_waiters()
+
+    @contextlib.asynccontextmanager
+    async def reserve(self, nbytes: int, kind: str) -> AsyncIterator[None]:
+        """Hold ``nbytes`` of the budget for the duration of the block"""
+        nbytes = min(max(nbytes, 0), self.limit_bytes)
+        await self._acquire(nbytes)
+        self.in_use_by_kind[kind] += nbytes
+        try:
+            yield
+        finally:
+            self.in_use_by_kind[kind] -= nbytes
+            self._release(nbytes)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "limit_bytes": self.limit_bytes,
+            "in_use_bytes": self.in_use,
+            "peak_bytes": self.peak,
+            "in_use_by_kind": dict(self.in_use_by_kind),
+            "waiting": sum(1 for _, future in self._waiters if not future.done()),
+            "granted": self.granted,
+            "waited": self.waited,
+            "rejected": self.rejected,
+        }
@@ -0,0 +1,218 @@
+import asyncio
+import collections
+import io
+import json
+import os
+import time
+import uuid
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+
+from PIL import Image, ImageOps
+
+HASH_BITS = 64
+
+
+def dhash(content: bytes) -> int:
+    """64-bit difference hash of an image: the sign of each horizontal gradient on a 9x8 thumbnail.
+
+    Survives re-encoding, resizing and mild recompression, which is what a
+    phone does to a photo it uploads twice. JPEG sources are decoded at a
+    reduced scale with ``draft``, so this takes a few milliseconds; other
+    formats are decoded in full first.
+    """
+    image = Image.open(io.BytesIO(content))
+    image.draft("L", (64, 64))
+    image = ImageOps.exif_transpose(image).convert("L").resize((9, 8), Image.BOX)
+    pixels = list(image.getdata())
+    value = 0
+    for row in range(8):
+        for column in range(8):
+            left = pixels[row * 9 + column]
+            right = pixels[row * 9 + column + 1]
+            value = (value << 1) | (left > right)
+    return value
+
+
+def _chunk_spans(chunks: int) -> List[Tuple[int, int]]:
+    """(shift, mask) of each chunk when a hash is cut into ``chunks`` nearly equal runs of bits"""
+    spans = []
+    start = 0
+    for index in range(chunks):
+        width = HASH_BITS // chunks + (1 if index < HASH_BITS % chunks else 0)
+        spans.append((start, (1 << width) - 1))
+        start += width
+    return spans
+
+
+class IndexEntry:
+    __slots__ = ("entry_id", "client_id", "phash", "value", "created_at")
+
+    def __init__(self, entry_id: str, client_id: str, phash: int, value: Dict[str, Any], created_at: float):
+        self.entry_id = entry_id
+        self.client_id = client_id
+        self.phash = phash
+        self.value = value
+        self.created_at = created_at
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "entry_id": self.entry_id,
+            "client_id": self.client_id,
+            "phash": f"{self.phash:016x}",
+            "value": self.value,
+            "created_at": self.created_at,
+        }
+
+
+class PerceptualIndex:
+    """Finds earlier images within ``max_distance`` bits of a perceptual hash.
+
+    Multi-index hashing: each hash is cut into ``max_distance + 1`` chunks,
+    and every chunk value is looked up in its own table. Two hashes within
+    ``max_distance`` bits of each other must agree exactly on at least one
+    chunk, so only the entries sharing a chunk are compared bit by bit.
+    Unlike a BK-tree, removing an entry is as cheap as adding one.
+
+    Matches are only returned for the same client. Entries are kept in LRU
+    order and the least recently used is evicted past ``max_entries``;
+    ``on_evict`` sees each evicted entry. With a ``path``, the index is
+    saved as a JSON snapshot every ``save_interval`` seconds while it has
+    changes, and at shutdown, then loaded at startup.
+    """
+
+    def __init__(self, max_distance: int, max_entries: int, path: Optional[str] = None,
+                 save_interval: float = 60.0, on_evict: Optional[Callable[[IndexEntry], None]] = None):
+        self.max_distance = max_distance
+        self.max_entries = max_entries
+        self.path = path
+        self.save_interval = save_interval
+        self.on_evict = on_evict
+        self.spans = _chunk_spans(max_distance + 1)
+        self.tables: List[Dict[int, Set[str]]] = [collections.defaultdict(set) for _ in self.spans]
+        self.entries: "collections.OrderedDict[str, IndexEntry]" = collections.OrderedDict()
+        self.dirty = False
+        self._task: Optional[asyncio.Task] = None
+        self.lookups = 0
+        self.hits = 0
+        self.evicted = 0
+        self.lookup_seconds = 0.0
+
+    def _chunks(self, phash: int) -> List[int]:
+        return [(phash >> shift) & mask for shift, mask in self.spans]
+
+    def add(self, client_id: str, phash: int, value: Dict[str, Any]) -> IndexEntry:
+        entry = IndexEntry(uuid.uuid4().hex, client_id, phash, value, time.time())
+        self._insert(entry)
+        while len(self.entries) > self.max_entries:
+            _, evicted = self.entries.popitem(last=False)
+            self._unlink(evicted)
+            self.evicted += 1
+            if self.on_evict:
+                self.on_evict(evicted)
+        self.dirty = True
+        return entry
+
+    def _insert(self, entry: IndexEntry):
+        self.entries[entry.entry_id] = entry
+        for table, chunk in zip(self.tables, self._chunks(entry.phash)):
+            table[chunk].add(entry.entry_id)
+
+    def _unlink(self, entry: IndexEntry):
+        for table, chunk in zip(self.tables, self._chunks(entry.phash)):
+            bucket = table.get(chunk)
+            if bucket is not None:
+                bucket.discard(entry.entry_id)
+                if not bucket:
+                    del table[chunk]
+
+    def remove(self, entry: IndexEntry):
+        if self.entries.pop(entry.entry_id, None) is not None:
+            self._unlink(entry)
+            self.dirty = True
+
+    def find(self, client_id: str, phash: int) -> Optional[Tuple[IndexEntry, int]]:
+        """The client's closest entry within ``max_distance`` bits, with its distance"""
+        started = time.perf_counter()
+        best: Optional[Tuple[IndexEntry, int]] = None
+        seen: Set[str] = set()
+        for table, chunk in zip(self.tables, self._chunks(phash)):
+            for entry_id in table.get(chunk, ()):
+                if entry_id in seen:
+                    continue
+                seen.add(entry_id)
+                entry = self.entries[entry_id]
+                if entry.client_id != client_id:
+                    continue
+                distance = (entry.phash ^ phash).bit_count()
+                if distance <= self.max_distance and (best is None or distance < best[1]):
+                    best = (entry, distance)
+        self.lookups += 1
+        self.lookup_seconds += time.perf_counter() - started
+        if best is not None:
+            self.hits += 1
+            self.entries.move_to_end(best[0].entry_id)
+        return best
+
+    def _save(self, entries: List[Dict[str, Any]]):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(self.path + ".tmp", "w") as f:
+            json.dump({"max_distance": self.max_distance, "entries": entries}, f, separators=(",", ":"))
+        os.replace(self.path + ".tmp", self.path)
+
+    def _load(self) -> List[Dict[str, Any]]:
+        try:
+            with open(self.path) as f:
+                return json.load(f)["entries"]
+        except FileNotFoundError:
+            return []
+        except (ValueError, KeyError) as e:
+            print(f"[PerceptualIndex] Ignoring unreadable snapshot {self.path}: {e}")
+            return []
+
+    async def save(self):
+        if not self.path or not self.dirty:
+            return
+        self.dirty = False
+        loop = asyncio.get_running_loop()
+        entries = [entry.to_dict() for entry in self.entries.values()]
+        try:
+            await loop.run_in_executor(None, self._save, entries)
+        except OSError as e:
+            self.dirty = True
+            print(f"[PerceptualIndex] Failed to save {self.path}: {e}")
+
+    async def _autosave(self):
+        while True:
+            await asyncio.sleep(self.save_interval)
+            await self.save()
+
+    async def start(self):
+        if not self.path:
+            return
+        loop = asyncio.get_running_loop()
+        for record in (await loop.run_in_executor(None, self._load))[-self.max_entries:]:
+            self._insert(IndexEntry(
+                record["entry_id"], record["client_id"], int(record["phash"], 16),
+                record["value"], record["created_at"]
+            ))
+        print(f"[PerceptualIndex] Loaded {len(self.entries)} entries from {self.path}")
+        if self._task is None:
+            self._task = asyncio.create_task(self._autosave())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+        await self.save()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "entries": len(self.entries),
+            "max_distance": self.max_distance,
+            "lookups": self.lookups,
+            "hits": self.hits,
+            "evicted": self.evicted,
+            "mean_lookup_us": round(self.lookup_seconds / self.lookups * 1e6, 1) if self.lookups else 0.0,
+        }
@@ -1,34 +1,629 @@
 import replicate
 import os
 import uuid
-import aiofiles
-from typing import Dict, Any, Optional
+from typing import Dict, Any, List, Optional, Union
 from config import Config
+from spool import SpoolManager
+from scheduler import FairScheduler, QueueTimeoutError
+from circuit_breaker import CircuitBreaker, CircuitOpenError
+from errors import ServiceUnavailableError
+from retry_policy import RetryBudget, RetryPolicy, UpstreamUnavailableError, is_input_error, retry_after_hint
+import request_context
+import deadlines
+import profiling
+from deadlines import DeadlineExceededError
+from references import ReferenceHandle, ReferenceStore, StoredReference, hash_file, normalize_reference_image
+from ledger import GenerationLedger
+from memory_budget import MemoryBudget
+from inference_backends import FakeBackend, InferenceBackend, LocalFallbackBackend, ReplicateBackend
+from drain import ShuttingDownError
+from face_gate import FaceCheck, FaceCheckError, FaceGate
+from perceptual_index import IndexEntry, PerceptualIndex, dhash
 from PIL import Image
 import io
-import zipfile
-import tempfile
 import asyncio
-import signal
 from concurrent.futures import ThreadPoolExecutor, TimeoutError
-import gc
+from typing import Callable
+import contextlib
+import contextvars
+import time
+import random
+
+# Decoding, orientation and resizing a reference keep about two decoded copies alive at once
+REFERENCE_DECODED_COPIES = 2
+
+
+def _write_atomically(path: str, content: bytes):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + ".tmp", "wb") as f:
+        f.write(content)
+    os.replace(path + ".tmp", path)
+
 
 class PortraitGenerationService:
     def __init__(self):
         self.config = Config()
         os.environ["REPLICATE_API_TOKEN"] = self.config.REPLICATE_API_TOKEN
+        self.backend = self._create_backend(self.config.INFERENCE_BACKEND)
+        self.fallback = LocalFallbackBackend(
+            self.config.FALLBACK_OUTPUT_DIR, self.config.FALLBACK_MAX_OUTPUTS
+        ) if self.config.FALLBACK_ENABLED else None
+        if self.backend.degraded:
+            self.fallback = self.backend
+        self._saturated_since: Optional[float] = None
+        self.degraded_generations = 0
+        # Set once the instance is shutting down; no new prediction starts after it
+        self.stopping = False
+        self.spool = SpoolManager(
+            self.config.SPOOL_DIR,
+            max_bytes=self.config.SPOOL_MAX_BYTES,
+            max_age=self.config.SPOOL_MAX_AGE,
+            janitor_interval=self.config.SPOOL_JANITOR_INTERVAL,
+            wait_timeout=self.config.SPOOL_WAIT_TIMEOUT
+        )
+        self.references = ReferenceStore(self.config.REFERENCE_TTL, self.config.REFERENCE_MAX_ENTRIES)
+        self.memory = MemoryBudget(self.config.MEMORY_BUDGET_BYTES, self.config.MEMORY_BUDGET_WAIT_TIMEOUT)
+        self.face_gate = FaceGate(
+            self.config.FACE_GATE_MODE,
+            workers=self.config.FACE_GATE_WORKERS,
+            max_side=self.config.FACE_GATE_MAX_SIDE,
+            min_face_ratio=self.config.FACE_GATE_MIN_FACE_RATIO,
+            timeout=self.config.FACE_GATE_TIMEOUT
+        )
+        self.phash_index = PerceptualIndex(
+            self.config.PHASH_MAX_DISTANCE,
+            self.config.PHASH_INDEX_MAX_ENTRIES,
+            path=os.path.join(self.config.PHASH_INDEX_DIR, "index.json") if self.config.PHASH_INDEX_DIR else None,
+            on_evict=self._forget_reference_image
+        ) if self.config.PHASH_INDEX_MAX_ENTRIES > 0 else None
+        
+        # All predictions share one executor; the scheduler decides whose call gets a thread next
+        self.executor = ThreadPoolExecutor(
+            max_workers=self.config.MAX_CONCURRENT_PREDICTIONS,
+            thread_name_prefix="replicate"
+        )
+        self.scheduler = FairScheduler(
+            capacity=self.config.MAX_CONCURRENT_PREDICTIONS,
+            weights=self.config.CLIENT_WEIGHTS,
+            default_weight=self.config.CLIENT_DEFAULT_WEIGHT,
+            max_concurrency=self.config.CLIENT_MAX_CONCURRENCY,
+            rate=self.config.CLIENT_RATE_LIMIT,
+            burst=self.config.CLIENT_RATE_BURST,
+            max_queue_per_client=self.config.CLIENT_MAX_QUEUE,
+            queue_timeout=self.config.SCHEDULER_QUEUE_TIMEOUT
+        )
+        self.breakers = {
+            model_key: CircuitBreaker(
+                model_key,
+                window_seconds=self.config.BREAKER_WINDOW_SECONDS,
+                min_calls=self.config.BREAKER_MIN_CALLS,
+                failure_rate=self.config.BREAKER_FAILURE_RATE,
+                open_seconds=self.config.BREAKER_OPEN_SECONDS,
+                half_open_calls=self.config.BREAKER_HALF_OPEN_CALLS
+            )
+            for model_key in self.config.MODELS
+        }
+        self.ledger = GenerationLedger(
+            self.config.LEDGER_PATH,
+            batch_size=self.config.LEDGER_BATCH_SIZE,
+            flush_interval=self.config.LEDGER_FLUSH_INTERVAL,
+            max_pending=self.config.LEDGER_MAX_PENDING
+        )
+        self.retry_policy = RetryPolicy(
+            max_attempts=self.config.RETRY_MAX_ATTEMPTS,
+            base_delay=self.config.RETRY_BASE_DELAY,
+            max_delay=self.config.RETRY_MAX_DELAY,
+            time_budget=self.config.RETRY_TIME_BUDGET,
+            budget=RetryBudget(self.config.RETRY_BUDGET_RATIO, self.config.RETRY_BUDGET_MIN_RETRIES)
+        )
+    
+    def _create_backend(self, name: str) -> InferenceBackend:
+        if name == "fake":
+            print("[Service] Using the fake backend; no real predictions will be made")
+            return FakeBackend(self.config.FAKE_BACKEND_LATENCY, failure_rate=self.config.FAKE_BACKEND_FAILURE_RATE)
+        if name == "local":
+            print("[Service] Using the local backend; every generation is degraded")
+            return LocalFallbackBackend(self.config.FALLBACK_OUTPUT_DIR, self.config.FALLBACK_MAX_OUTPUTS)
+        if name != "replicate":
+            raise ValueError(f"Unknown inference backend: {name}")
+        return ReplicateBackend(self.config.PREDICTION_POLL_INTERVAL)
     
     async def save_uploaded_image(self, image_content: bytes) -> str:
-        """Save uploaded image and return the file path"""
-        image_id = str(uuid.uuid4())
-        temp_path = f"temp_{image_id}.jpg"
+        """Save uploaded image to the spool and return the file path"""
+        return await self.spool.write(image_content)
+    
+
+    
+    async def upload_reference(self, image_path: str) -> ReferenceHandle:
+        """Upload a reference image once so several predictions can share it"""
+        loop = asyncio.get_running_loop()
+        handle = await loop.run_in_executor(None, ReferenceHandle.from_file, image_path)
+        print(f"[Reference] Uploaded {image_path} ({handle.size} bytes)")
+        return handle
+    
+    async def create_reference(self, image_content: bytes) -> StoredReference:
+        """Face-check, normalize and upload an image once, keeping it for reuse across requests.
+
+        A near-duplicate of one of the client's earlier references is
+        answered with that reference instead. The caller's memory reservation
+        must cover ``REFERENCE_DECODED_COPIES`` of the image.
+        """
+        phash = await self.perceptual_hash(image_content)
+        reference = await self.similar_reference(phash)
+        if reference is not None:
+            return reference
+        face_check = await self.face_gate.check(image_content)
+        loop = asyncio.get_running_loop()
+        normalized, width, height = await loop.run_in_executor(
+            None, normalize_reference_image, image_content, self.config.REFERENCE_MAX_SIDE
+        )
+        handle = await loop.run_in_executor(None, ReferenceHandle.from_bytes, normalized)
+        reference = self.references.add(handle, width, height, face_check)
+        print(f"[Reference] Stored {reference.reference_id} ({width}x{height}, {handle.size} bytes)")
+        if phash is not None:
+            await self._index_reference(phash, reference, normalized)
+        return reference
+    
+    def delete_reference(self, reference_id: str) -> bool:
+        """Forget a reference everywhere: the store, the perceptual-hash index and its cached image.
+
+        Returns whether there was anything to delete. Without its index
+        entry, a later near-duplicate upload is stored as a new reference
+        rather than bringing this one back.
+        """
+        deleted = self.references.remove(reference_id)
+        if self.phash_index is not None:
+            for entry in [entry for entry in self.phash_index.entries.values()
+                          if entry.value["reference_id"] == reference_id]:
+                self.phash_index.remove(entry)
+                self._forget_reference_image(entry)
+                deleted = True
+        return deleted
+    
+    async def perceptual_hash(self, image_content: bytes) -> Optional[int]:
+        """dHash of an upload, or None when the index is off or the image cannot be read"""
+        if self.phash_index is None:
+            return None
+        loop = asyncio.get_running_loop()
+        try:
+            return await loop.run_in_executor(None, dhash, image_content)
+        except Exception:
+            # Unreadable images are reported by the regular upload path
+            return None
+    
+    async def reuse_reference(self, image_content: bytes) -> Optional[StoredReference]:
+        """A stored reference that a plain upload is a near-duplicate of, if any"""
+        if self.phash_index is None or not self.phash_index.entries:
+            return None
+        return await self.similar_reference(await self.perceptual_hash(image_content))
+    
+    async def similar_reference(self, phash: Optional[int]) -> Optional[StoredReference]:
+        """The client's reference within PHASH_MAX_DISTANCE bits of ``phash``, if any.
+
+        A reference that expired from the store is restored under a new id
+        from its cached normalized image, when PHASH_INDEX_DIR is set; a
+        deleted one has no entry or cached image left to match. Raises
+        FaceCheckError if the gate enforces and the reference failed its check.
+        """
+        if phash is None:
+            return None
+        match = self.phash_index.find(request_context.client_id.get(), phash)
+        if match is None:
+            return None
+        entry, distance = match
+        reference = self.references.get(entry.value["reference_id"]) or await self._restore_reference(entry)
+        if reference is None:
+            self.phash_index.remove(entry)
+            return None
+        face_check = reference.face_check
+        if face_check and face_check.problem and self.face_gate.enabled and self.face_gate.mode == "enforce":
+            raise FaceCheckError(face_check)
+        reference.reuses += 1
+        print(f"[Reference] Reusing {reference.reference_id} for a near-duplicate upload ({distance} bits apart)")
+        return reference
+    
+    def _reference_image_path(self, sha256: str) -> Optional[str]:
+        if not self.config.PHASH_INDEX_DIR:
+            return None
+        return os.path.join(self.config.PHASH_INDEX_DIR, f"{sha256}.jpg")
+    
+    async def _index_reference(self, phash: int, reference: StoredReference, normalized: bytes):
+        """Index a new reference, caching its normalized image so it outlives the store"""
+        path = self._reference_image_path(reference.handle.sha256)
+        if path:
+            loop = asyncio.get_running_loop()
+            try:
+                await loop.run_in_executor(None, _write_atomically, path, normalized)
+            except OSError as e:
+                print(f"[Reference] Failed to cache {path}: {e}")
+        face_check = reference.face_check
+        self.phash_index.add(request_context.client_id.get(), phash, {
+            "reference_id": reference.reference_id,
+            "sha256": reference.handle.sha256,
+            "width": reference.width,
+            "height": reference.height,
+            "faces": [list(box) for box in face_check.faces] if face_check else None,
+        })
+    
+    async def _restore_reference(self, entry: IndexEntry) -> Optional[StoredReference]:
+        path = self._reference_image_path(entry.value["sha256"])
+        if path is None:
+            return None
+        loop = asyncio.get_running_loop()
+        try:
+            handle = await loop.run_in_executor(None, ReferenceHandle.from_file, path)
+        except OSError:
+            return None
+        faces = entry.value["faces"]
+        face_check = FaceCheck(
+            [tuple(box) for box in faces], self.config.FACE_GATE_MIN_FACE_RATIO, 0.0
+        ) if faces is not None else None
+        reference = self.references.add(handle, entry.value["width"], entry.value["height"], face_check)
+        entry.value["reference_id"] = reference.reference_id
+        self.phash_index.dirty = True
+        print(f"[Reference] Restored {reference.reference_id} from {path}")
+        return reference
+    
+    def _forget_reference_image(self, entry: IndexEntry):
+        """Delete an evicted entry's cached image unless another entry shares it"""
+        path = self._reference_image_path(entry.value["sha256"])
+        if path is None or any(other.value["sha256"] == entry.value["sha256"] for other in self.phash_index.entries.values()):
+            return
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(path)
+    
+    async def _run_prediction(self, model_key: str, run_replicate: Callable[[], Any], timeout: float) -> Any:
+        """Run a replicate call, retrying transient provider errors with backoff.
+
+        Retries are bounded by the attempt limit, the per-request time budget
+        and the global retry budget. A transient error that outlives them is
+        raised as UpstreamUnavailableError so the client gets a 503.
+
+        Calls to a model whose circuit is open fail immediately. The breaker
+        sees one outcome per call, whatever the number of attempts, so one
+        request's retries cannot open the circuit for everyone.
+        """
+        breaker = self.breakers[model_key]
+        breaker.allow()
+        started = time.monotonic()
+        self.retry_policy.budget.record_request()
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                output = await self._attempt_prediction(model_key, run_replicate, timeout)
+            except Exception as e:
+                delay, retryable = self.retry_policy.next_delay(e, attempt, time.monotonic() - started)
+                left = deadlines.remaining()
+                if delay is not None and left is not None and delay >= left:
+                    # The client will have given up before the retry could finish
+                    delay = None
+                if delay is None:
+                    self._record_outcome(breaker, e)
+                    if retryable:
+                        raise UpstreamUnavailableError(
+                            f"{model_key} is temporarily unavailable: {e}",
+                            retry_after=retry_after_hint(e)
+                        ) from e
+                    raise
+                print(f"[Retry] {model_key} attempt {attempt} failed ({e}), retrying in {delay:.1f}s")
+                try:
+                    await asyncio.sleep(delay)
+                except BaseException:
+                    breaker.record_abandoned()
+                    raise
+                continue
+            except BaseException:
+                # Cancelled while waiting on the model
+                breaker.record_abandoned()
+                raise
+            breaker.record_success()
+            return output
+    
+    @staticmethod
+    def _record_outcome(breaker: CircuitBreaker, error: BaseException):
+        """Record a call's final error with the model's breaker"""
+        if isinstance(error, (DeadlineExceededError, ServiceUnavailableError)):
+            # Never reached the provider, or stopped waiting for it: the client's deadline,
+            # queueing limits or shutdown
+            breaker.record_abandoned()
+        elif isinstance(error, asyncio.TimeoutError):
+            breaker.record_failure(timed_out=True)
+        elif is_input_error(error):
+            # The provider refused this request's input; that says nothing about its health
+            breaker.record_neutral()
+        else:
+            # Transport errors, 5xx, 429 and failed predictions, ModelError included
+            breaker.record_failure()
+    
+    async def _attempt_prediction(self, model_key: str, run_replicate: Callable[[], Any], timeout: float) -> Any:
+        """Run a blocking replicate call on the shared executor under the fair-share scheduler.
+
+        The slot is held until the worker thread finishes, even if we stop
+        waiting for it, so the scheduler never hands out more slots than
+        threads. Breaker outcomes are left to ``_run_prediction``.
+        """
+        deadlines.check("queueing")
+        if self.stopping:
+            raise ShuttingDownError("Server is shutting down, please retry")
+        client = await self.scheduler.acquire(request_context.client_id.get(), request_context.deadline.get())
         
-        async with aiofiles.open(temp_path, 'wb') as f:
-            await f.write(image_content)
+        # The client's deadline, if sooner, also bounds the call. The worker
+        # thread sees it too, so the backend can cancel the remote prediction.
+        attempt_timeout = deadlines.bound(timeout)
+        context = contextvars.copy_context()
+        context.run(request_context.deadline.set, time.monotonic() + attempt_timeout)
         
-        return temp_path
+        loop = asyncio.get_running_loop()
+        try:
+            if attempt_timeout <= 0:
+                raise deadlines.expired("prediction")
+            if self.stopping:
+                # Shutdown began while this call was queued
+                raise ShuttingDownError("Server is shutting down, please retry")
+            future = self.executor.submit(context.run, profiling.in_thread(run_replicate))
+        except BaseException:
+            self.scheduler.release(client)
+            raise
+        future.add_done_callback(lambda _: loop.call_soon_threadsafe(self.scheduler.release, client))
+        
+        try:
+            return await asyncio.wait_for(asyncio.wrap_future(future), timeout=attempt_timeout)
+        except asyncio.TimeoutError:
+            if attempt_timeout < timeout:
+                # The client's deadline ran out, not the model's time
+                raise deadlines.expired("prediction completed")
+            raise
+        except DeadlineExceededError:
+            raise
+        except Exception as e:
+            if self.stopping:
+                # Cancelled by the shutdown drain, not a failure of the model
+                raise ShuttingDownError("Server shut down before the prediction finished, please retry") from e
+            raise
+    
+    def stop_predictions(self) -> int:
+        """Refuse new predictions and cancel the remote ones still running; returns how many were cancelled"""
+        self.stopping = True
+        return self.backend.cancel_all()
     
+    def _degrade_reason(self, model_key: str) -> Optional[str]:
+        """Why model_key should be served by the local fallback right now, if it should"""
+        if not self.fallback:
+            return None
+        if self.breakers[model_key].state == CircuitBreaker.OPEN:
+            return f"{model_key} circuit is open"
+        
+        # Saturation only counts once the backlog has stayed high for a while
+        if self.scheduler.queue_depth() < self.config.FALLBACK_QUEUE_DEPTH:
+            self._saturated_since = None
+            return None
+        now = time.monotonic()
+        if self._saturated_since is None:
+            self._saturated_since = now
+        if now - self._saturated_since >= self.config.FALLBACK_SATURATION_SECONDS:
+            return f"provider saturated for {now - self._saturated_since:.0f}s"
+        return None
+    
+    async def generate(self, model_key: str, image_path: Union[str, ReferenceHandle], prompt: str,
+                       negative_prompt: str, style: str = "realistic",
+                       run_id: Optional[str] = None, allow_fallback: bool = True,
+                       fallback_reason: Optional[str] = None, num_variants: int = 1,
+                       seeds: Optional[List[int]] = None) -> Dict[str, Any]:
+        """Generate a portrait with one model and record the outcome in the ledger.
+
+        While the provider is saturated or the model's circuit is open, or
+        once a call fails for lack of provider capacity, the local fallback
+        serves a degraded result instead, unless ``allow_fallback`` is off.
+        Passing ``fallback_reason`` goes straight to the fallback.
+
+        ``num_variants`` above one, or explicit ``seeds``, returns several
+        variants; see ``_generate_variants``.
+        """
+        generate_with = {
+            "instantid": self.generate_with_instantid,
+            "ipadapter": self.generate_with_ipadapter,
+            "instantid2": self.generate_with_instantid2,
+            "ipadapter2": self.generate_with_ipadapter2
+        }.get(model_key)
+        if not generate_with and not fallback_reason:
+            raise ValueError(f"Unknown model: {model_key}")
+        if self.backend.degraded:
+            fallback_reason = fallback_reason or "the local backend is configured"
+        elif allow_fallback and not fallback_reason and generate_with:
+            fallback_reason = self._degrade_reason(model_key)
+        
+        if isinstance(image_path, ReferenceHandle):
+            inputs_hash = image_path.sha256
+        else:
+            loop = asyncio.get_running_loop()
+            inputs_hash = await loop.run_in_executor(None, hash_file, image_path)
+        
+        entry = {
+            "created_at": time.time(),
+            "client_id": request_context.client_id.get(),
+            "model": model_key,
+            "style": self.recorded_style(style),
+            "prompt": prompt,
+            "negative_prompt": negative_prompt,
+            "params": {**self.config.DEFAULT_PARAMS.get(model_key, {}), "num_variants": num_variants},
+            "inputs_hash": inputs_hash,
+            "run_id": run_id
+        }
+        face_check = request_context.face_check.get()
+        if face_check is not None:
+            entry["face_box"] = list(face_check.face_box) if face_check.face_box else None
+        started = time.monotonic()
+        try:
+            if fallback_reason:
+                result = await self.generate_with_fallback(model_key, image_path, style, fallback_reason)
+            else:
+                try:
+                    if num_variants > 1 or seeds:
+                        result = await self._generate_variants(
+                            model_key, generate_with, image_path, prompt, negative_prompt, num_variants, seeds
+                        )
+                    else:
+                        result = await generate_with(image_path, prompt, negative_prompt)
+                except (CircuitOpenError, UpstreamUnavailableError, QueueTimeoutError) as e:
+                    if not (allow_fallback and self.fallback):
+                        raise
+                    result = await self.generate_with_fallback(model_key, image_path, style, str(e))
+        except Exception as e:
+            entry.update({
+                "generation_id": str(uuid.uuid4()),
+                "status": "failed",
+                "error": str(e),
+                "duration_ms": round((time.monotonic() - started) * 1000)
+            })
+            self.ledger.record(entry)
+            raise
+        
+        if "variants" not in result:
+            result["variants"] = [{
+                "image_url": str(result["image_url"]),
+                "seed": None if result.get("degraded") else self.config.DEFAULT_PARAMS.get(model_key, {}).get("seed")
+            }]
+        if face_check is not None:
+            result["face_box"] = list(face_check.face_box) if face_check.face_box else None
+            if face_check.problem:
+                result["warnings"] = [face_check.message]
+        entry.update({
+            "generation_id": result["generation_id"],
+            "status": "succeeded",
+            "model_used": result["model_used"],
+            "image_url": str(result["image_url"]),
+            "degraded": result.get("degraded", False),
+            "variants": result["variants"],
+            "duration_ms": round((time.monotonic() - started) * 1000)
+        })
+        self.ledger.record(entry)
+        return result
+    
+    async def _generate_variants(self, model_key: str, generate_with: Callable, image_path: Union[str, ReferenceHandle],
+                                 prompt: str, negative_prompt: str, num_variants: int,
+                                 seeds: Optional[List[int]]) -> Dict[str, Any]:
+        """Generate several variants with as few predictions as the model allows.
 
+        Models that accept ``num_outputs`` get the variants in batches of up to
+        ``max_outputs`` per prediction, one seed per batch. Other models, or
+        requests with a distinct seed per variant, make one prediction per
+        variant, at most ``VARIANT_MAX_CONCURRENCY`` at a time. Each variant
+        reports the seed that reproduces it. Failed calls are dropped as long
+        as at least one variant succeeds.
+        """
+        model = self.config.MODELS[model_key]
+        seed_param = model.get("seed_param")
+        max_outputs = model.get("max_outputs", 1)
+        if seeds and len(seeds) == 1 and max_outputs == 1:
+            seeds = [seeds[0] + i for i in range(num_variants)]
+        
+        # (num_outputs, seed) for each prediction
+        if max_outputs > 1 and (not seeds or len(seeds) == 1):
+            first_seed = seeds[0] if seeds else random.randint(0, 2**31 - 1)
+            calls = [
+                (min(max_outputs, num_variants - start), first_seed + batch)
+                for batch, start in enumerate(range(0, num_variants, max_outputs))
+            ]
+        else:
+            seeds = seeds or [random.randint(0, 2**31 - 1) for _ in range(num_variants)]
+            calls = [(1, seed) for seed in seeds]
+        
+        concurrency = asyncio.Semaphore(self.config.VARIANT_MAX_CONCURRENCY)
+        
+        async def run_call(num_outputs: int, seed: int) -> Dict[str, Any]:
+            extra_input = {}
+            if num_outputs > 1:
+                extra_input["num_outputs"] = num_outputs
+            if seed_param:
+                extra_input[seed_param] = seed
+            async with concurrency:
+                return await generate_with(image_path, prompt, negative_prompt, extra_input=extra_input)
+        
+        print(f"[Variants] {model_key}: {num_variants} variants in {len(calls)} prediction(s)")
+        outcomes = await asyncio.gather(
+            *(profiling.profiled(run_call(n, seed)) for n, seed in calls), return_exceptions=True
+        )
+        
+        variants = []
+        first_result = None
+        for (num_outputs, seed), outcome in zip(calls, outcomes):
+            if isinstance(outcome, BaseException):
+                print(f"[Variants] {model_key} prediction with seed {seed} failed: {outcome}")
+                continue
+            first_result = first_result or outcome
+            for batch_index, image_url in enumerate(outcome["output_urls"][:num_outputs]):
+                variant = {"image_url": image_url, "seed": seed if seed_param else None}
+                if num_outputs > 1:
+                    variant["batch_index"] = batch_index
+                variants.append(variant)
+        if not first_result:
+            raise next(outcome for outcome in outcomes if isinstance(outcome, BaseException))
+        
+        return {
+            **first_result,
+            "image_url": variants[0]["image_url"],
+            "generation_id": str(uuid.uuid4()),
+            "variants": variants,
+            "predictions": len(calls)
+        }
+    
+    async def generate_with_fallback(self, model_key: str, image_path: Union[str, ReferenceHandle],
+                                     style: str, reason: str) -> Dict[str, Any]:
+        """Stylize the reference locally in place of a model the provider cannot serve"""
+        deadlines.check("fallback")
+        print(f"[Fallback] Serving {model_key} locally: {reason}")
+        
+        face_check = request_context.face_check.get()
+        face_box = face_check.face_box if face_check is not None else None
+        
+        def run_local():
+            with self.open_reference(image_path) as img_file:
+                return self.fallback.run(
+                    "local-fallback",
+                    input={"image": img_file, "style": style, "width": 640, "height": 640, "face_box": face_box}
+                )
+        
+        # The default executor, since the prediction threads are what is saturated
+        loop = asyncio.get_running_loop()
+        output = await loop.run_in_executor(None, run_local)
+        self.degraded_generations += 1
+        return {
+            "image_url": output[0],
+            "model_used": "Local Fallback (degraded)",
+            "model_description": f"Quick local stylization served because {reason}",
+            "generation_id": str(uuid.uuid4()),
+            "degraded": True
+        }
+    
+    def degradation_stats(self) -> Dict[str, Any]:
+        return {
+            "backend": self.backend.name,
+            "fallback_enabled": self.fallback is not None,
+            "degraded_generations": self.degraded_generations,
+            "saturated_for_seconds": round(time.monotonic() - self._saturated_since, 1) if self._saturated_since else 0
+        }
+    
+    def _output_urls(self, output: Any) -> List[str]:
+        """Every image URL in a model's output, in order"""
+        if hasattr(output, 'url'):
+            return [output.url()]
+        if isinstance(output, str):
+            return [output.strip()]
+        try:
+            return [str(item).strip() for item in output]
+        except TypeError:
+            return [str(output)]
+    
+    def open_reference(self, image: Union[str, ReferenceHandle]):
+        """Context manager yielding the value to pass as a model's image input"""
+        if isinstance(image, ReferenceHandle):
+            return contextlib.nullcontext(image.url)
+        return open(image, "rb")
+    
+    def recorded_style(self, style: str) -> str:
+        """The style to record for a generation: unknown styles are generated, and recorded, as realistic"""
+        return style if style in self.config.PROMPT_TEMPLATES else "realistic"
     
     def get_prompt(self, style: str, custom_prompt: Optional[str] = None) -> str:
         """Get appropriate prompt based on style"""
@@ -48,30 +643,29 @@ class PortraitGenerationService:
         
         return base_negative
     
-    async def generate_with_instantid(self, image_path: str, prompt: str, negative_prompt: str) -> Dict[str, Any]:
+    async def generate_with_instantid(self, image_path: Union[str, ReferenceHandle], prompt: str, negative_prompt: str,
+                              extra_input: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
         """Generate portrait using InstantID model"""
         try:
             params = self.config.DEFAULT_PARAMS["instantid"].copy()
             print("[InstantID] About to call replicate.run() with params:", params)
             
-            # Run replicate in a thread with timeout
-            loop = asyncio.get_event_loop()
-            with ThreadPoolExecutor() as executor:
-                def run_replicate():
-                    with open(image_path, "rb") as img_file:
-                        return replicate.run(
-                            self.config.MODELS["instantid"]["model_id"],
-                            input={
-                                "image": img_file,
-                                "width": 640,
-                                "height": 640,
-                                "prompt": prompt,
-                                "negative_prompt": negative_prompt
-                            }
-                        )
-                
-                future = loop.run_in_executor(executor, run_replicate)
-                output = await asyncio.wait_for(future, timeout=300)  # 5 minute timeout
+            def run_replicate():
+                with self.open_reference(image_path) as img_file:
+                    return self.backend.run(
+                        self.config.MODELS["instantid"]["model_id"],
+                        input={
+                            "image": img_file,
+                            "width": 640,
+                            "height": 640,
+                            "prompt": prompt,
+                            "negative_prompt": negative_prompt,
+                            **(extra_input or {})
+                        }
+                    )
+            
+            # Run replicate on the shared executor once the scheduler grants a slot
+            output = await self._run_prediction("instantid", run_replicate, timeout=self.config.PREDICTION_TIMEOUT)
             
             print("[InstantID] replicate.run() output:", output)
             print("[InstantID] Output type:", type(output))
@@ -98,82 +692,86 @@ class PortraitGenerationService:
             return {
                 "image_url": image_url,
                 "model_used": "InstantID",
+                "output_urls": self._output_urls(output),
                 "model_description": self.config.MODELS["instantid"]["description"],
                 "generation_id": str(uuid.uuid4())
             }
+        except ServiceUnavailableError:
+            raise
         except asyncio.TimeoutError:
-            print("[InstantID] Timeout after 5 minutes!")
-            raise Exception("InstantID generation timed out after 5 minutes")
+            print(f"[InstantID] Timeout after {self.config.PREDICTION_TIMEOUT:.0f}s!")
+            raise Exception(f"InstantID generation timed out after {self.config.PREDICTION_TIMEOUT:.0f}s")
         except Exception as e:
             print(f"[InstantID] Exception: {e}")
             raise Exception(f"InstantID generation failed: {str(e)}")
     
 
     
-    async def generate_with_ipadapter(self, image_path: str, prompt: str, negative_prompt: str) -> Dict[str, Any]:
+    async def generate_with_ipadapter(self, image_path: Union[str, ReferenceHandle], prompt: str, negative_prompt: str,
+                              extra_input: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
         """Generate portrait using IP-Adapter SDXL Face model"""
         try:
             params = self.config.DEFAULT_PARAMS["ipadapter"].copy()
             print("[IP-Adapter] About to call replicate.run() with params:", params)
             
-            # Run replicate in a thread with timeout
-            loop = asyncio.get_event_loop()
-            with ThreadPoolExecutor() as executor:
-                def run_replicate():
-                    with open(image_path, "rb") as img_file:
-                        return replicate.run(
-                            self.config.MODELS["ipadapter"]["model_id"],
-                            input={
-                                "image": img_file,
-                                "prompt": prompt,
-                                "negative_prompt": negative_prompt,
-                                **params
-                            }
-                        )
-                
-                future = loop.run_in_executor(executor, run_replicate)
-                output = await asyncio.wait_for(future, timeout=300)  # 5 minute timeout
+            def run_replicate():
+                with self.open_reference(image_path) as img_file:
+                    return self.backend.run(
+                        self.config.MODELS["ipadapter"]["model_id"],
+                        input={
+                            "image": img_file,
+                            "prompt": prompt,
+                            "negative_prompt": negative_prompt,
+                            **params,
+                            **(extra_input or {})
+                        }
+                    )
+            
+            # Run replicate on the shared executor once the scheduler grants a slot
+            output = await self._run_prediction("ipadapter", run_replicate, timeout=self.config.PREDICTION_TIMEOUT)
             
             print("[IP-Adapter] replicate.run() output:", output)
             return {
                 "image_url": output[0],
                 "model_used": "IP-Adapter SDXL Face",
+                "output_urls": self._output_urls(output),
                 "model_description": self.config.MODELS["ipadapter"]["description"],
                 "generation_id": str(uuid.uuid4())
             }
+        except ServiceUnavailableError:
+            raise
         except asyncio.TimeoutError:
-            print("[IP-Adapter] Timeout after 5 minutes!")
-            raise Exception("IP-Adapter generation timed out after 5 minutes")
+            print(f"[IP-Adapter] Timeout after {self.config.PREDICTION_TIMEOUT:.0f}s!")
+            raise Exception(f"IP-Adapter generation timed out after {self.config.PREDICTION_TIMEOUT:.0f}s")
         except Exception as e:
             print(f"[IP-Adapter] Exception: {e}")
             raise Exception(f"IP-Adapter generation failed: {str(e)}")
     
 
     
-    async def generate_with_instantid2(self, image_path: str, prompt: str, negative_prompt: str) -> Dict[str, Any]:
+    async def generate_with_instantid2(self, image_path: Union[str, ReferenceHandle], prompt: str, negative_prompt: str,
+                              extra_input: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
         """Generate portrait using InstantID MultiControlNet model"""
         try:
             params = self.config.DEFAULT_PARAMS["instantid2"].copy()
             print("[InstantID2] About to call replicate.run() with params:", params)
             
-            # Run replicate in a thread with timeout
-            loop = asyncio.get_event_loop()
-            with ThreadPoolExecutor() as executor:
-                def run_replicate():
-                    with open(image_path, "rb") as img_file:
-                        return replicate.run(
-                            self.config.MODELS["instantid2"]["model_id"],
-                            input={
-                                "face_image_path": img_file,
-                                "width": 640,
-                                "height": 640,
-                                "prompt": prompt,
-                                "negative_prompt": negative_prompt
-                            }
-                        )
-                
-                future = loop.run_in_executor(executor, run_replicate)
-                output = await asyncio.wait_for(future, timeout=300)  # 5 minute timeout
+            def run_replicate():
+                with self.open_reference(image_path) as img_file:
+                    return self.backend.run(
+                        self.config.MODELS["instantid2"]["model_id"],
+                        input={
+                            "face_image_path": img_file,
+                            "width": 640,
+                            "height": 640,
+                            "prompt": prompt,
+                            "negative_prompt": negative_prompt,
+                            **(extra_input or {})
+                        }
+                    )
+            
+            # Run replicate on the shared executor once the scheduler grants a slot
+            output = await self._run_prediction("instantid2", run_replicate, timeout=self.config.PREDICTION_TIMEOUT)
             
             print("[InstantID2] replicate.run() output:", output)
             print("[InstantID2] Output type:", type(output))
@@ -203,12 +801,15 @@ class PortraitGenerationService:
             return {
                 "image_url": image_url,
                 "model_used": "InstantID MultiControlNet",
+                "output_urls": self._output_urls(output),
                 "model_description": self.config.MODELS["instantid2"]["description"],
                 "generation_id": str(uuid.uuid4())
             }
+        except ServiceUnavailableError:
+            raise
         except asyncio.TimeoutError:
-            print("[InstantID2] Timeout after 5 minutes!")
-            raise Exception("InstantID2 generation timed out after 5 minutes")
+            print(f"[InstantID2] Timeout after {self.config.PREDICTION_TIMEOUT:.0f}s!")
+            raise Exception(f"InstantID2 generation timed out after {self.config.PREDICTION_TIMEOUT:.0f}s")
         except Exception as e:
             print(f"[InstantID2] Exception: {e}")
             print(f"[InstantID2] Exception type: {type(e).__name__}")
@@ -220,27 +821,26 @@ class PortraitGenerationService:
             else:
                 raise Exception(f"InstantID2 generation failed: {str(e)}")
     
-    async def generate_with_ipadapter2(self, image_path: str, prompt: str = "", negative_prompt: str = "") -> Dict[str, Any]:
+    async def generate_with_ipadapter2(self, image_path: Union[str, ReferenceHandle], prompt: str = "", negative_prompt: str = "",
+                                       extra_input: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
         """Generate portrait using IP-Adapter Plus Face model"""
         try:
             params = self.config.DEFAULT_PARAMS["ipadapter2"].copy()
             print("[IP-Adapter2] About to call replicate.run() with params:", params)
             
-            # Run replicate in a thread with timeout
-            loop = asyncio.get_event_loop()
-            with ThreadPoolExecutor() as executor:
-                def run_replicate():
-                    with open(image_path, "rb") as img_file:
-                        return replicate.run(
-                            self.config.MODELS["ipadapter2"]["model_id"],
-                            input={
-                                "image": img_file,
-                                "output_format": "png"
-                            }
-                        )
-                
-                future = loop.run_in_executor(executor, run_replicate)
-                output = await asyncio.wait_for(future, timeout=300)  # 5 minute timeout
+            def run_replicate():
+                with self.open_reference(image_path) as img_file:
+                    return self.backend.run(
+                        self.config.MODELS["ipadapter2"]["model_id"],
+                        input={
+                            "image": img_file,
+                            "output_format": "png",
+                            **(extra_input or {})
+                        }
+                    )
+            
+            # Run replicate on the shared executor once the scheduler grants a slot
+            output = await self._run_prediction("ipadapter2", run_replicate, timeout=self.config.PREDICTION_TIMEOUT)
             
             print("[IP-Adapter2] replicate.run() output:", output)
             
@@ -259,17 +859,20 @@ class PortraitGenerationService:
             return {
                 "image_url": image_url,
                 "model_used": "IP-Adapter Plus Face",
+                "output_urls": self._output_urls(output),
                 "model_description": self.config.MODELS["ipadapter2"]["description"],
                 "generation_id": str(uuid.uuid4())
             }
+        except ServiceUnavailableError:
+            raise
         except asyncio.TimeoutError:
-            print("[IP-Adapter2] Timeout after 5 minutes!")
-            raise Exception("IP-Adapter2 generation timed out after 5 minutes")
+            print(f"[IP-Adapter2] Timeout after {self.config.PREDICTION_TIMEOUT:.0f}s!")
+            raise Exception(f"IP-Adapter2 generation timed out after {self.config.PREDICTION_TIMEOUT:.0f}s")
         except Exception as e:
             print(f"[IP-Adapter2] Exception: {e}")
             raise Exception(f"IP-Adapter2 generation failed: {str(e)}")
     
-    async def generate_portrait_runall(self, image_path: str, style: str = "realistic",
+    async def generate_portrait_runall(self, image_path: Union[str, ReferenceHandle], style: str = "realistic",
                                      custom_prompt: Optional[str] = None,
                                      custom_negative: Optional[str] = None) -> Dict[str, Any]:
         """Generate portraits using all models and select the best result"""
@@ -284,76 +887,160 @@ class PortraitGenerationService:
             results = {}
             successful_models = 0
             total_models = 4  # We now have 4 models total
+            run_id = str(uuid.uuid4())
+            started = time.monotonic()
+            entry = {
+                "generation_id": run_id,
+                "created_at": time.time(),
+                "client_id": request_context.client_id.get(),
+                "model": "runall",
+                "style": self.recorded_style(style),
+                "prompt": unified_prompt,
+                "negative_prompt": unified_negative_prompt,
+                "inputs_hash": image_path.sha256 if isinstance(image_path, ReferenceHandle) else None,
+                "run_id": run_id
+            }
             
-            # Generate with InstantID
-            try:
-                results["instantid"] = await self.generate_with_instantid(
-                    image_path, unified_prompt, unified_negative_prompt
-                )
-                successful_models += 1
-                print(f"[Run All] InstantID completed successfully ({successful_models}/{total_models})")
-            except Exception as e:
-                results["instantid"] = {"error": str(e)}
-                print(f"[Run All] InstantID failed: {str(e)}")
-            
-            # Generate with IP-Adapter
-            try:
-                results["ipadapter"] = await self.generate_with_ipadapter(
-                    image_path, unified_prompt, unified_negative_prompt
+            # Upload the reference once and share the handle across all models;
+            # stored references are already uploaded and owned by the store
+            if isinstance(image_path, ReferenceHandle):
+                successful_models = await self._run_all_models(
+                    image_path, unified_prompt, unified_negative_prompt, style, run_id, results, total_models
                 )
-                successful_models += 1
-                print(f"[Run All] IP-Adapter completed successfully ({successful_models}/{total_models})")
-            except Exception as e:
-                results["ipadapter"] = {"error": str(e)}
-                print(f"[Run All] IP-Adapter failed: {str(e)}")
+            else:
+                # The handle holds a base64 copy of the file for the whole run
+                async with self.memory.reserve(os.path.getsize(image_path) * 4 // 3, "reference"):
+                    reference = await self.upload_reference(image_path)
+                    entry["inputs_hash"] = reference.sha256
+                    try:
+                        successful_models = await self._run_all_models(
+                            reference, unified_prompt, unified_negative_prompt, style, run_id, results, total_models
+                        )
+                    finally:
+                        reference.release()
             
-            # Generate with InstantID2
-            try:
-                results["instantid2"] = await self.generate_with_instantid2(
-                    image_path, unified_prompt, unified_negative_prompt
-                )
-                successful_models += 1
-                print(f"[Run All] InstantID2 completed successfully ({successful_models}/{total_models})")
-            except Exception as e:
-                error_msg = str(e)
-                if "network" in error_msg.lower() or "nodename" in error_msg.lower():
-                    results["instantid2"] = {"error": "InstantID2 requires additional network access that is not available. Try using InstantID instead."}
-                else:
-                    results["instantid2"] = {"error": error_msg}
-                print(f"[Run All] InstantID2 failed: {error_msg}")
+            print(f"[Run All] Generation complete: {successful_models}/{total_models} models succeeded")
             
-            # Generate with IP-Adapter2
-            try:
-                results["ipadapter2"] = await self.generate_with_ipadapter2(
-                    image_path, unified_prompt, unified_negative_prompt
-                )
-                successful_models += 1
-                print(f"[Run All] IP-Adapter2 completed successfully ({successful_models}/{total_models})")
-            except Exception as e:
-                results["ipadapter2"] = {"error": str(e)}
-                print(f"[Run All] IP-Adapter2 failed: {str(e)}")
+            # Select the best result
+            best_result = self.select_best_result(results)
             
-            print(f"[Run All] Generation complete: {successful_models}/{total_models} models succeeded")
+            # The run's own record points at the best result and each model's generation,
+            # so the returned generation_id can be looked up and rendered like any other
+            entry.update({
+                "status": "succeeded" if best_result else "failed",
+                "runs": {model_name: result.get("generation_id") for model_name, result in results.items()},
+                "duration_ms": round((time.monotonic() - started) * 1000)
+            })
+            if best_result:
+                entry.update({
+                    "model_used": best_result["model_used"],
+                    "image_url": str(best_result["image_url"]),
+                    "degraded": best_result.get("degraded", False)
+                })
+            self.ledger.record(entry)
             
             # Check if we have at least one successful generation
-            if successful_models == 0:
+            if not best_result:
+                deadlines.check("any model finished")
                 raise Exception("All models failed to generate portraits. Please try again or check your input image.")
             
-            # Select the best result
-            best_result = self.select_best_result(results)
-            if best_result:
-                results["best"] = best_result
-                print(f"[Run All] Selected best result: {best_result['model_used']}")
+            results["best"] = best_result
+            print(f"[Run All] Selected best result: {best_result['model_used']}")
             
             return {
                 "runall_results": results,
-                "generation_id": str(uuid.uuid4()),
+                "generation_id": run_id,
                 "successful_models": successful_models,
                 "total_models": total_models
             }
+        except ServiceUnavailableError:
+            raise
         except Exception as e:
             raise Exception(f"Run All generation failed: {str(e)}")
     
+    async def _run_all_models(self, reference: ReferenceHandle, unified_prompt: str,
+                              unified_negative_prompt: str, style: str, run_id: str,
+                              results: Dict[str, Any], total_models: int) -> int:
+        """Run every model against the shared reference, filling results; returns the success count"""
+        successful_models = 0
+        
+        # Generate with InstantID
+        try:
+            results["instantid"] = await self.generate(
+                "instantid", reference, unified_prompt, unified_negative_prompt, style=style, run_id=run_id,
+                allow_fallback=False
+            )
+            successful_models += 1
+            print(f"[Run All] InstantID completed successfully ({successful_models}/{total_models})")
+        except CircuitOpenError as e:
+            results["instantid"] = {"error": str(e), "skipped": True}
+            print(f"[Run All] InstantID skipped, circuit open")
+        except Exception as e:
+            results["instantid"] = {"error": str(e)}
+            print(f"[Run All] InstantID failed: {str(e)}")
+        
+        # Generate with IP-Adapter
+        try:
+            results["ipadapter"] = await self.generate(
+                "ipadapter", reference, unified_prompt, unified_negative_prompt, style=style, run_id=run_id,
+                allow_fallback=False
+            )
+            successful_models += 1
+            print(f"[Run All] IP-Adapter completed successfully ({successful_models}/{total_models})")
+        except CircuitOpenError as e:
+            results["ipadapter"] = {"error": str(e), "skipped": True}
+            print(f"[Run All] IP-Adapter skipped, circuit open")
+        except Exception as e:
+            results["ipadapter"] = {"error": str(e)}
+            print(f"[Run All] IP-Adapter failed: {str(e)}")
+        
+        # Generate with InstantID2
+        try:
+            results["instantid2"] = await self.generate(
+                "instantid2", reference, unified_prompt, unified_negative_prompt, style=style, run_id=run_id,
+                allow_fallback=False
+            )
+            successful_models += 1
+            print(f"[Run All] InstantID2 completed successfully ({successful_models}/{total_models})")
+        except CircuitOpenError as e:
+            results["instantid2"] = {"error": str(e), "skipped": True}
+            print(f"[Run All] InstantID2 skipped, circuit open")
+        except Exception as e:
+            error_msg = str(e)
+            if "network" in error_msg.lower() or "nodename" in error_msg.lower():
+                results["instantid2"] = {"error": "InstantID2 requires additional network access that is not available. Try using InstantID instead."}
+            else:
+                results["instantid2"] = {"error": error_msg}
+            print(f"[Run All] InstantID2 failed: {error_msg}")
+        
+        # Generate with IP-Adapter2
+        try:
+            results["ipadapter2"] = await self.generate(
+                "ipadapter2", reference, unified_prompt, unified_negative_prompt, style=style, run_id=run_id,
+                allow_fallback=False
+            )
+            successful_models += 1
+            print(f"[Run All] IP-Adapter2 completed successfully ({successful_models}/{total_models})")
+        except CircuitOpenError as e:
+            results["ipadapter2"] = {"error": str(e), "skipped": True}
+            print(f"[Run All] IP-Adapter2 skipped, circuit open")
+        except Exception as e:
+            results["ipadapter2"] = {"error": str(e)}
+            print(f"[Run All] IP-Adapter2 failed: {str(e)}")
+        
+        # A degraded portrait beats none when every model failed
+        if successful_models == 0 and self.fallback:
+            try:
+                results["fallback"] = await self.generate(
+                    "local", reference, unified_prompt, unified_negative_prompt, style=style, run_id=run_id,
+                    fallback_reason="every model failed"
+                )
+            except Exception as e:
+                results["fallback"] = {"error": str(e)}
+                print(f"[Run All] Local fallback failed: {str(e)}")
+        
+        return successful_models
+    
     def select_best_result(self, results: Dict[str, Any]) -> Optional[Dict[str, Any]]:
         """Select the best result from all successful generations"""
         successful_results = []
@@ -384,8 +1071,4 @@ class PortraitGenerationService:
     
     def cleanup_temp_file(self, file_path: str):
         """Clean up temporary file"""
-        try:
-            if os.path.exists(file_path):
-                os.remove(file_path)
-        except Exception:
-            pass 
\ No newline at end of file
+        self.spool.release(file_path) 
\ No newline at end of file
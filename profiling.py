@@ -0,0 +1,252 @@
+import collections
+import cProfile
+import hmac
+import io
+import marshal
+import pstats
+import random
+import threading
+import time
+import uuid
+from typing import Any, Awaitable, Callable, Deque, Dict, List, Optional
+
+from starlette.requests import Request
+
+import request_context
+
+
+class RequestProfile:
+    """cProfile data for one request's own work.
+
+    The event loop interleaves many requests, so a profiler left running on
+    it would mix them up. Instead the loop-side profiler only runs during
+    the steps of this request's coroutines (see ``profiled``), and every
+    executor hop gets its own profiler in its thread (see ``in_thread``).
+    Both are merged into one ``pstats`` profile when the request finishes.
+    """
+
+    def __init__(self, method: str, path: str, reason: str):
+        self.profile_id = uuid.uuid4().hex[:12]
+        self.method = method
+        self.path = path
+        self.reason = reason
+        self.client_id = request_context.client_id.get()
+        self.created_at = time.time()
+        self.started = time.monotonic()
+        self.wall_seconds = 0.0
+        self.status = 0
+        self.loop_steps = 0
+        self.thread_calls = 0
+        self.thread_seconds = 0.0
+        self.data = b""
+        self._loop_profiler = cProfile.Profile()
+        self._depth = 0
+        self._thread_profilers: List[cProfile.Profile] = []
+        self._lock = threading.Lock()
+
+    def enter(self):
+        if self._depth == 0:
+            self._loop_profiler.enable()
+        self._depth += 1
+        self.loop_steps += 1
+
+    def exit(self):
+        self._depth -= 1
+        if self._depth == 0:
+            self._loop_profiler.disable()
+
+    def add_thread(self, profiler: cProfile.Profile, seconds: float):
+        with self._lock:
+            self._thread_profilers.append(profiler)
+            self.thread_calls += 1
+            self.thread_seconds += seconds
+
+    def finish(self, status: int):
+        """Merge the profilers into a marshalled ``pstats`` profile"""
+        self.status = status
+        self.wall_seconds = time.monotonic() - self.started
+        stats = None
+        with self._lock:
+            profilers = [self._loop_profiler] + self._thread_profilers
+            self._thread_profilers = []
+        for profiler in profilers:
+            profiler.create_stats()
+            if not profiler.stats:
+                continue
+            if stats is None:
+                stats = pstats.Stats(profiler)
+            else:
+                stats.add(profiler)
+        self.data = marshal.dumps(stats.stats) if stats else marshal.dumps({})
+
+    def text(self, limit: int = 60) -> str:
+        """The profile as a ``pstats`` listing, sorted by cumulative time"""
+        output = io.StringIO()
+        output.write(f"{self.method} {self.path} -> {self.status} in {self.wall_seconds:.3f}s "
+                     f"({self.loop_steps} loop steps, {self.thread_calls} executor calls "
+                     f"taking {self.thread_seconds:.3f}s)\n\n")
+        stats = pstats.Stats(stream=output)
+        stats.stats = marshal.loads(self.data)
+        if stats.stats:
+            stats.get_top_level_stats()
+            stats.sort_stats("cumulative").print_stats(limit)
+        return output.getvalue()
+
+    def summary(self) -> Dict[str, Any]:
+        return {
+            "profile_id": self.profile_id,
+            "method": self.method,
+            "path": self.path,
+            "status": self.status,
+            "reason": self.reason,
+            "client_id": self.client_id,
+            "created_at": self.created_at,
+            "wall_seconds": round(self.wall_seconds, 4),
+            "loop_steps": self.loop_steps,
+            "executor_calls": self.thread_calls,
+            "executor_seconds": round(self.thread_seconds, 4),
+            "size_bytes": len(self.data),
+        }
+
+
+class _ProfiledCoroutine:
+    """Awaitable that runs a coroutine with the request's loop profiler on during each step"""
+
+    __slots__ = ("coro", "profile")
+
+    def __init__(self, coro: Awaitable, profile: RequestProfile):
+        self.coro = coro
+        self.profile = profile
+
+    def __await__(self):
+        coro = self.coro.__await__()
+        value, error = None, None
+        while True:
+            self.profile.enter()
+            try:
+                if error is not None:
+                    yielded = coro.throw(error)
+                else:
+                    yielded = coro.send(value)
+            except StopIteration as e:
+                return e.value
+            finally:
+                self.profile.exit()
+            try:
+                value, error = (yield yielded), None
+            except BaseException as e:
+                value, error = None, e
+
+
+def profiled(coro: Awaitable) -> Awaitable:
+    """Profile a coroutine's steps if the current request is being profiled.
+
+    Needed for coroutines that run as tasks of their own, e.g. under
+    ``asyncio.gather``; everything awaited inline is already covered.
+    """
+    profile = request_context.profile.get()
+    if profile is None:
+        return coro
+    return _ProfiledCoroutine(coro, profile)
+
+
+def in_thread(fn: Callable[[], Any]) -> Callable[[], Any]:
+    """Profile ``fn`` in the executor thread it runs on if the current request is being profiled"""
+    profile = request_context.profile.get()
+    if profile is None:
+        return fn
+
+    def run():
+        profiler = cProfile.Profile()
+        started = time.monotonic()
+        profiler.enable()
+        try:
+            return fn()
+        finally:
+            profiler.disable()
+            profile.add_thread(profiler, time.monotonic() - started)
+    return run
+
+
+class ProfileStore:
+    """The most recent request profiles, kept in memory for download"""
+
+    def __init__(self, max_kept: int):
+        self.profiles: Deque[RequestProfile] = collections.deque(maxlen=max_kept)
+        self.by_reason: Dict[str, int] = collections.Counter()
+
+    def add(self, profile: RequestProfile):
+        self.profiles.append(profile)
+        self.by_reason[profile.reason] += 1
+
+    def get(self, profile_id: str) -> Optional[RequestProfile]:
+        for profile in self.profiles:
+            if profile.profile_id == profile_id:
+                return profile
+        return None
+
+    def list(self) -> List[Dict[str, Any]]:
+        return [profile.summary() for profile in reversed(self.profiles)]
+
+    def stats(self) -> Dict[str, Any]:
+        return {"kept": len(self.profiles), "captured": dict(self.by_reason)}
+
+
+def is_admin(request: Request, admin_token: str) -> bool:
+    """Whether the request carries the admin token; always false when none is configured"""
+    supplied = request.headers.get("x-admin-token", "")
+    return bool(admin_token) and hmac.compare_digest(supplied.encode(), admin_token.encode())
+
+
+class ProfilingMiddleware:
+    """Profiles requests sent with ``X-Profile: 1`` by an admin, and a sample of generation requests.
+
+    Added right after CORS, so it runs innermost, in the same task as the
+    endpoint: everything the endpoint awaits inline is profiled. The
+    response carries ``X-Profile-Id`` for fetching the profile from
+    ``/admin/profiles/{id}``. Not installed at all while profiling is off.
+    """
+
+    def __init__(self, app: Any, store: ProfileStore, admin_token: str, sample_rate: float,
+                 sampled_prefixes=("/generate-portrait", "/references")):
+        self.app = app
+        self.store = store
+        self.admin_token = admin_token
+        self.sample_rate = sample_rate
+        self.sampled_prefixes = sampled_prefixes
+
+    def _reason(self, scope) -> Optional[str]:
+        request = Request(scope)
+        if request.headers.get("x-profile") == "1" and is_admin(request, self.admin_token):
+            return "requested"
+        if (self.sample_rate and scope["method"] == "POST" and scope["path"].startswith(self.sampled_prefixes)
+                and random.random() < self.sample_rate):
+            return "sampled"
+        return None
+
+    async def __call__(self, scope, receive, send):
+        reason = self._reason(scope) if scope["type"] == "http" else None
+        if reason is None:
+            return await self.app(scope, receive, send)
+
+        profile = RequestProfile(scope["method"], scope["path"], reason)
+        status = 500
+
+        async def send_with_id(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                message["headers"] = list(message.get("headers", [])) + [
+                    (b"x-profile-id", profile.profile_id.encode("ascii"))
+                ]
+            await send(message)
+
+        token = request_context.profile.set(profile)
+        try:
+            await _ProfiledCoroutine(self.app(scope, receive, send_with_id), profile)
+        finally:
+            request_context.profile.reset(token)
+            profile.finish(status)
+            self.store.add(profile)
+            print(f"[Profile] {profile.method} {profile.path} profiled as {profile.profile_id} "
+                  f"({profile.reason}, {profile.wall_seconds:.3f}s)")
@@ -0,0 +1,162 @@
+import base64
+import hashlib
+import io
+import time
+import uuid
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+
+from PIL import Image, ImageOps
+
+# Magic numbers of the formats we expect to receive as reference images
+IMAGE_SIGNATURES = (
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"GIF8", "image/gif"),
+    (b"RIFF", "image/webp"),
+)
+
+
+def sniff_mime_type(content: bytes) -> str:
+    """Guess an image MIME type from its leading bytes"""
+    for signature, mime_type in IMAGE_SIGNATURES:
+        if content.startswith(signature):
+            return mime_type
+    return "image/jpeg"
+
+
+class ReferenceHandle:
+    """A reference image uploaded once and shared by several predictions.
+
+    The Replicate client in use has no file storage API, so the upload is a
+    data URL built once; every model input that receives ``url`` skips
+    re-reading and re-encoding the file.
+    """
+
+    def __init__(self, url: str, size: int, sha256: str):
+        self.url: Optional[str] = url
+        self.size = size
+        self.sha256 = sha256
+
+    @classmethod
+    def from_bytes(cls, content: bytes) -> "ReferenceHandle":
+        encoded = base64.b64encode(content).decode("ascii")
+        return cls(
+            f"data:{sniff_mime_type(content)};base64,{encoded}",
+            len(content),
+            hashlib.sha256(content).hexdigest()
+        )
+
+    @classmethod
+    def from_file(cls, path: str) -> "ReferenceHandle":
+        with open(path, "rb") as f:
+            return cls.from_bytes(f.read())
+
+    def release(self):
+        """Drop the uploaded payload; the handle must not be used afterwards"""
+        self.url = None
+
+
+def hash_file(path: str) -> str:
+    """SHA-256 of a file's contents"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def normalize_reference_image(content: bytes, max_side: int) -> Tuple[bytes, int, int]:
+    """Apply EXIF orientation, convert to RGB and cap the longest side.
+
+    Returns the re-encoded JPEG bytes with the final width and height.
+    Raises ValueError if the content is not a readable image.
+    """
+    try:
+        image = Image.open(io.BytesIO(content))
+        image = ImageOps.exif_transpose(image)
+    except Exception as e:
+        raise ValueError(f"Invalid reference image: {e}")
+
+    if image.mode != "RGB":
+        image = image.convert("RGB")
+    image.thumbnail((max_side, max_side), Image.LANCZOS)
+
+    output = io.BytesIO()
+    image.save(output, format="JPEG", quality=95)
+    return output.getvalue(), image.width, image.height
+
+
+class StoredReference:
+    """A normalized, uploaded reference image addressable by id until it expires"""
+
+    def __init__(self, handle: ReferenceHandle, width: int, height: int, ttl: float, face_check: Any = None):
+        self.reference_id = str(uuid.uuid4())
+        self.handle = handle
+        self.width = width
+        self.height = height
+        # FaceCheck from the upload, reused by every generation from this reference
+        self.face_check = face_check
+        # Near-duplicate uploads answered with this reference instead of a new one
+        self.reuses = 0
+        self.created_at = time.time()
+        self.expires_at = self.created_at + ttl
+
+    def to_dict(self) -> Dict[str, object]:
+        return {
+            "reference_id": self.reference_id,
+            "expires_at": self.expires_at,
+            "ttl_seconds": max(0, int(self.expires_at - time.time())),
+            "width": self.width,
+            "height": self.height,
+            "size": self.handle.size,
+            "face_check": self.face_check.to_dict() if self.face_check else None,
+            "reuses": self.reuses,
+        }
+
+
+class ReferenceStore:
+    """Bounded in-memory store of reusable references with a fixed TTL.
+
+    Expired entries are dropped lazily; when the store is full the oldest
+    reference is evicted. Handles are not released on eviction because a
+    generation may still be using them.
+    """
+
+    def __init__(self, ttl: float, max_entries: int):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.references: "OrderedDict[str, StoredReference]" = OrderedDict()
+
+    def add(self, handle: ReferenceHandle, width: int, height: int, face_check: Any = None) -> StoredReference:
+        self.purge_expired()
+        while len(self.references) >= self.max_entries:
+            self.references.popitem(last=False)
+        reference = StoredReference(handle, width, height, self.ttl, face_check)
+        self.references[reference.reference_id] = reference
+        return reference
+
+    def get(self, reference_id: str) -> Optional[StoredReference]:
+        reference = self.references.get(reference_id)
+        if reference and reference.expires_at <= time.time():
+            del self.references[reference_id]
+            return None
+        return reference
+
+    def remove(self, reference_id: str) -> bool:
+        return self.references.pop(reference_id, None) is not None
+
+    def purge_expired(self):
+        now = time.time()
+        # Entries are kept in creation order and share one TTL, so expired ones lead
+        while self.references:
+            reference = next(iter(self.references.values()))
+            if reference.expires_at > now:
+                break
+            self.references.popitem(last=False)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "references": len(self.references),
+            "max_entries": self.max_entries,
+        }
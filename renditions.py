@@ -0,0 +1,260 @@
+import asyncio
+import collections
+import contextlib
+import io
+import multiprocessing
+import os
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Dict, List, Optional, Tuple
+
+import httpx
+from PIL import Image
+
+from inference_backends import LOCAL_OUTPUT_URL_PREFIX
+from memory_budget import MemoryBudget, estimate_decoded_bytes
+
+try:
+    import pillow_avif  # noqa: F401  registers the AVIF codec with Pillow
+    AVIF_AVAILABLE = True
+except ImportError:
+    AVIF_AVAILABLE = False
+
+CONTENT_TYPES = {"avif": "image/avif", "webp": "image/webp", "jpeg": "image/jpeg"}
+# Preferred order when negotiating a format from the Accept header
+FORMAT_PREFERENCE = ("avif", "webp", "jpeg")
+
+
+def _encode(image: Image.Image, image_format: str, quality: int) -> bytes:
+    output = io.BytesIO()
+    if image_format == "webp":
+        image.save(output, format="WEBP", quality=quality, method=4)
+    elif image_format == "avif":
+        image.save(output, format="AVIF", quality=quality, speed=8)
+    else:
+        image.save(output, format="JPEG", quality=quality, optimize=True, progressive=True)
+    return output.getvalue()
+
+
+def render_renditions(source: bytes, sizes: List[int], formats: List[str], quality: int) -> Dict[Tuple[int, str], bytes]:
+    """Decode a generated image once and encode every size x format rendition.
+
+    Runs in a worker process. JPEG sources are decoded straight at a reduced
+    scale with ``draft``. Each size is then made from the next larger
+    rendition instead of the full source, and ``thumbnail`` with a reducing
+    gap does a cheap integer ``reduce`` before the final Lanczos resample.
+    """
+    image = Image.open(io.BytesIO(source))
+    largest = max(sizes)
+    image.draft("RGB", (largest, largest))
+    image = image.convert("RGB")
+
+    renditions = {}
+    current = image
+    for size in sorted(sizes, reverse=True):
+        if max(current.size) > size:
+            current = current.copy()
+            current.thumbnail((size, size), Image.LANCZOS, reducing_gap=2.0)
+        for image_format in formats:
+            renditions[(size, image_format)] = _encode(current, image_format, quality)
+    return renditions
+
+
+class RenditionNotFoundError(Exception):
+    """Raised when a generation has no output image to render"""
+
+
+class RenditionService:
+    """Lazily renders and caches resized, re-encoded copies of generation outputs.
+
+    The first request for any rendition of a generation downloads the output
+    once and renders every configured size x format in a process pool.
+    Concurrent requests for the same generation share that work. Results go
+    to a disk cache and a bounded in-memory LRU. The disk cache keeps the
+    renditions of at most ``max_cached_generations`` generations, pruning
+    the oldest every ``PRUNE_EVERY`` renders.
+    """
+
+    PRUNE_EVERY = 100
+
+    def __init__(self, sizes: List[int], formats: List[str], quality: int, cache_dir: str,
+                 memory_cache_bytes: int, max_source_bytes: int, workers: int, budget: MemoryBudget,
+                 local_output_dir: str, max_cached_generations: int):
+        self.sizes = sorted(sizes)
+        self.formats = [f for f in formats if f != "avif" or AVIF_AVAILABLE]
+        self.quality = quality
+        self.cache_dir = cache_dir
+        self.memory_cache_bytes = memory_cache_bytes
+        self.max_source_bytes = max_source_bytes
+        self.workers = workers
+        self.budget = budget
+        self.local_output_dir = local_output_dir
+        self.max_cached_generations = max_cached_generations
+
+        self.memory: "collections.OrderedDict[Tuple[str, int, str], bytes]" = collections.OrderedDict()
+        self.memory_bytes = 0
+        self.inflight: Dict[str, asyncio.Future] = {}
+        self._pool: Optional[ProcessPoolExecutor] = None
+        self.rendered = 0
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.pruned = 0
+
+    @property
+    def pool(self) -> ProcessPoolExecutor:
+        if self._pool is None:
+            # spawn keeps the workers clear of the server's threads and event loop
+            self._pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context("spawn"))
+        return self._pool
+
+    def shutdown(self):
+        if self._pool:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+    def pick_size(self, requested: int) -> int:
+        """Smallest configured size that covers the requested one"""
+        for size in self.sizes:
+            if size >= requested:
+                return size
+        return self.sizes[-1]
+
+    def pick_format(self, requested: Optional[str], accept: str) -> str:
+        if requested:
+            requested = "jpeg" if requested.lower() == "jpg" else requested.lower()
+            if requested not in self.formats:
+                raise ValueError(f"Unsupported rendition format: {requested}. Available: {self.formats}")
+            return requested
+        for image_format in FORMAT_PREFERENCE:
+            if image_format in self.formats and CONTENT_TYPES[image_format] in accept:
+                return image_format
+        return "jpeg" if "jpeg" in self.formats else self.formats[0]
+
+    def _path(self, generation_id: str, size: int, image_format: str) -> str:
+        return os.path.join(self.cache_dir, generation_id, f"{size}.{image_format}")
+
+    def _remember(self, key: Tuple[str, int, str], content: bytes):
+        if key in self.memory:
+            return
+        self.memory[key] = content
+        self.memory_bytes += len(content)
+        while self.memory_bytes > self.memory_cache_bytes and self.memory:
+            _, evicted = self.memory.popitem(last=False)
+            self.memory_bytes -= len(evicted)
+
+    def _read_disk(self, path: str) -> Optional[bytes]:
+        try:
+            with open(path, "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def _write_disk(self, generation_id: str, renditions: Dict[Tuple[int, str], bytes]):
+        os.makedirs(os.path.join(self.cache_dir, generation_id), exist_ok=True)
+        for (size, image_format), content in renditions.items():
+            path = self._path(generation_id, size, image_format)
+            with open(path + ".tmp", "wb") as f:
+                f.write(content)
+            os.replace(path + ".tmp", path)
+
+    def _prune_disk(self):
+        """Delete the renditions of the oldest generations beyond ``max_cached_generations``"""
+        try:
+            entries = [entry for entry in os.scandir(self.cache_dir) if entry.is_dir()]
+        except FileNotFoundError:
+            return
+        entries.sort(key=lambda entry: entry.stat().st_mtime)
+        for entry in entries[:max(0, len(entries) - self.max_cached_generations)]:
+            # A request reading these concurrently just renders them again
+            shutil.rmtree(entry.path, ignore_errors=True)
+            self.pruned += 1
+
+    async def _download(self, url: str, reservations: contextlib.AsyncExitStack) -> bytes:
+        """Download an output image, reserving its size from the memory budget on ``reservations``"""
+        if url.startswith(LOCAL_OUTPUT_URL_PREFIX):
+            return await self._read_local(url, reservations)
+        async with httpx.AsyncClient(timeout=60, follow_redirects=True) as client:
+            async with client.stream("GET", url) as response:
+                response.raise_for_status()
+                expected = int(response.headers.get("content-length") or self.max_source_bytes)
+                if expected > self.max_source_bytes:
+                    raise ValueError(f"Output image exceeds {self.max_source_bytes} bytes")
+                await reservations.enter_async_context(self.budget.reserve(expected, "download"))
+                chunks = []
+                received = 0
+                async for chunk in response.aiter_bytes():
+                    received += len(chunk)
+                    if received > expected:
+                        raise ValueError(f"Output image is larger than its announced {expected} bytes")
+                    chunks.append(chunk)
+                return b"".join(chunks)
+
+    async def _read_local(self, url: str, reservations: contextlib.AsyncExitStack) -> bytes:
+        """Read an output written by the local fallback backend"""
+        path = os.path.join(self.local_output_dir, os.path.basename(url))
+        loop = asyncio.get_running_loop()
+        try:
+            size = os.path.getsize(path)
+        except FileNotFoundError:
+            raise RenditionNotFoundError(f"Output {url} no longer exists")
+        await reservations.enter_async_context(self.budget.reserve(size, "download"))
+        return await loop.run_in_executor(None, self._read_disk, path)
+
+    async def _render_all(self, generation_id: str, image_url: str):
+        loop = asyncio.get_running_loop()
+        async with contextlib.AsyncExitStack() as reservations:
+            source = await self._download(image_url, reservations)
+        # Swap the download reservation for one covering the source, the decoded source and its
+        # largest rendition; waiting for the second while holding the first could deadlock
+        async with self.budget.reserve(len(source) + 2 * estimate_decoded_bytes(source), "preprocess"):
+            renditions = await loop.run_in_executor(
+                self.pool, render_renditions, source, self.sizes, self.formats, self.quality
+            )
+        await loop.run_in_executor(None, self._write_disk, generation_id, renditions)
+        for (size, image_format), content in renditions.items():
+            self._remember((generation_id, size, image_format), content)
+        self.rendered += 1
+        if self.rendered % self.PRUNE_EVERY == 0:
+            await loop.run_in_executor(None, self._prune_disk)
+        print(f"[Renditions] Rendered {len(renditions)} renditions for {generation_id}")
+
+    async def render(self, generation_id: str, image_url: str):
+        """Render every rendition of a generation, sharing work with concurrent callers"""
+        future = self.inflight.get(generation_id)
+        if future is None:
+            future = asyncio.ensure_future(self._render_all(generation_id, image_url))
+            self.inflight[generation_id] = future
+            future.add_done_callback(lambda _: self.inflight.pop(generation_id, None))
+        await asyncio.shield(future)
+
+    async def get(self, generation_id: str, image_url: Optional[str], size: int, image_format: str) -> bytes:
+        key = (generation_id, size, image_format)
+        content = self.memory.get(key)
+        if content is not None:
+            self.memory.move_to_end(key)
+            self.memory_hits += 1
+            return content
+
+        loop = asyncio.get_running_loop()
+        content = await loop.run_in_executor(None, self._read_disk, self._path(*key))
+        if content is not None:
+            self.disk_hits += 1
+            self._remember(key, content)
+            return content
+
+        if not image_url:
+            raise RenditionNotFoundError(f"Generation {generation_id} has no output image")
+        await self.render(generation_id, image_url)
+        return self.memory.get(key) or await loop.run_in_executor(None, self._read_disk, self._path(*key))
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "sizes": self.sizes,
+            "formats": self.formats,
+            "rendered_generations": self.rendered,
+            "in_flight": len(self.inflight),
+            "memory_bytes": self.memory_bytes,
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "pruned_generations": self.pruned,
+        }
@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+"""
+Replay a captured traffic trace against a running AI Portrait Generator.
+
+Capture a trace by running the server with CAPTURE_TRAFFIC=1, then replay it
+against an instance wired to the fake backend, with the face pre-check off
+since the synthetic images have no face in them:
+
+    FAKE_BACKEND=1 FACE_GATE_MODE=off python main.py
+    python replay.py data/traffic_capture.jsonl --speed 4
+
+Requests are re-issued open-loop on the captured schedule (divided by
+--speed) with synthetic images of the captured size and format, and the
+replayed latency and throughput are compared with the captured ones.
+"""
+
+import argparse
+import asyncio
+import io
+import json
+import time
+from collections import defaultdict
+from typing import Any, Dict, List, Optional, Tuple
+
+import httpx
+from PIL import Image
+
+FORMAT_MIME_TYPES = {"JPEG": "image/jpeg", "PNG": "image/png", "WEBP": "image/webp"}
+
+
+def load_trace(path: str) -> List[Dict[str, Any]]:
+    """Load a capture file, oldest request first"""
+    records = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    pass
+    records.sort(key=lambda record: record["ts"])
+    return records
+
+
+_image_cache: Dict[Tuple[int, int, str], bytes] = {}
+
+
+def synthesize_image(width: Optional[int], height: Optional[int], image_format: Optional[str]) -> Tuple[bytes, str]:
+    """Build a noisy image with the captured dimensions and format.
+
+    Noise keeps the encoded size close to that of a real photo, and the same
+    bytes are reused for every request with the same shape.
+    """
+    width, height = width or 512, height or 512
+    image_format = image_format if image_format in FORMAT_MIME_TYPES else "JPEG"
+    key = (width, height, image_format)
+    if key not in _image_cache:
+        noise = Image.effect_noise((width, height), 64)
+        image = Image.merge("RGB", (noise, noise.rotate(90, expand=False), noise.transpose(Image.FLIP_LEFT_RIGHT)))
+        output = io.BytesIO()
+        image.save(output, format=image_format)
+        _image_cache[key] = output.getvalue()
+    return _image_cache[key], FORMAT_MIME_TYPES[image_format]
+
+
+def percentile(values: List[float], pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+class Replayer:
+    def __init__(self, base_url: str, speed: float, timeout: float):
+        self.base_url = base_url
+        self.speed = speed
+        self.client = httpx.AsyncClient(
+            base_url=base_url,
+            timeout=timeout,
+            limits=httpx.Limits(max_connections=1000, max_keepalive_connections=100)
+        )
+        self.references: Dict[str, str] = {}
+        self.reference_locks: Dict[str, asyncio.Lock] = defaultdict(asyncio.Lock)
+        self.results: List[Dict[str, Any]] = []
+
+    async def _reference_for(self, record: Dict[str, Any], headers: Dict[str, str]) -> Optional[str]:
+        """Create one reference per replayed client for requests that used a reference_id"""
+        client_id = record.get("client_id", "")
+        async with self.reference_locks[client_id]:
+            if client_id not in self.references:
+                content, mime_type = synthesize_image(512, 512, "JPEG")
+                response = await self.client.post(
+                    "/references",
+                    files={"reference_image": ("reference.jpg", content, mime_type)},
+                    headers=headers
+                )
+                if response.status_code != 200:
+                    return None
+                self.references[client_id] = response.json()["reference_id"]
+        return self.references[client_id]
+
+    async def send(self, record: Dict[str, Any]):
+        endpoint = record["endpoint"]
+        headers = {"X-Client-Id": f"replay-{record.get('client_id', 'anonymous')}"}
+        data = {"style": record.get("style") or "realistic"}
+        if record.get("prompt_length"):
+            data["prompt"] = "x" * record["prompt_length"]
+        if record.get("negative_prompt_length"):
+            data["negative_prompt"] = "x" * record["negative_prompt_length"]
+        if record.get("num_variants", 1) > 1:
+            data["num_variants"] = str(record["num_variants"])
+
+        files = None
+        if record.get("reference_id_used") and endpoint != "/references":
+            reference_id = await self._reference_for(record, headers)
+            if reference_id:
+                data["reference_id"] = reference_id
+        if "reference_id" not in data:
+            content, mime_type = synthesize_image(
+                record.get("image_width"), record.get("image_height"), record.get("image_format")
+            )
+            files = {"reference_image": ("reference", content, mime_type)}
+        if endpoint == "/references":
+            data = {}
+
+        started = time.monotonic()
+        try:
+            response = await self.client.post(endpoint, data=data, files=files, headers=headers)
+            status = response.status_code
+        except httpx.HTTPError as e:
+            print(f"❌ {endpoint}: {type(e).__name__}: {e}")
+            status = 0
+        self.results.append({
+            "endpoint": endpoint,
+            "status": status,
+            "latency_ms": (time.monotonic() - started) * 1000,
+            "captured_status": record.get("status"),
+            "captured_latency_ms": record.get("duration_ms"),
+        })
+
+    async def replay(self, trace: List[Dict[str, Any]]) -> float:
+        """Issue every request on the scaled schedule; returns the wall time taken"""
+        first_ts = trace[0]["ts"]
+        started = time.monotonic()
+        tasks = []
+        for record in trace:
+            delay = (record["ts"] - first_ts) / self.speed - (time.monotonic() - started)
+            if delay > 0:
+                await asyncio.sleep(delay)
+            tasks.append(asyncio.create_task(self.send(record)))
+        await asyncio.gather(*tasks)
+        await self.client.aclose()
+        return time.monotonic() - started
+
+
+def report(trace: List[Dict[str, Any]], results: List[Dict[str, Any]], wall_seconds: float, speed: float):
+    captured_span = max(trace[-1]["ts"] - trace[0]["ts"], 1e-9)
+    captured_rps = len(trace) / captured_span
+    replay_rps = len(results) / max(wall_seconds, 1e-9)
+
+    print("\n" + "=" * 78)
+    print(f"Replayed {len(results)} requests at {speed}x in {wall_seconds:.1f}s")
+    print(f"Throughput: captured {captured_rps:.2f} req/s, expected {captured_rps * speed:.2f} req/s, "
+          f"replayed {replay_rps:.2f} req/s ({(replay_rps / (captured_rps * speed) - 1) * 100:+.1f}%)")
+    print("=" * 78)
+    print(f"{'endpoint':34} {'n':>5} {'ok%':>6} {'p50 ms':>16} {'p95 ms':>16} {'p99 ms':>16}")
+    print(f"{'':34} {'':>5} {'':>6} {'cap → replay':>16} {'cap → replay':>16} {'cap → replay':>16}")
+
+    by_endpoint: Dict[str, List[Dict[str, Any]]] = defaultdict(list)
+    for result in results:
+        by_endpoint[result["endpoint"]].append(result)
+    for endpoint, rows in sorted(by_endpoint.items()):
+        ok = sum(1 for row in rows if 200 <= row["status"] < 300)
+        replayed = [row["latency_ms"] for row in rows]
+        captured = [row["captured_latency_ms"] for row in rows if row["captured_latency_ms"] is not None]
+        columns = []
+        for pct in (50, 95, 99):
+            columns.append(f"{percentile(captured, pct):7.0f}→{percentile(replayed, pct):<8.0f}")
+        print(f"{endpoint:34} {len(rows):>5} {ok / len(rows) * 100:>5.1f}% " + " ".join(f"{c:>16}" for c in columns))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay a captured traffic trace")
+    parser.add_argument("trace", help="Capture file written with CAPTURE_TRAFFIC=1")
+    parser.add_argument("--base-url", default="http://localhost:8000")
+    parser.add_argument("--speed", type=float, default=1.0, help="Replay N times faster than captured")
+    parser.add_argument("--limit", type=int, default=None, help="Replay only the first N requests")
+    parser.add_argument("--timeout", type=float, default=600.0, help="Per-request timeout in seconds")
+    args = parser.parse_args()
+
+    trace = load_trace(args.trace)
+    if args.limit:
+        trace = trace[:args.limit]
+    if not trace:
+        print("❌ The trace is empty")
+        return
+
+    print(f"🔁 Replaying {len(trace)} requests from {args.trace} against {args.base_url} at {args.speed}x")
+    replayer = Replayer(args.base_url, args.speed, args.timeout)
+    wall_seconds = asyncio.run(replayer.replay(trace))
+    report(trace, replayer.results, wall_seconds, args.speed)
+
+
+if __name__ == "__main__":
+    main()
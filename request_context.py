@@ -0,0 +1,22 @@
+import contextvars
+from typing import Any, Dict, Optional
+
+# Identity of the API client the current request is served for, used to
+# share prediction capacity fairly between tenants
+client_id: contextvars.ContextVar[str] = contextvars.ContextVar("client_id", default="anonymous")
+
+# Shape of the current request being recorded by traffic capture, or None
+# when capture is off (the common case, which costs one lookup)
+capture_shape: contextvars.ContextVar[Optional[Dict[str, Any]]] = contextvars.ContextVar("capture_shape", default=None)
+
+# time.monotonic() by which the current request must be answered, or None
+# when the client gave no deadline; set from X-Request-Timeout or a form field
+deadline: contextvars.ContextVar[Optional[float]] = contextvars.ContextVar("deadline", default=None)
+
+# Face pre-check of the current request's reference image, or None when it
+# was not checked; its face box is recorded and used to centre local crops
+face_check: contextvars.ContextVar[Optional[Any]] = contextvars.ContextVar("face_check", default=None)
+
+# Profile collecting the current request's work, or None when it is not
+# being profiled (the common case, which costs one lookup per hook)
+profile: contextvars.ContextVar[Optional[Any]] = contextvars.ContextVar("profile", default=None)
@@ -0,0 +1,171 @@
+import asyncio
+import collections
+import math
+import random
+import re
+import time
+from email.utils import parsedate_to_datetime
+from typing import Any, Deque, Dict, Optional, Tuple
+
+import httpx
+from replicate.exceptions import ModelError, ReplicateError
+
+from errors import ServiceUnavailableError
+
+RETRYABLE_STATUS_CODES = {408, 429, 500, 502, 503, 504}
+
+# The replicate client only keeps the "detail" of an error response, so
+# transient failures have to be recognised from the message
+TRANSIENT_MESSAGE_RE = re.compile(
+    r"throttl|rate limit|too many requests|temporarily unavailable|internal server error"
+    r"|bad gateway|gateway timeout|service unavailable|\b(429|500|502|503|504)\b",
+    re.IGNORECASE,
+)
+# e.g. "Request was throttled. Expected available in 3 seconds."
+RETRY_AFTER_MESSAGE_RE = re.compile(r"available in (\d+(?:\.\d+)?) second", re.IGNORECASE)
+
+# Provider responses rejecting the request's own input rather than failing to serve it
+INPUT_ERROR_STATUS_CODES = {400, 413, 415, 422}
+INPUT_ERROR_MESSAGE_RE = re.compile(
+    r"\b(400|413|415|422)\b|invalid input|validation error|unprocessable",
+    re.IGNORECASE,
+)
+
+
+class UpstreamUnavailableError(ServiceUnavailableError):
+    """Raised when a transient provider error persists after all allowed retries"""
+
+
+def _parse_retry_after(value: Optional[str]) -> Optional[float]:
+    if not value:
+        return None
+    value = value.strip()
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+        return max(0.0, retry_at.timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def classify_error(error: BaseException) -> Tuple[bool, Optional[float]]:
+    """Return (retryable, retry_after_seconds) for an exception raised by a prediction"""
+    # Our own capacity errors and prediction timeouts are never retried here
+    if isinstance(error, (ServiceUnavailableError, asyncio.TimeoutError)):
+        return False, None
+    # The model ran and failed on this input; running it again will not help
+    if isinstance(error, ModelError):
+        return False, None
+    if isinstance(error, httpx.HTTPStatusError):
+        status = error.response.status_code
+        if status in RETRYABLE_STATUS_CODES:
+            return True, _parse_retry_after(error.response.headers.get("retry-after"))
+        return False, None
+    if isinstance(error, (httpx.TransportError, ConnectionError)):
+        return True, None
+    if isinstance(error, ReplicateError):
+        message = str(error)
+        match = RETRY_AFTER_MESSAGE_RE.search(message)
+        retry_after = float(match.group(1)) if match else None
+        return bool(TRANSIENT_MESSAGE_RE.search(message)) or match is not None, retry_after
+    return False, None
+
+
+def is_input_error(error: BaseException) -> bool:
+    """Whether the provider rejected a prediction for its input, e.g. a field failing validation"""
+    if isinstance(error, httpx.HTTPStatusError):
+        return error.response.status_code in INPUT_ERROR_STATUS_CODES
+    if isinstance(error, ReplicateError) and not isinstance(error, ModelError):
+        return bool(INPUT_ERROR_MESSAGE_RE.search(str(error)))
+    return False
+
+
+class RetryBudget:
+    """Caps retries to a fraction of recent traffic so outages are not amplified.
+
+    Over a sliding ``window_seconds``, retries are allowed while they stay
+    below ``min_retries + ratio * requests``.
+    """
+
+    def __init__(self, ratio: float, min_retries: int, window_seconds: float = 10.0):
+        self.ratio = ratio
+        self.min_retries = min_retries
+        self.window_seconds = window_seconds
+        self.requests: Deque[float] = collections.deque()
+        self.retries: Deque[float] = collections.deque()
+
+    def _trim(self, now: float):
+        cutoff = now - self.window_seconds
+        for events in (self.requests, self.retries):
+            while events and events[0] < cutoff:
+                events.popleft()
+
+    def record_request(self):
+        self.requests.append(time.monotonic())
+
+    def try_withdraw(self) -> bool:
+        now = time.monotonic()
+        self._trim(now)
+        if len(self.retries) >= self.min_retries + self.ratio * len(self.requests):
+            return False
+        self.retries.append(now)
+        return True
+
+
+class RetryPolicy:
+    """Exponential backoff with full jitter, bounded by attempts, time and a global budget"""
+
+    def __init__(self, max_attempts: int, base_delay: float, max_delay: float,
+                 time_budget: float, budget: RetryBudget):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.time_budget = time_budget
+        self.budget = budget
+
+        self.retries = 0
+        self.denied_by_budget = 0
+        self.exhausted = 0
+
+    def next_delay(self, error: BaseException, attempt: int, elapsed: float) -> Tuple[Optional[float], bool]:
+        """Decide whether to retry after a failed attempt.
+
+        Returns (delay, retryable): ``delay`` is None when the call should not
+        be retried; ``retryable`` tells whether the error itself was transient.
+        """
+        retryable, retry_after = classify_error(error)
+        if not retryable:
+            return None, False
+
+        if attempt >= self.max_attempts:
+            self.exhausted += 1
+            return None, True
+
+        backoff = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+        delay = max(backoff, retry_after) if retry_after is not None else backoff
+        if elapsed + delay > self.time_budget:
+            self.exhausted += 1
+            return None, True
+        if not self.budget.try_withdraw():
+            self.denied_by_budget += 1
+            return None, True
+
+        self.retries += 1
+        return delay, True
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "retries": self.retries,
+            "denied_by_budget": self.denied_by_budget,
+            "exhausted": self.exhausted,
+            "max_attempts": self.max_attempts,
+        }
+
+
+def retry_after_hint(error: BaseException, default: int = 5) -> int:
+    """Seconds a client should wait before retrying a request that failed with error"""
+    _, retry_after = classify_error(error)
+    return max(1, math.ceil(retry_after)) if retry_after else default
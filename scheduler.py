@@ -0,0 +1,253 @@
+import asyncio
+import collections
+import contextlib
+import time
+from typing import Any, Deque, Dict, Optional
+
+import deadlines
+from errors import ServiceUnavailableError
+
+# Seconds a client may sit idle before its queue state is forgotten
+CLIENT_IDLE_TTL = 600
+
+
+class ClientQueueFullError(ServiceUnavailableError):
+    """Raised when a client already has too many predictions queued"""
+    status_code = 429
+
+
+class QueueTimeoutError(ServiceUnavailableError):
+    """Raised when a queued prediction waits longer than the queue timeout"""
+
+
+class TokenBucket:
+    """Token bucket allowing ``rate`` starts per second with bursts of ``burst``"""
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self) -> float:
+        """Seconds until a token is available (0 if one is available now)"""
+        if self.rate <= 0:
+            return 0.0
+        self._refill()
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def take(self):
+        if self.rate > 0:
+            self._refill()
+            self.tokens -= 1
+
+
+class Ticket:
+    """A queued request for one prediction slot"""
+
+    def __init__(self, client: "ClientQueue", start_tag: float, deadline: Optional[float]):
+        self.client = client
+        self.start_tag = start_tag
+        self.deadline = deadline
+        self.enqueued_at = time.monotonic()
+        self.future: asyncio.Future = asyncio.get_running_loop().create_future()
+
+
+class ClientQueue:
+    """Per-client queue, limits and accounting"""
+
+    def __init__(self, client_id: str, weight: float, max_concurrency: int, rate: float, burst: float):
+        self.client_id = client_id
+        self.weight = weight
+        self.max_concurrency = max_concurrency
+        self.bucket = TokenBucket(rate, burst)
+        self.waiting: Deque[Ticket] = collections.deque()
+        self.running = 0
+        self.finish_tag = 0.0
+        self.last_active = time.monotonic()
+
+        self.dispatched = 0
+        self.rejected = 0
+        self.wait_seconds_total = 0.0
+        self.wait_seconds_max = 0.0
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "weight": self.weight,
+            "queue_depth": len(self.waiting),
+            "running": self.running,
+            "dispatched": self.dispatched,
+            "rejected": self.rejected,
+            "avg_wait_seconds": round(self.wait_seconds_total / self.dispatched, 3) if self.dispatched else 0.0,
+            "max_wait_seconds": round(self.wait_seconds_max, 3),
+        }
+
+
+class FairScheduler:
+    """Weighted fair-share scheduler for prediction slots.
+
+    Each client gets its own queue. Slots are handed out by start-time fair
+    queuing: a request's virtual start tag is the later of the system virtual
+    time and its client's previous finish tag, and each prediction advances the
+    client's finish tag by ``1 / weight``. The eligible head with the smallest
+    start tag goes next, so a client with weight 2 gets twice the slots of a
+    client with weight 1 while both are backlogged, and a heavy batch can never
+    starve an interactive user. Clients are additionally held to a concurrency
+    cap and a token-bucket rate limit.
+    """
+
+    def __init__(self, capacity: int, weights: Dict[str, float], default_weight: float,
+                 max_concurrency: int, rate: float, burst: float,
+                 max_queue_per_client: int, queue_timeout: float):
+        self.capacity = capacity
+        self.weights = weights
+        self.default_weight = default_weight
+        self.max_concurrency = max_concurrency
+        self.rate = rate
+        self.burst = burst
+        self.max_queue_per_client = max_queue_per_client
+        self.queue_timeout = queue_timeout
+
+        self.clients: Dict[str, ClientQueue] = {}
+        self.running = 0
+        self.virtual_time = 0.0
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._last_prune = time.monotonic()
+
+    def _client(self, client_id: str) -> ClientQueue:
+        client = self.clients.get(client_id)
+        if client is None:
+            client = ClientQueue(
+                client_id,
+                weight=self.weights.get(client_id, self.default_weight),
+                max_concurrency=self.max_concurrency,
+                rate=self.rate,
+                burst=self.burst,
+            )
+            self.clients[client_id] = client
+        return client
+
+    def _prune(self):
+        now = time.monotonic()
+        if now - self._last_prune < 60:
+            return
+        self._last_prune = now
+        for client_id, client in list(self.clients.items()):
+            if not client.waiting and not client.running and now - client.last_active > CLIENT_IDLE_TTL:
+                del self.clients[client_id]
+
+    async def acquire(self, client_id: str, deadline: Optional[float] = None) -> ClientQueue:
+        """Wait for a prediction slot for the client, giving up at ``deadline`` (time.monotonic())"""
+        timeout = self.queue_timeout
+        if deadline is not None:
+            timeout = min(timeout, deadline - time.monotonic())
+            if timeout <= 0:
+                raise deadlines.expired("a generation slot was free")
+        self._prune()
+        client = self._client(client_id)
+        client.last_active = time.monotonic()
+        if len(client.waiting) >= self.max_queue_per_client:
+            client.rejected += 1
+            raise ClientQueueFullError(
+                f"Too many queued generations for this client ({len(client.waiting)})", retry_after=10
+            )
+
+        start_tag = max(self.virtual_time, client.finish_tag)
+        client.finish_tag = start_tag + 1.0 / client.weight
+        ticket = Ticket(client, start_tag, deadline)
+        client.waiting.append(ticket)
+        self._dispatch()
+
+        try:
+            await asyncio.wait_for(asyncio.shield(ticket.future), timeout=timeout)
+        except asyncio.TimeoutError:
+            if self._abandon(ticket):
+                client.rejected += 1
+                if deadline is not None and time.monotonic() >= deadline:
+                    raise deadlines.expired("a generation slot was free")
+                raise QueueTimeoutError("Timed out waiting for a free generation slot", retry_after=30)
+        except asyncio.CancelledError:
+            if not self._abandon(ticket):
+                self.release(client)
+            raise
+        return client
+
+    def _abandon(self, ticket: Ticket) -> bool:
+        """Withdraw a waiting ticket. Returns False if it was already granted a slot."""
+        if ticket.future.done():
+            return False
+        ticket.client.waiting.remove(ticket)
+        ticket.future.cancel()
+        return True
+
+    def release(self, client: ClientQueue):
+        """Return a slot previously granted to the client"""
+        self.running -= 1
+        client.running -= 1
+        client.last_active = time.monotonic()
+        self._dispatch()
+
+    @contextlib.asynccontextmanager
+    async def slot(self, client_id: str):
+        client = await self.acquire(client_id)
+        try:
+            yield client
+        finally:
+            self.release(client)
+
+    def _dispatch(self):
+        if self._timer:
+            self._timer.cancel()
+            self._timer = None
+
+        while self.running < self.capacity:
+            best = None
+            next_token_in = None
+            for client in self.clients.values():
+                if not client.waiting or client.running >= client.max_concurrency:
+                    continue
+                delay = client.bucket.delay()
+                if delay > 0:
+                    next_token_in = delay if next_token_in is None else min(next_token_in, delay)
+                    continue
+                if best is None or client.waiting[0].start_tag < best.waiting[0].start_tag:
+                    best = client
+
+            if best is None:
+                if next_token_in is not None:
+                    self._timer = asyncio.get_running_loop().call_later(next_token_in, self._dispatch)
+                return
+
+            ticket = best.waiting.popleft()
+            if ticket.deadline is not None and time.monotonic() >= ticket.deadline:
+                # Nobody is waiting for this one any more; never start it
+                ticket.future.set_exception(deadlines.expired("dispatch"))
+                continue
+            best.bucket.take()
+            best.running += 1
+            best.dispatched += 1
+            self.running += 1
+            self.virtual_time = max(self.virtual_time, ticket.start_tag)
+
+            waited = time.monotonic() - ticket.enqueued_at
+            best.wait_seconds_total += waited
+            best.wait_seconds_max = max(best.wait_seconds_max, waited)
+            ticket.future.set_result(None)
+
+    def queue_depth(self) -> int:
+        return sum(len(client.waiting) for client in self.clients.values())
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "capacity": self.capacity,
+            "running": self.running,
+            "queue_depth": self.queue_depth(),
+            "clients": {client_id: client.stats() for client_id, client in self.clients.items()},
+        }
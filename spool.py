@@ -0,0 +1,183 @@
+import asyncio
+import os
+import re
+import time
+import uuid
+from typing import Any, Dict, Optional
+
+import aiofiles
+
+import deadlines
+from errors import ServiceUnavailableError
+
+# temp_<pid>_<uuid>.<ext>; the pid lets a restarted process tell its own
+# leftovers apart from files still owned by a live sibling worker
+SPOOL_FILE_RE = re.compile(r"^temp_(?:(\d+)_)?[0-9a-f-]{36}\.\w+$")
+
+
+class SpoolFullError(ServiceUnavailableError):
+    """Raised when the spool quota stays exhausted for longer than the wait timeout"""
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class SpoolManager:
+    """Managed directory for temporary reference images.
+
+    Writes are accounted against a byte quota; when the quota is exhausted new
+    writes wait for space to be released and are rejected after a timeout.
+    Files left behind by crashed processes are swept on startup, and a
+    periodic janitor evicts untracked files older than ``max_age``.
+    """
+
+    def __init__(self, directory: str, max_bytes: int, max_age: float,
+                 janitor_interval: float, wait_timeout: float):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.janitor_interval = janitor_interval
+        self.wait_timeout = wait_timeout
+
+        self.active: Dict[str, int] = {}
+        self.used_bytes = 0
+        self.peak_bytes = 0
+        self.disk_bytes = 0
+        self.evicted_files = 0
+        self.rejected_writes = 0
+        self._space_freed = asyncio.Event()
+        self._janitor_task: Optional[asyncio.Task] = None
+
+    async def start(self):
+        """Create the spool directory, sweep crash leftovers and start the janitor"""
+        os.makedirs(self.directory, exist_ok=True)
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self.sweep, True)
+        if self.janitor_interval > 0 and self._janitor_task is None:
+            self._janitor_task = asyncio.create_task(self._janitor())
+
+    async def stop(self):
+        """Stop the janitor and delete files still held by requests, which no one will read any more"""
+        if self._janitor_task:
+            self._janitor_task.cancel()
+            self._janitor_task = None
+        if self.active:
+            print(f"[Spool] Removing {len(self.active)} spool files left at shutdown")
+            for path in list(self.active):
+                self.release(path)
+
+    async def _reserve(self, size: int):
+        if size > self.max_bytes:
+            self.rejected_writes += 1
+            raise SpoolFullError(f"Upload of {size} bytes exceeds the spool quota of {self.max_bytes} bytes")
+
+        deadline = time.monotonic() + deadlines.bound(self.wait_timeout)
+        while self.used_bytes + size > self.max_bytes:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                self.rejected_writes += 1
+                raise SpoolFullError("Temporary storage is full, please retry shortly")
+            self._space_freed.clear()
+            try:
+                await asyncio.wait_for(self._space_freed.wait(), timeout=remaining)
+            except asyncio.TimeoutError:
+                pass
+
+        self.used_bytes += size
+        self.peak_bytes = max(self.peak_bytes, self.used_bytes)
+
+    async def write(self, content: bytes, suffix: str = ".jpg") -> str:
+        """Write content to a new spool file and return its path"""
+        await self._reserve(len(content))
+        path = os.path.join(self.directory, f"temp_{os.getpid()}_{uuid.uuid4()}{suffix}")
+        self.active[path] = len(content)
+        try:
+            async with aiofiles.open(path, "wb") as f:
+                await f.write(content)
+        except Exception:
+            self.release(path)
+            raise
+        return path
+
+    def release(self, path: str):
+        """Delete a spool file and return its bytes to the quota"""
+        size = self.active.pop(path, None)
+        if size is not None:
+            self.used_bytes -= size
+            self._space_freed.set()
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            # The janitor will retry once the file is older than max_age
+            print(f"[Spool] Failed to remove {path}: {e}")
+
+    def sweep(self, startup: bool = False):
+        """Remove orphaned spool files.
+
+        On startup, files from processes that no longer exist are removed
+        immediately; otherwise only untracked files older than max_age go.
+        """
+        now = time.time()
+        disk_bytes = 0
+        evicted = 0
+        try:
+            entries = list(os.scandir(self.directory))
+        except FileNotFoundError:
+            return
+
+        for entry in entries:
+            match = SPOOL_FILE_RE.match(entry.name)
+            if not match or not entry.is_file():
+                continue
+            active_size = self.active.get(entry.path)
+            if active_size is not None:
+                disk_bytes += active_size
+                continue
+            try:
+                stat = entry.stat()
+                pid = int(match.group(1)) if match.group(1) else None
+                dead_owner = startup and pid is not None and (pid == os.getpid() or not _pid_alive(pid))
+                if dead_owner or now - stat.st_mtime > self.max_age:
+                    os.remove(entry.path)
+                    evicted += 1
+                else:
+                    disk_bytes += stat.st_size
+            except FileNotFoundError:
+                continue
+            except OSError as e:
+                print(f"[Spool] Failed to evict {entry.path}: {e}")
+
+        self.disk_bytes = disk_bytes
+        self.evicted_files += evicted
+        if evicted:
+            print(f"[Spool] Evicted {evicted} orphaned files from {self.directory}")
+
+    async def _janitor(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(self.janitor_interval)
+            try:
+                await loop.run_in_executor(None, self.sweep)
+            except Exception as e:
+                print(f"[Spool] Janitor run failed: {e}")
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "directory": self.directory,
+            "used_bytes": self.used_bytes,
+            "peak_bytes": self.peak_bytes,
+            "max_bytes": self.max_bytes,
+            "active_files": len(self.active),
+            "disk_bytes": self.disk_bytes,
+            "evicted_files": self.evicted_files,
+            "rejected_writes": self.rejected_writes,
+        }
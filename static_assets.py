@@ -0,0 +1,212 @@
+import asyncio
+import gzip
+import hashlib
+import mimetypes
+import os
+import re
+from typing import Dict, Optional
+
+from fastapi import Request
+from fastapi.responses import Response
+
+try:
+    import brotli
+except ImportError:  # brotli is optional, gzip is always available
+    brotli = None
+
+COMPRESSIBLE_TYPES = (
+    "text/",
+    "application/javascript",
+    "application/json",
+    "application/xml",
+    "image/svg+xml",
+)
+
+# Compressing tiny files costs more in headers than it saves in bytes
+MIN_COMPRESS_SIZE = 256
+
+# src/href attributes pointing at a frontend asset, e.g. src="/static/app.js"
+ASSET_REFERENCE_RE = re.compile(rb'((?:src|href)\s*=\s*["\'])(/?static/)([^"\'?#]+)(["\'])')
+
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+PRIVATE_IMMUTABLE_CACHE_CONTROL = "private, max-age=31536000, immutable"
+REVALIDATE_CACHE_CONTROL = "no-cache"
+
+
+class StaticAsset:
+    """A static file held in memory with its precompressed variants"""
+
+    def __init__(self, rel_path: str, content: bytes, mtime_ns: int, source: Optional[bytes] = None):
+        self.rel_path = rel_path
+        self.mtime_ns = mtime_ns
+        # The file as read from disk; differs from ``content`` for pages whose asset URLs were versioned
+        self.source = content if source is None else source
+        self.size = len(content)
+        self.version = hashlib.sha256(content).hexdigest()[:16]
+
+        content_type, _ = mimetypes.guess_type(rel_path)
+        content_type = content_type or "application/octet-stream"
+        if content_type == "application/javascript":
+            # The response class only appends a charset to text/* types
+            content_type = f"{content_type}; charset=utf-8"
+        self.content_type = content_type
+
+        self.variants = {"identity": content}
+        if self.size >= MIN_COMPRESS_SIZE and content_type.startswith(COMPRESSIBLE_TYPES):
+            gzipped = gzip.compress(content, compresslevel=9, mtime=0)
+            if len(gzipped) < self.size:
+                self.variants["gzip"] = gzipped
+            if brotli is not None:
+                brotlied = brotli.compress(content, quality=11)
+                if len(brotlied) < self.size:
+                    self.variants["br"] = brotlied
+
+    @property
+    def is_page(self) -> bool:
+        return self.content_type.startswith("text/html")
+
+    def versioned(self, assets: Dict[str, "StaticAsset"]) -> "StaticAsset":
+        """This page with every reference to a known asset carrying ``?v=<content hash>``"""
+        def add_version(match):
+            asset = assets.get(match.group(3).decode("utf-8", "replace"))
+            if asset is None or asset.is_page:
+                return match.group(0)
+            return match.group(1) + match.group(2) + match.group(3) + b"?v=" + asset.version.encode("ascii") + match.group(4)
+        return StaticAsset(self.rel_path, ASSET_REFERENCE_RE.sub(add_version, self.source), self.mtime_ns, self.source)
+
+    def etag(self, encoding: str) -> str:
+        if encoding == "identity":
+            return f'"{self.version}"'
+        return f'"{self.version}-{encoding}"'
+
+    def matches(self, if_none_match: str) -> bool:
+        """Weak comparison of an If-None-Match header against this asset"""
+        for tag in if_none_match.split(","):
+            tag = tag.strip()
+            if tag == "*":
+                return True
+            if tag.startswith("W/"):
+                tag = tag[2:]
+            tag = tag.strip('"')
+            if tag.split("-", 1)[0] == self.version:
+                return True
+        return False
+
+
+def _accepted_encodings(accept_encoding: str) -> Dict[str, float]:
+    """Parse an Accept-Encoding header into {coding: q}"""
+    accepted = {}
+    for part in accept_encoding.split(","):
+        coding, _, params = part.strip().partition(";")
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        q = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        accepted[coding] = q
+    return accepted
+
+
+class StaticAssetCache:
+    """In-memory cache of the frontend assets.
+
+    Files are read and compressed once, then re-read only when their mtime
+    or size changes, so requests never touch the disk. HTML pages are
+    served with their ``/static/`` references versioned by content hash, so
+    browsers can cache the assets forever; pages are rewritten whenever an
+    asset changes.
+    """
+
+    def __init__(self, directory: str, reload_interval: float = 2.0):
+        self.directory = directory
+        self.reload_interval = reload_interval
+        self.assets: Dict[str, StaticAsset] = {}
+        self._watch_task: Optional[asyncio.Task] = None
+
+    def refresh(self) -> bool:
+        """Rescan the directory, reloading changed files. Returns True if anything changed."""
+        found = {}
+        changed = False
+        if os.path.isdir(self.directory):
+            for root, _, files in os.walk(self.directory):
+                for name in files:
+                    full_path = os.path.join(root, name)
+                    rel_path = os.path.relpath(full_path, self.directory).replace(os.sep, "/")
+                    try:
+                        stat = os.stat(full_path)
+                        current = self.assets.get(rel_path)
+                        if current and current.mtime_ns == stat.st_mtime_ns and len(current.source) == stat.st_size:
+                            found[rel_path] = current
+                            continue
+                        with open(full_path, "rb") as f:
+                            found[rel_path] = StaticAsset(rel_path, f.read(), stat.st_mtime_ns)
+                        changed = True
+                    except OSError as e:
+                        print(f"[Static] Failed to load {full_path}: {e}")
+
+        if set(found) != set(self.assets):
+            changed = True
+        if changed:
+            for rel_path, asset in found.items():
+                if asset.is_page:
+                    found[rel_path] = asset.versioned(found)
+        self.assets = found
+        if changed:
+            print(f"[Static] Loaded {len(found)} assets from {self.directory}")
+        return changed
+
+    async def start(self):
+        """Load assets once and keep watching the directory for changes"""
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self.refresh)
+        if self.reload_interval > 0 and self._watch_task is None:
+            self._watch_task = asyncio.create_task(self._watch())
+
+    async def stop(self):
+        if self._watch_task:
+            self._watch_task.cancel()
+            self._watch_task = None
+
+    async def _watch(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(self.reload_interval)
+            try:
+                await loop.run_in_executor(None, self.refresh)
+            except Exception as e:
+                print(f"[Static] Reload failed: {e}")
+
+    def get(self, rel_path: str) -> Optional[StaticAsset]:
+        return self.assets.get(rel_path)
+
+    def respond(self, asset: StaticAsset, request: Request, cache_control: str) -> Response:
+        """Build a response for the asset, honouring If-None-Match and Accept-Encoding"""
+        accepted = _accepted_encodings(request.headers.get("accept-encoding", ""))
+        encoding = "identity"
+        for candidate in ("br", "gzip"):
+            if candidate in asset.variants and accepted.get(candidate, 0) > 0:
+                encoding = candidate
+                break
+
+        headers = {
+            "ETag": asset.etag(encoding),
+            "Cache-Control": cache_control,
+            "Vary": "Accept-Encoding",
+        }
+
+        if_none_match = request.headers.get("if-none-match")
+        if if_none_match and asset.matches(if_none_match):
+            return Response(status_code=304, headers=headers)
+
+        if encoding != "identity":
+            headers["Content-Encoding"] = encoding
+        return Response(
+            content=asset.variants[encoding],
+            media_type=asset.content_type,
+            headers=headers,
+        )
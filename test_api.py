@@ -16,7 +16,7 @@ def test_health_check():
     """Test the health check endpoint"""
     print("Testing health check...")
     try:
-        response = requests.get(f"{BASE_URL}/")
+        response = requests.get(f"{BASE_URL}/healthz")
         if response.status_code == 200:
             print("✅ Health check passed")
             print(f"Response: {response.json()}")
@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+"""
+Unit tests for the per-model circuit breaker and error classification
+"""
+
+import httpx
+import pytest
+from replicate.exceptions import ModelError, ReplicateError
+
+from circuit_breaker import CircuitBreaker, CircuitOpenError
+from retry_policy import is_input_error
+
+
+def make_breaker(min_calls=3, failure_rate=0.5, half_open_calls=1):
+    return CircuitBreaker(
+        "test-model",
+        window_seconds=120,
+        min_calls=min_calls,
+        failure_rate=failure_rate,
+        open_seconds=60,
+        half_open_calls=half_open_calls,
+    )
+
+
+def call(breaker, failed=False):
+    breaker.allow()
+    if failed:
+        breaker.record_failure()
+    else:
+        breaker.record_success()
+
+
+def open_breaker(breaker):
+    for _ in range(breaker.min_calls):
+        call(breaker, failed=True)
+    assert breaker.state == CircuitBreaker.OPEN
+
+
+def let_open_period_pass(breaker):
+    breaker.opened_at -= breaker.open_seconds
+
+
+def test_stays_closed_below_min_calls():
+    breaker = make_breaker()
+    call(breaker, failed=True)
+    call(breaker, failed=True)
+    assert breaker.state == CircuitBreaker.CLOSED
+
+
+def test_opens_once_failure_rate_is_reached():
+    breaker = make_breaker(min_calls=4)
+    call(breaker)
+    call(breaker)
+    call(breaker, failed=True)
+    assert breaker.state == CircuitBreaker.CLOSED
+    call(breaker, failed=True)
+    assert breaker.state == CircuitBreaker.OPEN
+    assert breaker.times_opened == 1
+
+
+def test_open_circuit_fails_fast():
+    breaker = make_breaker()
+    open_breaker(breaker)
+    with pytest.raises(CircuitOpenError) as raised:
+        breaker.allow()
+    assert raised.value.retry_after >= 1
+    assert breaker.short_circuited == 1
+
+
+def test_successful_probe_closes_the_circuit():
+    breaker = make_breaker()
+    open_breaker(breaker)
+    let_open_period_pass(breaker)
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    breaker.allow()
+    # Only half_open_calls probes at a time
+    with pytest.raises(CircuitOpenError):
+        breaker.allow()
+    breaker.record_success()
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert breaker.stats()["window_calls"] == 1
+
+
+def test_failed_probe_reopens_the_circuit():
+    breaker = make_breaker()
+    open_breaker(breaker)
+    let_open_period_pass(breaker)
+    breaker.allow()
+    breaker.record_failure(timed_out=True)
+    assert breaker.state == CircuitBreaker.OPEN
+    assert breaker.times_opened == 2
+
+
+def test_abandoned_and_neutral_probes_free_their_place():
+    breaker = make_breaker()
+    open_breaker(breaker)
+    let_open_period_pass(breaker)
+    breaker.allow()
+    breaker.record_abandoned()
+    breaker.allow()
+    breaker.record_neutral()
+    breaker.allow()
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    assert breaker.neutral == 1
+
+
+def test_neutral_outcomes_do_not_count():
+    breaker = make_breaker()
+    for _ in range(10):
+        breaker.allow()
+        breaker.record_neutral()
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert breaker.stats()["window_calls"] == 0
+
+
+def status_error(status_code):
+    request = httpx.Request("POST", "https://api.replicate.com/v1/predictions")
+    response = httpx.Response(status_code, request=request)
+    return httpx.HTTPStatusError(f"{status_code}", request=request, response=response)
+
+
+def test_only_input_validation_errors_are_input_errors():
+    assert is_input_error(status_error(422))
+    assert is_input_error(ReplicateError("422 validation error: input.image is required"))
+    assert not is_input_error(status_error(429))
+    assert not is_input_error(status_error(503))
+    assert not is_input_error(ModelError("prediction failed"))
+    assert not is_input_error(httpx.ConnectError("connection refused"))
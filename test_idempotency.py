@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+"""
+Unit tests for Idempotency-Key replays
+"""
+
+import asyncio
+
+import httpx
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse
+from starlette.routing import Route
+
+from idempotency import BodyFingerprint, IdempotencyMiddleware, IdempotencyStore
+
+
+def make_app(status_code=200, delay=0.0):
+    calls = []
+
+    async def generate(request):
+        form = await request.form()
+        calls.append(form.get("prompt"))
+        await asyncio.sleep(delay)
+        return JSONResponse({"call": len(calls)}, status_code=status_code)
+
+    app = Starlette(routes=[Route("/generate-portrait-instantid", generate, methods=["POST"])])
+    store = IdempotencyStore(ttl=60, max_entries=100)
+    app.add_middleware(IdempotencyMiddleware, store=store,
+                       identify=lambda request: request.headers.get("x-client-id", ""), max_wait=5)
+    return app, store, calls
+
+
+async def post(app, prompt, key="key-1", client_id="me"):
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test") as client:
+        return await client.post(
+            "/generate-portrait-instantid",
+            data={"prompt": prompt},
+            files={"reference_image": ("face.jpg", b"\xff\xd8\xff" + b"x" * 5000, "image/jpeg")},
+            headers={"Idempotency-Key": key, "X-Client-Id": client_id},
+        )
+
+
+def test_retry_is_replayed_despite_a_new_multipart_boundary():
+    async def run():
+        app, store, calls = make_app()
+        first = await post(app, "portrait")
+        retry = await post(app, "portrait")
+        return first, retry, store, calls
+
+    first, retry, store, calls = asyncio.run(run())
+    assert calls == ["portrait"]
+    assert retry.status_code == first.status_code == 200
+    assert retry.json() == first.json()
+    assert retry.headers["idempotent-replayed"] == "true"
+    assert store.replayed == 1
+
+
+def test_reused_key_with_a_different_body_is_rejected():
+    async def run():
+        app, store, calls = make_app()
+        await post(app, "portrait")
+        return await post(app, "landscape"), calls
+
+    response, calls = asyncio.run(run())
+    assert response.status_code == 422
+    assert calls == ["portrait"]
+
+
+def test_keys_are_scoped_to_the_client():
+    async def run():
+        app, store, calls = make_app()
+        await post(app, "portrait", client_id="me")
+        return await post(app, "portrait", client_id="someone-else"), calls
+
+    response, calls = asyncio.run(run())
+    assert "idempotent-replayed" not in response.headers
+    assert len(calls) == 2
+
+
+def test_failed_first_attempt_runs_again():
+    async def run():
+        app, store, calls = make_app(status_code=503)
+        await post(app, "portrait")
+        await post(app, "portrait")
+        return store, calls
+
+    store, calls = asyncio.run(run())
+    assert len(calls) == 2
+    assert store.stored == 0
+
+
+def test_concurrent_retry_waits_for_the_first_request():
+    async def run():
+        app, store, calls = make_app(delay=0.1)
+        return await asyncio.gather(post(app, "portrait"), post(app, "portrait")), store, calls
+
+    (first, retry), store, calls = asyncio.run(run())
+    assert len(calls) == 1
+    assert first.json() == retry.json()
+    assert store.waited == 1
+
+
+def test_fingerprint_does_not_depend_on_chunking():
+    content_type = "multipart/form-data; boundary=abc123"
+    body = b"--abc123\r\ncontent\r\n--abc123--\r\n" * 50
+    whole = BodyFingerprint("/generate-portrait-instantid", content_type)
+    whole.update(body, more_body=False)
+    for chunk_size in (1, 3, 7, 64):
+        chunked = BodyFingerprint("/generate-portrait-instantid", content_type)
+        for start in range(0, len(body), chunk_size):
+            chunked.update(body[start:start + chunk_size], more_body=start + chunk_size < len(body))
+        assert chunked.complete
+        assert chunked.hexdigest() == whole.hexdigest()
@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+"""
+Unit tests for the generation ledger and its history index
+"""
+
+import asyncio
+import uuid
+
+from ledger import GenerationLedger, HistoryIndex, JsonlBatchWriter
+
+
+def record(client_id, recorded_at, model="instantid", style="realistic"):
+    return {"client_id": client_id, "model": model, "style": style, "recorded_at": recorded_at}
+
+
+def all_pages(index, client_id, limit, **filters):
+    rows, cursor = index.query(client_id, filters.get("model"), filters.get("style"),
+                               filters.get("since"), filters.get("until"), None, limit)
+    pages = [rows]
+    while cursor is not None:
+        rows, cursor = index.query(client_id, filters.get("model"), filters.get("style"),
+                                   filters.get("since"), filters.get("until"), cursor, limit)
+        pages.append(rows)
+    return pages
+
+
+def test_grows_past_65535_clients():
+    index = HistoryIndex()
+    clients = 70_000
+    for row in range(clients):
+        index.add(record(f"client-{row}", float(row), model=f"model-{row % 4}"), packed=row * 10)
+
+    assert len(index.spans) == len(index.models) == len(index.styles) == len(index.recorded_at) == clients
+    assert len(index.client_codes) == clients
+    # Models and styles keep their own small code tables
+    assert len(index.model_codes) == 4
+    assert len(index.style_codes) == 1
+    for row in (0, 65_535, 65_536, clients - 1):
+        assert index.query(f"client-{row}", None, None, None, None, None, 10) == ([row], None)
+        assert index.query(f"client-{row}", f"model-{row % 4}", "realistic", None, None, None, 10) == ([row], None)
+        assert index.spans[row] == row * 10
+
+
+def test_pages_newest_first_without_gaps():
+    index = HistoryIndex()
+    for row in range(25):
+        index.add(record("me", float(row)), packed=row)
+        index.add(record("other", float(row)), packed=row)
+
+    pages = all_pages(index, "me", 10)
+    rows = [row for page in pages for row in page]
+    assert [len(page) for page in pages] == [10, 10, 5]
+    assert rows == sorted(rows, reverse=True)
+    assert len(set(rows)) == 25
+    assert all(row % 2 == 0 for row in rows)
+
+
+def test_filters_by_model_style_and_dates():
+    index = HistoryIndex()
+    for row in range(12):
+        index.add(record("me", float(row), model=["instantid", "ipadapter"][row % 2],
+                         style=["realistic", "anime", "oil"][row % 3]), packed=row)
+
+    assert index.query("me", "ipadapter", None, None, None, None, 20)[0] == [11, 9, 7, 5, 3, 1]
+    assert index.query("me", None, "anime", None, None, None, 20)[0] == [10, 7, 4, 1]
+    assert index.query("me", "ipadapter", "anime", None, None, None, 20)[0] == [7, 1]
+    assert index.query("me", None, None, 3.0, 6.0, None, 20)[0] == [6, 5, 4, 3]
+    assert index.query("me", "unknown", None, None, None, None, 20) == ([], None)
+    assert index.query("stranger", None, None, None, None, None, 20) == ([], None)
+
+
+def test_recorded_at_stays_monotonic():
+    index = HistoryIndex()
+    index.add(record("me", 100.0), packed=0)
+    # The clock stepped backwards
+    index.add(record("me", 50.0), packed=1)
+    assert list(index.recorded_at) == [100.0, 100.0]
+    assert index.query("me", None, None, 100.0, None, None, 10)[0] == [1, 0]
+
+
+def make_ledger(path, max_pending=1000):
+    return GenerationLedger(str(path), batch_size=8, flush_interval=0.01, max_pending=max_pending)
+
+
+def generation(client_id="me", model="instantid"):
+    return {"generation_id": str(uuid.uuid4()), "client_id": client_id, "model": model,
+            "style": "realistic", "status": "succeeded", "image_url": "https://example.com/out.png"}
+
+
+def test_records_are_served_before_and_after_flushing(tmp_path):
+    async def run():
+        ledger = make_ledger(tmp_path / "ledger.jsonl")
+        await ledger.start()
+        entries = [generation() for _ in range(20)]
+        for entry in entries:
+            ledger.record(entry)
+        # Not written yet: served from memory
+        assert (await ledger.get(entries[0]["generation_id"]))["model"] == "instantid"
+        await ledger.stop()
+        assert ledger.unflushed == {}
+        return ledger, entries
+
+    ledger, entries = asyncio.run(run())
+    assert ledger.writer.written == 20
+    for entry in entries:
+        assert asyncio.run(ledger.get(entry["generation_id"]))["generation_id"] == entry["generation_id"]
+    assert asyncio.run(ledger.get(str(uuid.uuid4()))) is None
+    assert asyncio.run(ledger.get("not-a-uuid")) is None
+
+
+def test_index_is_rebuilt_at_startup(tmp_path):
+    async def run():
+        ledger = make_ledger(tmp_path / "ledger.jsonl")
+        await ledger.start()
+        entries = [generation(model=["instantid", "ipadapter"][i % 2]) for i in range(10)]
+        entries.append(generation(client_id="other"))
+        for entry in entries:
+            ledger.record(entry)
+        await ledger.stop()
+        # A torn final line from a crash is skipped
+        with open(tmp_path / "ledger.jsonl", "ab") as f:
+            f.write(b'{"generation_id": "')
+
+        reopened = make_ledger(tmp_path / "ledger.jsonl")
+        await reopened.start()
+        history = await reopened.list_history("me", model="ipadapter", limit=3)
+        rest = await reopened.list_history("me", model="ipadapter", cursor=int(history["next_cursor"]), limit=3)
+        found = await reopened.get(entries[-1]["generation_id"])
+        await reopened.stop()
+        return entries, history, rest, found
+
+    entries, history, rest, found = asyncio.run(run())
+    ipadapter_ids = [entry["generation_id"] for entry in entries[:10] if entry["model"] == "ipadapter"]
+    listed = [item["generation_id"] for item in history["items"] + rest["items"]]
+    assert listed == ipadapter_ids[::-1]
+    assert rest["next_cursor"] is None
+    assert found["client_id"] == "other"
+
+
+def test_writer_drops_records_past_max_pending(tmp_path):
+    writer = JsonlBatchWriter(str(tmp_path / "out.jsonl"), batch_size=100, flush_interval=10, max_pending=3)
+    assert all(writer.submit({"n": n}) for n in range(3))
+    assert not writer.submit({"n": 3})
+    assert writer.dropped == 1
+
+
+def test_writer_survives_a_failing_on_written_callback(tmp_path):
+    def on_written(batch, spans):
+        raise RuntimeError("index is broken")
+
+    async def run():
+        writer = JsonlBatchWriter(str(tmp_path / "out.jsonl"), batch_size=2, flush_interval=0.01,
+                                  max_pending=100, on_written=on_written)
+        await writer.start()
+        for n in range(5):
+            writer.submit({"n": n})
+        await asyncio.sleep(0.05)
+        writer.submit({"n": 5})
+        await writer.stop()
+        return writer
+
+    writer = asyncio.run(run())
+    assert writer.written == 6
+    assert (tmp_path / "out.jsonl").read_text().count("\n") == 6
@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+"""
+Unit tests for the memory budget
+"""
+
+import asyncio
+
+import pytest
+
+from memory_budget import MemoryBudget, MemoryBudgetExceededError
+
+
+async def reserve_and_record(budget, nbytes, name, order):
+    async with budget.reserve(nbytes, "test"):
+        order.append(name)
+
+
+def test_memory_waiters_are_served_in_arrival_order():
+    async def run():
+        budget = MemoryBudget(100, wait_timeout=5.0)
+        order = []
+        async with budget.reserve(80, "test"):
+            large = asyncio.create_task(reserve_and_record(budget, 50, "large", order))
+            await asyncio.sleep(0)
+            # Would fit right now, but must not overtake the larger waiter
+            small = asyncio.create_task(reserve_and_record(budget, 10, "small", order))
+            await asyncio.sleep(0)
+            assert order == []
+        await asyncio.gather(large, small)
+        return budget, order
+
+    budget, order = asyncio.run(run())
+    assert order == ["large", "small"]
+    assert budget.in_use == 0
+
+
+def test_cancelled_memory_waiter_unblocks_the_queue():
+    async def run():
+        budget = MemoryBudget(100, wait_timeout=5.0)
+        order = []
+        async with budget.reserve(60, "test"):
+            blocked = asyncio.create_task(reserve_and_record(budget, 100, "blocked", order))
+            await asyncio.sleep(0)
+            behind = asyncio.create_task(reserve_and_record(budget, 30, "behind", order))
+            await asyncio.sleep(0)
+            blocked.cancel()
+            await behind
+        return budget, order
+
+    budget, order = asyncio.run(run())
+    assert order == ["behind"]
+    assert budget.in_use == 0
+
+
+def test_memory_wait_times_out():
+    async def run():
+        budget = MemoryBudget(100, wait_timeout=0.05)
+        async with budget.reserve(100, "test"):
+            with pytest.raises(MemoryBudgetExceededError):
+                async with budget.reserve(1, "test"):
+                    pass
+        return budget
+
+    budget = asyncio.run(run())
+    assert budget.rejected == 1
+    assert budget.in_use == 0
+    assert budget.stats()["waiting"] == 0
+
+
+def test_oversized_reservation_is_capped_to_the_budget():
+    async def run():
+        budget = MemoryBudget(100, wait_timeout=0.05)
+        async with budget.reserve(1000, "test"):
+            assert budget.in_use == 100
+
+    asyncio.run(run())
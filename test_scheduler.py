@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+"""
+Unit tests for the fair-share scheduler
+"""
+
+import asyncio
+
+import pytest
+
+from scheduler import FairScheduler, QueueTimeoutError
+
+
+def make_scheduler(capacity=1, weights=None, queue_timeout=5.0):
+    return FairScheduler(
+        capacity=capacity,
+        weights=weights or {},
+        default_weight=1.0,
+        max_concurrency=100,
+        rate=0,
+        burst=1,
+        max_queue_per_client=100,
+        queue_timeout=queue_timeout,
+    )
+
+
+async def use_slot(scheduler, client_id, order):
+    client = await scheduler.acquire(client_id)
+    order.append(client_id)
+    await asyncio.sleep(0)
+    scheduler.release(client)
+
+
+def test_backlogged_clients_share_slots_by_weight():
+    async def run():
+        scheduler = make_scheduler(weights={"batch": 1.0, "interactive": 2.0})
+        holder = await scheduler.acquire("holder")
+        order = []
+        tasks = [asyncio.create_task(use_slot(scheduler, "interactive", order)) for _ in range(6)]
+        tasks += [asyncio.create_task(use_slot(scheduler, "batch", order)) for _ in range(6)]
+        await asyncio.sleep(0)
+        scheduler.release(holder)
+        await asyncio.gather(*tasks)
+        return order
+
+    order = asyncio.run(run())
+    assert len(order) == 12
+    # Twice the weight, twice the slots while both are backlogged
+    assert order[:6].count("interactive") == 4
+    assert order[:6].count("batch") == 2
+
+
+def test_heavy_client_does_not_starve_a_newcomer():
+    async def run():
+        scheduler = make_scheduler()
+        holder = await scheduler.acquire("holder")
+        order = []
+        tasks = [asyncio.create_task(use_slot(scheduler, "batch", order)) for _ in range(10)]
+        await asyncio.sleep(0)
+        tasks.append(asyncio.create_task(use_slot(scheduler, "interactive", order)))
+        await asyncio.sleep(0)
+        scheduler.release(holder)
+        await asyncio.gather(*tasks)
+        return order
+
+    order = asyncio.run(run())
+    assert order.index("interactive") <= 1
+
+
+def test_cancelled_waiter_gives_up_its_place():
+    async def run():
+        scheduler = make_scheduler()
+        holder = await scheduler.acquire("holder")
+        cancelled = asyncio.create_task(scheduler.acquire("a"))
+        order = []
+        waiting = asyncio.create_task(use_slot(scheduler, "b", order))
+        await asyncio.sleep(0)
+        cancelled.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await cancelled
+        assert scheduler.queue_depth() == 1
+        scheduler.release(holder)
+        await waiting
+        return scheduler, order
+
+    scheduler, order = asyncio.run(run())
+    assert order == ["b"]
+    assert scheduler.running == 0
+    assert scheduler.queue_depth() == 0
+
+
+def test_queue_timeout_withdraws_the_ticket():
+    async def run():
+        scheduler = make_scheduler(queue_timeout=0.05)
+        await scheduler.acquire("holder")
+        with pytest.raises(QueueTimeoutError):
+            await scheduler.acquire("a")
+        return scheduler
+
+    scheduler = asyncio.run(run())
+    assert scheduler.queue_depth() == 0
+    assert scheduler.clients["a"].rejected == 1
@@ -0,0 +1,80 @@
+import io
+import time
+from typing import Any, Dict, Optional
+
+from PIL import Image
+
+import request_context
+from ledger import JsonlBatchWriter
+
+# Only requests that reach the generation pipeline are worth replaying
+CAPTURED_PATH_PREFIXES = ("/generate-portrait", "/references")
+
+
+def note(**fields: Any):
+    """Add fields to the current request's captured shape, if capture is on"""
+    shape = request_context.capture_shape.get()
+    if shape is not None:
+        shape.update(fields)
+
+
+def note_image(content: bytes):
+    """Record the size, format and dimensions of an uploaded image, never its pixels"""
+    shape = request_context.capture_shape.get()
+    if shape is None:
+        return
+    shape["image_bytes"] = len(content)
+    try:
+        # Image.open only parses the header here
+        image = Image.open(io.BytesIO(content))
+        shape["image_format"] = image.format
+        shape["image_width"], shape["image_height"] = image.size
+    except Exception:
+        shape["image_format"] = None
+
+
+def note_prompts(style: str, prompt: Optional[str], negative_prompt: Optional[str]):
+    note(
+        style=style,
+        prompt_length=len(prompt or ""),
+        negative_prompt_length=len(negative_prompt or "")
+    )
+
+
+class TrafficCapture:
+    """Records the shape of generation requests for later replay.
+
+    Captured records hold the endpoint, style, prompt lengths, image size and
+    format, response status and latency. They never hold prompt text or image
+    content.
+    """
+
+    def __init__(self, path: str):
+        self.writer = JsonlBatchWriter(path, batch_size=256, flush_interval=1.0, max_pending=10000)
+
+    @staticmethod
+    def wants(path: str, method: str) -> bool:
+        return method == "POST" and path.startswith(CAPTURED_PATH_PREFIXES)
+
+    def begin(self, path: str) -> Dict[str, Any]:
+        shape = {
+            "ts": time.time(),
+            "endpoint": path,
+            "client_id": request_context.client_id.get(),
+        }
+        request_context.capture_shape.set(shape)
+        return shape
+
+    def finish(self, shape: Dict[str, Any], status: int, started: float):
+        shape["status"] = status
+        shape["duration_ms"] = round((time.monotonic() - started) * 1000, 1)
+        self.writer.submit(shape)
+
+    async def start(self):
+        await self.writer.start()
+
+    async def stop(self):
+        await self.writer.stop()
+
+    def stats(self) -> Dict[str, Any]:
+        return self.writer.stats()